@@ -0,0 +1,146 @@
+# Compare the threading and asyncio engines under many open connections: a
+# crowd of idle keep-alive clients, plus a smaller set of busy clients
+# downloading a small file back to back. The threading engine closes idle
+# connections when busy ones need their thread; "idle open" counts how many
+# were still open at the end.
+#
+# Each engine runs as its own server process, so its thread count and memory
+# can be read from /proc (Linux only; the columns show - elsewhere). The
+# clients share one asyncio event loop in this process. Run with:
+#
+#     python benchmarks/bench_concurrency.py [--idle 2000] [--busy 50]
+#
+# Raise the open file limit first (ulimit -n) when using more than about 500
+# idle connections.
+
+import argparse, asyncio, os, pathlib, statistics, subprocess, sys, tempfile
+import time
+
+PORT = 8765
+REQUEST = b'GET /small.txt HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'
+
+def read_status(pid: int) -> dict:
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            return dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return {}
+
+# Returns False if the server is closing the connection
+async def fetch(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+) -> bool:
+    writer.write(REQUEST)
+    head = (await reader.readuntil(b'\r\n\r\n')).lower()
+    for line in head.split(b'\r\n'):
+        if line.startswith(b'content-length:'):
+            await reader.readexactly(int(line.split(b':')[1]))
+            return b'\r\nconnection: close\r\n' not in head
+    raise ValueError('Response without Content-Length')
+
+# Returns the open connection, after one request so the server treats it as
+# kept alive
+async def open_idle() -> tuple:
+    reader, writer = await asyncio.open_connection('127.0.0.1', PORT)
+    await fetch(reader, writer)
+    return reader, writer
+
+# Reconnects like a browser would, when the server closes the connection
+async def busy_client(requests: int, latencies: list):
+    connection = None
+    for _ in range(requests):
+        start = time.perf_counter()
+        while True:
+            if connection is None:
+                connection = await asyncio.open_connection('127.0.0.1', PORT)
+            try:
+                keep_alive = await fetch(*connection)
+                break
+            except (asyncio.IncompleteReadError, ConnectionError):
+                # Closed while idle, before the request arrived
+                connection[1].close()
+                connection = None
+        latencies.append(time.perf_counter() - start)
+
+        if not keep_alive:
+            connection[1].close()
+            connection = None
+    if connection:
+        connection[1].close()
+
+async def run_load(idle: int, busy: int, requests: int) -> tuple:
+    connections = []
+    for start in range(0, idle, 100):
+        connections += await asyncio.gather(*(open_idle()
+            for _ in range(min(100, idle - start))))
+
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(busy_client(requests, latencies)
+        for _ in range(busy)))
+    wall = time.perf_counter() - start
+
+    return connections, len(latencies) / wall, latencies
+
+def measure(engine: str, directory: str, options: argparse.Namespace) -> tuple:
+    server = subprocess.Popen([sys.executable, '-m', 'updownserver',
+        str(PORT), '--engine', engine, '--directory', directory,
+        '--keep-alive-timeout', '600', '--max-requests', '1000000',
+        '--max-connections', str(options.idle + options.busy + 1)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    async def main() -> tuple:
+        for _ in range(100):
+            try:
+                _, writer = await asyncio.open_connection('127.0.0.1', PORT)
+                writer.close()
+                break
+            except OSError:
+                await asyncio.sleep(0.05)
+
+        connections, rate, latencies = await run_load(options.idle,
+            options.busy, options.requests)
+        status = read_status(server.pid)
+        await asyncio.sleep(0.1)
+        idle_open = sum(not reader.at_eof() for reader, _ in connections)
+        for _, writer in connections:
+            writer.close()
+        return rate, latencies, idle_open, status
+
+    try:
+        rate, latencies, idle_open, status = asyncio.run(main())
+    finally:
+        server.terminate()
+        server.wait()
+
+    p99 = statistics.quantiles(latencies, n=100)[98] * 1000
+    return rate, p99, idle_open, status.get('Threads', '-').strip(), \
+        status.get('VmRSS', '-').strip()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--idle', type=int, default=2000,
+        help='Idle keep-alive connections held open [default: 2000]')
+    parser.add_argument('--busy', type=int, default=50,
+        help='Clients sending requests back to back [default: 50]')
+    parser.add_argument('--requests', type=int, default=200,
+        help='Requests per busy client [default: 200]')
+    options = parser.parse_args()
+
+    env_path = str(pathlib.Path(__file__).resolve().parent.parent)
+    os.environ['PYTHONPATH'] = env_path + os.pathsep + \
+        os.environ.get('PYTHONPATH', '')
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, 'small.txt'), 'wb') as f:
+            f.write(os.urandom(4096))
+
+        print(f'{"engine":<12}{"requests/s":>12}{"p99":>12}{"idle open":>11}'
+            f'{"threads":>9}{"RSS":>14}')
+        for engine in ['threading', 'asyncio']:
+            rate, p99, idle_open, threads, rss = measure(engine, directory,
+                options)
+            print(f'{engine:<12}{rate:>12.0f}{p99:>9.1f} ms{idle_open:>11}'
+                f'{threads:>9}{rss:>14}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Measure server CPU time per GB of plain HTTP file downloads, with the
+# socket.sendfile() path in SimpleHTTPRequestHandler.copyfile() and with the
+# buffered stdlib copy it replaced.
+#
+# The server runs in this process and the client in a child process, so
+# time.process_time() here only counts the server. Run with:
+#
+#     python benchmarks/bench_download.py [--size-mb 1024] [--repeat 3]
+
+import argparse, functools, http.server, os, pathlib, subprocess, sys
+import tempfile, threading, time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+import updownserver
+
+# Reads the response into a reused buffer and throws it away
+CLIENT = '''
+import http.client, sys
+connection = http.client.HTTPConnection('127.0.0.1', int(sys.argv[1]))
+buffer = memoryview(bytearray(1 << 20))
+for _ in range(int(sys.argv[2])):
+    connection.request('GET', '/payload.bin')
+    response = connection.getresponse()
+    while response.readinto(buffer):
+        pass
+    connection.close()
+'''
+
+class QuietHandler(updownserver.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class BufferedHandler(QuietHandler):
+    copyfile = http.server.SimpleHTTPRequestHandler.copyfile
+
+def measure(handler_class: type, directory: str, size: int, repeat: int,
+) -> tuple[float, float]:
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+        functools.partial(handler_class, directory=directory))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', CLIENT,
+            str(server.server_address[1]), str(repeat)], check=True)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    gigabytes = size * repeat / 1e9
+    return (cpu / gigabytes, gigabytes / wall)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=1024,
+        help='Size of the downloaded file in MB [default: 1024]')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='Downloads per case [default: 3]')
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        updownserver.args = argparse.Namespace(directory=directory,
+            basic_auth=None, basic_auth_upload=None, client_certificate=None,
+            keep_alive_timeout=15, max_requests=100, metrics=False,
+            server_timing=False, profile_every=0)
+
+        size = options.size_mb << 20
+        with open(os.path.join(directory, 'payload.bin'), 'wb') as f:
+            for _ in range(options.size_mb):
+                f.write(os.urandom(1 << 20))
+
+        print(f'{"copy":<12}{"server CPU":>16}{"throughput":>14}')
+        for name, handler_class in [('buffered', BufferedHandler),
+        ('sendfile', QuietHandler)]:
+            cpu, rate = measure(handler_class, directory, size, options.repeat)
+            print(f'{name:<12}{cpu:>12.3f} s/GB{rate:>10.2f} GB/s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,391 @@
+# End-to-end benchmarks against a real server process: uploads through /upload
+# and PUT, small and large downloads, directory listing latency at several
+# sizes, and mkdir and DELETE rates, over plain HTTP and TLS and with each
+# engine.
+#
+# The results are written as JSON, so runs of different releases can be
+# compared. With --compare, every rate or latency that got worse than the
+# baseline by more than --threshold percent is reported, and the exit status
+# is 1. Run with:
+#
+#     python benchmarks/bench_e2e.py [--output results.json]
+#         [--compare baseline.json] [--engines threading,asyncio]
+#         [--protocols http,https]
+#
+# TLS runs need openssl to make a throwaway certificate, or --certificate. The
+# client is http.client over one keep-alive connection, in this process.
+
+import argparse, datetime, http.client, json, os, pathlib, platform, shutil
+import socket, ssl, statistics, subprocess, sys, tempfile, time, uuid
+
+PORT = 8765
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+# Rates where lower is worse, and latencies where higher is worse
+RATES = ('mb_per_s', 'ops_per_s')
+LATENCIES = ('p50_ms', 'p99_ms', 'first_ms')
+
+CHUNK = os.urandom(1 << 20)
+
+class Client:
+    def __init__(self, protocol: str, port: int):
+        if protocol == 'https':
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            self.connection = http.client.HTTPSConnection('127.0.0.1', port,
+                context=context, blocksize=1 << 20)
+        else:
+            self.connection = http.client.HTTPConnection('127.0.0.1', port,
+                blocksize=1 << 20)
+        self.buffer = memoryview(bytearray(1 << 20))
+
+    # Sends the request and reads the response into a reused buffer. Returns
+    # the status and the number of body bytes
+    def request(self, method: str, path: str, body=None, headers: dict = {},
+    ) -> tuple:
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        received = 0
+        while True:
+            count = response.readinto(self.buffer)
+            if not count:
+                break
+            received += count
+        if response.will_close:
+            self.connection.close()
+        return response.status, received
+
+    def close(self):
+        self.connection.close()
+
+# Yields `size` bytes in 1 MiB chunks, so large bodies are never in memory
+def stream(size: int):
+    while size > 0:
+        yield CHUNK[:size]
+        size -= len(CHUNK)
+
+# Returns the headers and body of a multipart/form-data upload of one file
+# into `path`. With `size`, the body is a generator
+def multipart_upload(path: str, filename: str, data: bytes = None,
+size: int = 0) -> tuple:
+    boundary = uuid.uuid4().hex
+    head = (f'--{boundary}\r\n'
+        'Content-Disposition: form-data; name="path"\r\n\r\n'
+        f'{path}\r\n'
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="files"; filename="{filename}"'
+        '\r\nContent-Type: application/octet-stream\r\n\r\n').encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+
+    if data is not None:
+        return headers, head + data + tail
+    headers['Content-Length'] = str(len(head) + size + len(tail))
+    def body():
+        yield head
+        yield from stream(size)
+        yield tail
+    return headers, body()
+
+def multipart_mkdir(path: str, foldername: str) -> tuple:
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\n'
+        'Content-Disposition: form-data; name="path"\r\n\r\n'
+        f'{path}\r\n'
+        f'--{boundary}\r\n'
+        'Content-Disposition: form-data; name="foldername"\r\n\r\n'
+        f'{foldername}\r\n--{boundary}--\r\n').encode()
+    return {'Content-Type': f'multipart/form-data; boundary={boundary}'}, body
+
+def check(status: int, expected: tuple, what: str):
+    if status not in expected:
+        raise RuntimeError(f'{what} answered {status}')
+
+def summarize(latencies: list, seconds: float, transferred: int = 0) -> dict:
+    result = {
+        'count': len(latencies),
+        'seconds': round(seconds, 6),
+        'ops_per_s': round(len(latencies) / seconds, 2),
+        'p50_ms': round(statistics.median(latencies) * 1000, 3),
+        'p99_ms': round((statistics.quantiles(latencies, n=100)[98]
+            if len(latencies) > 1 else latencies[0]) * 1000, 3),
+    }
+    if transferred:
+        result['bytes'] = transferred
+        result['mb_per_s'] = round(transferred / seconds / 1e6, 2)
+    return result
+
+# Runs `operation(i)` `count` times and returns the summary. operation returns
+# the bytes it transferred
+def timed(operation, count: int) -> dict:
+    latencies = []
+    transferred = 0
+    start = time.perf_counter()
+    for i in range(count):
+        operation_start = time.perf_counter()
+        transferred += operation(i)
+        latencies.append(time.perf_counter() - operation_start)
+    return summarize(latencies, time.perf_counter() - start, transferred)
+
+def run_cases(client: Client, directory: pathlib.Path,
+options: argparse.Namespace) -> dict:
+    results = {}
+    small = os.urandom(options.small_kb << 10)
+    large = options.large_mb << 20
+
+    def fresh(name: str) -> str:
+        shutil.rmtree(directory / name, ignore_errors=True)
+        (directory / name).mkdir()
+        return name
+
+    target = fresh('form-small')
+    def upload_small_form(i: int) -> int:
+        headers, body = multipart_upload(f'/{target}/', f'{i}.bin', small)
+        check(client.request('POST', '/upload', body, headers)[0],
+            (201, 204), 'POST /upload')
+        return len(small)
+    results['upload-small-form'] = timed(upload_small_form,
+        options.small_count)
+
+    target = fresh('put-small')
+    def upload_small_put(i: int) -> int:
+        check(client.request('PUT', f'/{target}/{i}.bin', small)[0],
+            (201, 204), 'PUT')
+        return len(small)
+    results['upload-small-put'] = timed(upload_small_put, options.small_count)
+
+    target = fresh('form-large')
+    def upload_large_form(i: int) -> int:
+        headers, body = multipart_upload(f'/{target}/', f'{i}.bin', size=large)
+        check(client.request('POST', '/upload', body, headers)[0],
+            (201, 204), 'POST /upload')
+        return large
+    results['upload-large-form'] = timed(upload_large_form, options.repeat)
+
+    target = fresh('put-large')
+    def upload_large_put(i: int) -> int:
+        check(client.request('PUT', f'/{target}/{i}.bin', stream(large),
+            {'Content-Length': str(large)})[0], (201, 204), 'PUT')
+        return large
+    results['upload-large-put'] = timed(upload_large_put, options.repeat)
+
+    def download_small(i: int) -> int:
+        status, received = client.request('GET',
+            f'/put-small/{i % options.small_count}.bin')
+        check(status, (200,), 'GET')
+        return received
+    results['download-small'] = timed(download_small, options.small_count)
+
+    def download_large(i: int) -> int:
+        status, received = client.request('GET', f'/put-large/{i}.bin')
+        check(status, (200,), 'GET')
+        return received
+    results['download-large'] = timed(download_large, options.repeat)
+
+    for entries in options.listing_sizes:
+        # The first request renders the page, later ones are served from the
+        # listing cache. Pages sorted by size are never cached
+        for case, query in ((f'listing-{entries}', ''),
+        (f'listing-{entries}-by-size', '?sort=size')):
+            def listing(i: int) -> int:
+                status, received = client.request('GET',
+                    f'/listing-{entries}/{query}')
+                check(status, (200,), 'GET listing')
+                return received
+            first = timed(listing, 1)
+            result = timed(listing, options.listing_repeat)
+            result['first_ms'] = first['p50_ms']
+            results[case] = result
+
+    target = fresh('mkdir')
+    def mkdir(i: int) -> int:
+        headers, body = multipart_mkdir(f'/{target}/', f'{i}')
+        check(client.request('POST', '/mkdir', body, headers)[0], (201,),
+            'POST /mkdir')
+        return 0
+    results['mkdir'] = timed(mkdir, options.ops)
+
+    def delete(i: int) -> int:
+        check(client.request('DELETE', f'/{target}/{i}')[0], (204,), 'DELETE')
+        return 0
+    results['delete'] = timed(delete, options.ops)
+
+    for name in ('form-small', 'put-small', 'form-large', 'put-large',
+    'mkdir'):
+        shutil.rmtree(directory / name, ignore_errors=True)
+    return results
+
+def wait_for_port(port: int, server: subprocess.Popen):
+    for _ in range(200):
+        if server.poll() is not None:
+            raise RuntimeError(f'Server exited with {server.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('Server did not start')
+
+def measure(engine: str, protocol: str, directory: pathlib.Path,
+certificate: str, options: argparse.Namespace) -> dict:
+    command = [sys.executable, '-m', 'updownserver', str(options.port),
+        '--bind', '127.0.0.1', '--directory', str(directory),
+        '--engine', engine, '--max-requests', '1000000']
+    if protocol == 'https':
+        command += ['--server-certificate', certificate]
+    server = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+
+    try:
+        wait_for_port(options.port, server)
+        client = Client(protocol, options.port)
+        try:
+            return run_cases(client, directory, options)
+        finally:
+            client.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+def make_certificate(directory: str) -> str:
+    path = os.path.join(directory, 'server.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-out', path, '-keyout', path,
+        '-newkey', 'rsa:2048', '-nodes', '-sha256', '-subj', '/CN=127.0.0.1',
+        '-days', '1'], check=True, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    return path
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def result_key(result: dict) -> tuple:
+    return result['case'], result['engine'], result['protocol']
+
+# Returns one line per metric that got worse than the baseline by more than
+# threshold percent
+def compare(results: list, baseline: list, threshold: float) -> list:
+    baseline = {result_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = baseline.get(result_key(result))
+        if old is None:
+            continue
+        for metric in RATES + LATENCIES:
+            if not old.get(metric) or metric not in result:
+                continue
+            change = (result[metric] - old[metric]) / old[metric] * 100
+            if (change < -threshold if metric in RATES else
+            change > threshold):
+                regressions.append(f'{"/".join(result_key(result))} {metric}: '
+                    f'{old[metric]} -> {result[metric]} ({change:+.1f}%)')
+    return regressions
+
+def print_result(result: dict):
+    rate = (f'{result["mb_per_s"]:>10.1f} MB/s' if 'mb_per_s' in result
+        else f'{result["ops_per_s"]:>11.0f} /s')
+    print(f'{result["case"]:<26}{result["engine"]:<11}{result["protocol"]:<7}'
+        f'{rate:>16}{result["p50_ms"]:>10.2f} ms{result["p99_ms"]:>10.2f} ms',
+        flush=True)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engines', default='threading,asyncio',
+        help='Comma-separated engines to run [default: threading,asyncio]')
+    parser.add_argument('--protocols', default='http,https',
+        help='Comma-separated protocols to run [default: http,https]')
+    parser.add_argument('--certificate',
+        help='Server certificate for https [default: made with openssl]')
+    parser.add_argument('--port', type=int, default=PORT,
+        help=f'Port for the server [default: {PORT}]')
+    parser.add_argument('--small-kb', type=int, default=4,
+        help='Size of each small file in KB [default: 4]')
+    parser.add_argument('--small-count', type=int, default=500,
+        help='Small files uploaded and downloaded [default: 500]')
+    parser.add_argument('--large-mb', type=int, default=256,
+        help='Size of each large file in MB [default: 256]')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='Large files uploaded and downloaded [default: 3]')
+    parser.add_argument('--listing-sizes', default='1000,10000,100000',
+        help='Comma-separated directory sizes to list '
+            '[default: 1000,10000,100000]')
+    parser.add_argument('--listing-repeat', type=int, default=20,
+        help='Requests per directory listing [default: 20]')
+    parser.add_argument('--ops', type=int, default=500,
+        help='Directories created and deleted [default: 500]')
+    parser.add_argument('--output', help='Write the results as JSON to FILE')
+    parser.add_argument('--compare', metavar='FILE',
+        help='Compare with the results of an earlier --output')
+    parser.add_argument('--threshold', type=float, default=10,
+        help='Percent change reported as a regression [default: 10]')
+    options = parser.parse_args()
+    options.listing_sizes = [int(size)
+        for size in options.listing_sizes.split(',') if size]
+
+    env_path = str(ROOT)
+    os.environ['PYTHONPATH'] = env_path + os.pathsep + \
+        os.environ.get('PYTHONPATH', '')
+
+    report = {
+        'started': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {name: value for name, value in vars(options).items()
+            if name not in ('output', 'compare')},
+        'results': [],
+    }
+
+    with tempfile.TemporaryDirectory() as temp:
+        directory = pathlib.Path(temp, 'root')
+        directory.mkdir()
+        for entries in options.listing_sizes:
+            listing = directory / f'listing-{entries}'
+            listing.mkdir()
+            for i in range(entries):
+                (listing / f'file-{i:06}.txt').touch()
+            # Listings of directories changed in the last second aren't cached
+            os.utime(listing, (time.time() - 60,) * 2)
+
+        certificate = options.certificate
+        protocols = options.protocols.split(',')
+        if 'https' in protocols and not certificate:
+            try:
+                certificate = make_certificate(temp)
+            except (OSError, subprocess.CalledProcessError):
+                print('Skipping https: openssl could not make a certificate',
+                    file=sys.stderr)
+                protocols.remove('https')
+
+        print(f'{"case":<26}{"engine":<11}{"proto":<7}{"rate":>16}'
+            f'{"p50":>13}{"p99":>13}')
+        for engine in options.engines.split(','):
+            for protocol in protocols:
+                cases = measure(engine, protocol, directory, certificate,
+                    options)
+                for case, result in cases.items():
+                    result = {'case': case, 'engine': engine,
+                        'protocol': protocol, **result}
+                    report['results'].append(result)
+                    print_result(result)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+
+    if options.compare:
+        with open(options.compare) as f:
+            regressions = compare(report['results'], json.load(f)['results'],
+                options.threshold)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
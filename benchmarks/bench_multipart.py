@@ -0,0 +1,175 @@
+# Compare upload parsing of the streaming parser in updownserver/multipart.py
+# against the vendored cgi.FieldStorage path it replaced (read_multi(),
+# read_lines_to_outerboundary(), read_binary() through PersistentFieldStorage).
+#
+# Bodies are built in memory and parsed from a BytesIO, so the numbers measure
+# parsing and spooling to disk only, without network noise. Each form is one
+# of the shapes the upload page sends:
+#
+#     huge          a few large random parts
+#     newline-dense one large part with a line break every 64 bytes
+#     tiny          many small files
+#     long-names    small files with non-ASCII filenames of about 200 bytes
+#     folder        a folder upload: each file followed by a "filenames" field
+#                   with its relative path
+#
+# Besides the two parsers, the upload path itself (UploadStream) is run, which
+# moves each file into the served directory as soon as it has arrived.
+#
+# For each, the best of --repeat runs gives MB/s and parts/s. One more run
+# under tracemalloc gives the peak Python memory and the number of temp files
+# left once parsing is done. Run with:
+#
+#     python benchmarks/bench_multipart.py [--size-mb 256] [--parts 10000]
+#         [--repeat 3] [--output results.json]
+
+import argparse, io, json, os, pathlib, sys, tempfile, time, tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+import updownserver
+from updownserver import multipart
+
+BOUNDARY = b'----updownserver-benchmark-boundary'
+
+# A file part, or a plain field when filename is None
+def build_part(name: str, filename: str, data: bytes) -> bytes:
+    if filename is None:
+        disposition = f'form-data; name="{name}"'
+    else:
+        disposition = f'form-data; name="{name}"; filename="{filename}"'
+    return b''.join([
+        b'--', BOUNDARY, b'\r\n',
+        b'Content-Disposition: ', disposition.encode('utf-8'), b'\r\n',
+        b'Content-Type: application/octet-stream\r\n\r\n'
+            if filename is not None else b'\r\n',
+        data, b'\r\n',
+    ])
+
+# Returns the body and the number of parts in it
+def build_body(parts: list) -> tuple:
+    return b''.join([build_part('path', None, b'/')] +
+        [build_part(*part) for part in parts] +
+        [b'--', BOUNDARY, b'--\r\n']), len(parts) + 1
+
+def build_forms(size: int, count: int) -> dict:
+    line = b'x' * 63 + b'\n'
+    small = os.urandom(256)
+    long_name = 'ファイル名-' * 12
+
+    folder = []
+    for i in range(count // 2):
+        folder.append(('files', f'{i}.txt', small))
+        folder.append(('filenames', None,
+            f'album/{i % 100:03}/{i}.txt'.encode()))
+
+    return {
+        'huge': build_body([('files', f'{i}.bin', os.urandom(size // 4))
+            for i in range(4)]),
+        'newline-dense': build_body([('files', 'lines.txt',
+            line * (size // len(line)))]),
+        'tiny': build_body([('files', f'{i}.bin', small[:64])
+            for i in range(count)]),
+        'long-names': build_body([('files', f'{long_name}{i}.bin', small)
+            for i in range(count)]),
+        'folder': build_body(folder),
+    }
+
+def parse_cgi(body: bytes) -> list:
+    form = updownserver.PersistentFieldStorage(fp=io.BytesIO(body), headers={
+        'content-type': 'multipart/form-data; boundary=' + BOUNDARY.decode(),
+        'content-length': str(len(body)),
+    }, environ={'REQUEST_METHOD': 'POST'})
+    return form.list
+
+def parse_streaming(body: bytes) -> list:
+    form = multipart.parse_form(io.BytesIO(body), BOUNDARY, len(body),
+        lambda part: updownserver.make_upload_file())
+    return form.fields
+
+class QuietHandler:
+    timings = None
+
+    def log_message(self, format, *args):
+        pass
+
+# Files are committed as they arrive, so there is nothing to clean up
+def parse_upload(body: bytes) -> list:
+    upload = updownserver.UploadStream(QuietHandler())
+    for part in multipart.MultipartParser(io.BytesIO(body), BOUNDARY,
+    len(body)):
+        if part.name == 'files':
+            upload.receive_file(part)
+        elif part.name == 'path':
+            upload.receive_path(part.read().decode())
+        elif part.name == 'filenames':
+            upload.receive_name(part.read().decode())
+    upload.commit_ready(finished=True)
+    return []
+
+def cleanup(fields: list):
+    for field in fields:
+        if field.file is not None and hasattr(field.file, 'name'):
+            field.file.close()
+            os.remove(field.file.name)
+
+def measure(parse, body: bytes, parts: int, spool: str, repeat: int) -> dict:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cleanup(parse(body))
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        fields = parse(body)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    temp_files = len(os.listdir(spool))
+    cleanup(fields)
+
+    return {
+        'mb_per_s': round(len(body) / best / 1e6, 2),
+        'parts_per_s': round(parts / best, 1),
+        'peak_mb': round(peak / 1e6, 2),
+        'temp_files': temp_files,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=256,
+        help='Size of the large forms in MB [default: 256]')
+    parser.add_argument('--parts', type=int, default=10000,
+        help='Parts in the forms of small files [default: 10000]')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='Runs per case, the best one is reported [default: 3]')
+    parser.add_argument('--output', help='Write the results as JSON to FILE')
+    options = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        updownserver.args = argparse.Namespace(directory=directory,
+            spool_dir=[os.path.join(directory, 'spool')], allow_replace=True)
+        spool = str(updownserver.get_upload_spool(directory))
+
+        print(f'{"form":<15}{"parser":<18}{"MB/s":>10}{"parts/s":>12}'
+            f'{"peak MB":>10}{"temp files":>12}')
+        for form, (body, parts) in build_forms(options.size_mb << 20,
+        options.parts).items():
+            for name, parse in [('cgi.FieldStorage', parse_cgi),
+            ('multipart.py', parse_streaming), ('UploadStream', parse_upload)]:
+                result = measure(parse, body, parts, spool, options.repeat)
+                print(f'{form:<15}{name:<18}{result["mb_per_s"]:>10.1f}'
+                    f'{result["parts_per_s"]:>12.0f}{result["peak_mb"]:>10.1f}'
+                    f'{result["temp_files"]:>12}', flush=True)
+                results.append({'form': form, 'parser': name,
+                    'bytes': len(body), 'parts': parts, **result})
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'options': vars(options), 'results': results}, f,
+                indent=2)
+            f.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,420 @@
+# Soak a server with many slow clients, the way a crowd of mobile uploaders
+# does, and watch whether well-behaved clients still get served.
+#
+# Slow uploaders send PUT (or /upload form) bodies at --upload-rate bytes/s,
+# and slow downloaders read a large file at --download-rate bytes/s. Each one
+# starts over when it's done, until --duration runs out. Meanwhile a few good
+# clients download a small file over keep-alive connections, and their latency
+# is what to watch: every --interval seconds a line shows their request rate,
+# p99 latency and errors, next to the server's RSS, threads, open file
+# descriptors and its upload temp files. With --workers, the server's
+# processes are added up. The stats come from /proc (Linux only; they show -
+# elsewhere).
+#
+# All clients share one asyncio event loop in this process. Run with:
+#
+#     python benchmarks/bench_soak.py [--slow-uploads 2000]
+#         [--slow-downloads 200] [--duration 60] [--engine asyncio]
+#         [--server-args "--threads 256"] [--output results.json]
+#
+# The open file limit is raised to its hard limit for this process and the
+# server. Raise the hard limit (ulimit -Hn) for more than a few thousand
+# connections.
+
+import argparse, asyncio, json, os, pathlib, shlex, statistics, subprocess
+import sys, tempfile, time, uuid
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+PORT = 8765
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.all_latencies = []
+        self.errors = {}
+        self.slow_open = 0
+        self.uploads_done = 0
+        self.downloads_done = 0
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+# Returns the status and headers of a response, lowercase
+async def read_head(reader: asyncio.StreamReader) -> tuple:
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').lower()
+    status_line, *lines = head.split('\r\n')
+    headers = dict(line.split(':', 1) for line in lines if ':' in line)
+    return int(status_line.split()[1]), {name: value.strip()
+        for name, value in headers.items()}
+
+async def read_body(reader: asyncio.StreamReader, headers: dict,
+rate: float = 0) -> int:
+    remaining = int(headers.get('content-length', 0))
+    chunk = max(int(rate / 10), 1) if rate else 1 << 16
+    while remaining:
+        data = await reader.read(min(chunk, remaining))
+        if not data:
+            raise asyncio.IncompleteReadError(b'', remaining)
+        remaining -= len(data)
+        if rate:
+            await asyncio.sleep(len(data) / rate)
+    return remaining
+
+async def trickle(writer: asyncio.StreamWriter, size: int, rate: float):
+    chunk = max(int(rate / 10), 1)
+    data = os.urandom(chunk)
+    while size > 0:
+        writer.write(data[:size])
+        await writer.drain()
+        size -= chunk
+        await asyncio.sleep(chunk / rate)
+
+async def slow_upload(options: argparse.Namespace, number: int):
+    reader, writer = await asyncio.open_connection('127.0.0.1', options.port,
+        limit=1 << 16)
+    try:
+        await send_upload(writer, options, number)
+        status, headers = await read_head(reader)
+        await read_body(reader, headers)
+        return status
+    finally:
+        writer.close()
+
+async def send_upload(writer: asyncio.StreamWriter,
+options: argparse.Namespace, number: int):
+    if options.upload_kind == 'put':
+        writer.write((f'PUT /soak/{number}.bin HTTP/1.1\r\n'
+            'Host: 127.0.0.1\r\nConnection: close\r\n'
+            f'Content-Length: {options.upload_size}\r\n\r\n').encode())
+        await trickle(writer, options.upload_size, options.upload_rate)
+    else:
+        boundary = uuid.uuid4().hex
+        head = (f'--{boundary}\r\n'
+            'Content-Disposition: form-data; name="path"\r\n\r\n/soak/\r\n'
+            f'--{boundary}\r\n'
+            'Content-Disposition: form-data; name="files"; '
+            f'filename="{number}.bin"\r\n\r\n').encode()
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        writer.write(('POST /upload HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+            'Connection: close\r\nContent-Type: multipart/form-data; '
+            f'boundary={boundary}\r\nContent-Length: '
+            f'{len(head) + options.upload_size + len(tail)}\r\n\r\n'
+            ).encode() + head)
+        await trickle(writer, options.upload_size, options.upload_rate)
+        writer.write(tail)
+        await writer.drain()
+
+async def slow_download(options: argparse.Namespace):
+    reader, writer = await asyncio.open_connection('127.0.0.1', options.port,
+        limit=1 << 16)
+    try:
+        writer.write(b'GET /large.bin HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+            b'Connection: close\r\n\r\n')
+        status, headers = await read_head(reader)
+        await read_body(reader, headers, options.download_rate)
+        return status
+    finally:
+        writer.close()
+
+# Starts over until the deadline, counting completions and errors
+async def slow_client(kind: str, options: argparse.Namespace, stats: Stats,
+deadline: float, number: int):
+    # Spread out the connections, so they don't all start in the same
+    # instant
+    await asyncio.sleep(number % 100 / 100)
+    while time.monotonic() < deadline:
+        stats.slow_open += 1
+        try:
+            if kind == 'upload':
+                status = await slow_upload(options, number)
+            else:
+                status = await slow_download(options)
+        except (OSError, asyncio.IncompleteReadError,
+        asyncio.LimitOverrunError) as e:
+            # A reset while uploading is most likely a 503 for too many
+            # uploads: the server answers and closes the connection before
+            # the body is finished, and the reset loses the response
+            status = type(e).__name__
+        finally:
+            stats.slow_open -= 1
+
+        if status in (200, 201, 204):
+            if kind == 'upload':
+                stats.uploads_done += 1
+            else:
+                stats.downloads_done += 1
+        else:
+            stats.error(f'slow {kind} {status}')
+            # Back off like a client retrying later
+            await asyncio.sleep(1)
+
+# Sends one request. Returns the status and whether the connection stays open
+async def fetch(connection: tuple, timeout: float) -> tuple:
+    reader, writer = connection
+    writer.write(b'GET /small.bin HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n')
+    status, headers = await asyncio.wait_for(read_head(reader), timeout)
+    await asyncio.wait_for(read_body(reader, headers), timeout)
+    return status, headers.get('connection') != 'close'
+
+async def good_client(options: argparse.Namespace, stats: Stats,
+deadline: float):
+    connection = None
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            if connection is not None:
+                try:
+                    status, keep_alive = await fetch(connection,
+                        options.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    # Closed while idle, before the request arrived. A
+                    # browser retries on a new connection
+                    connection[1].close()
+                    connection = None
+            if connection is None:
+                connection = await asyncio.wait_for(asyncio.open_connection(
+                    '127.0.0.1', options.port), options.timeout)
+                status, keep_alive = await fetch(connection, options.timeout)
+            latency = time.perf_counter() - start
+            if status != 200:
+                stats.error(f'good {status}')
+            else:
+                stats.latencies.append(latency)
+                stats.all_latencies.append(latency)
+            if not keep_alive:
+                connection[1].close()
+                connection = None
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+        asyncio.LimitOverrunError) as e:
+            stats.error(f'good {type(e).__name__}')
+            if connection:
+                connection[1].close()
+            connection = None
+        await asyncio.sleep(options.good_interval)
+    if connection:
+        connection[1].close()
+
+# The server process and, with --workers, its children
+def process_tree(pid: int) -> list:
+    pids = [pid]
+    try:
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    parent = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            if parent == pid:
+                pids.append(int(entry))
+    except OSError:
+        pass
+    return pids
+
+# Returns RSS in MB, threads and open file descriptors, or None for each one
+# that can't be read
+def read_process_stats(pid: int) -> tuple:
+    rss = threads = fds = None
+    for process in process_tree(pid):
+        try:
+            with open(f'/proc/{process}/status') as f:
+                status = dict(line.split(':', 1) for line in f if ':' in line)
+            rss = (rss or 0) + int(status['VmRSS'].split()[0]) / 1024
+            threads = (threads or 0) + int(status['Threads'])
+            fds = (fds or 0) + len(os.listdir(f'/proc/{process}/fd'))
+        except (OSError, KeyError, ValueError):
+            pass
+    return rss, threads, fds
+
+# Uploads the server is still receiving, or has left behind: they are
+# spooled to tempfile names until committed. Counts both the served root and
+# the spool directory
+def count_temp_files(directory: str) -> int:
+    return sum(1 for path in pathlib.Path(directory).rglob('tmp*')
+        if path.is_file())
+
+def take_sample(elapsed: float, interval: float, pid: int, directory: str,
+stats: Stats) -> dict:
+    latencies, stats.latencies = stats.latencies, []
+    rss, threads, fds = read_process_stats(pid)
+    return {
+        'time': round(elapsed, 1),
+        'slow_open': stats.slow_open,
+        'good_per_s': round(len(latencies) / interval, 1),
+        'good_p99_ms': round(statistics.quantiles(latencies, n=100)[98]
+            * 1000, 2) if len(latencies) > 1 else None,
+        'errors': sum(stats.errors.values()),
+        'rss_mb': round(rss, 1) if rss is not None else None,
+        'threads': threads,
+        'fds': fds,
+        'temp_files': count_temp_files(directory),
+    }
+
+def print_sample(sample: dict):
+    def show(value: object, format: str) -> str:
+        return '-' if value is None else format.format(value)
+    print(f'{sample["time"]:>7.1f}{sample["slow_open"]:>10}'
+        f'{sample["good_per_s"]:>10.1f}'
+        f'{show(sample["good_p99_ms"], "{:.1f} ms"):>12}'
+        f'{sample["errors"]:>8}{show(sample["rss_mb"], "{:.0f} MB"):>10}'
+        f'{show(sample["threads"], "{}"):>9}{show(sample["fds"], "{}"):>7}'
+        f'{sample["temp_files"]:>7}', flush=True)
+
+async def run(options: argparse.Namespace, pid: int, directory: str) -> dict:
+    stats = Stats()
+    deadline = time.monotonic() + options.duration
+    tasks = [asyncio.ensure_future(slow_client('upload', options, stats,
+        deadline, i)) for i in range(options.slow_uploads)]
+    tasks += [asyncio.ensure_future(slow_client('download', options, stats,
+        deadline, i)) for i in range(options.slow_downloads)]
+    tasks += [asyncio.ensure_future(good_client(options, stats, deadline))
+        for _ in range(options.good_clients)]
+
+    print(f'{"time":>7}{"slow open":>10}{"good/s":>10}{"good p99":>12}'
+        f'{"errors":>8}{"RSS":>10}{"threads":>9}{"fds":>7}{"temp":>7}')
+    samples = []
+    start = time.monotonic()
+    while time.monotonic() < deadline:
+        await asyncio.sleep(options.interval)
+        samples.append(take_sample(time.monotonic() - start, options.interval,
+            pid, directory, stats))
+        print_sample(samples[-1])
+
+    # Clients stop at the deadline, after what they were doing. Those still
+    # stuck are cancelled
+    done, pending = await asyncio.wait(tasks, timeout=options.timeout)
+    for task in pending:
+        task.cancel()
+    # Give the server a moment to notice the closed connections and remove
+    # what they were uploading
+    await asyncio.sleep(1)
+
+    latencies = stats.all_latencies
+    return {
+        'samples': samples,
+        'good_requests': len(latencies),
+        'good_p50_ms': round(statistics.median(latencies) * 1000, 2)
+            if latencies else None,
+        'good_p99_ms': round(statistics.quantiles(latencies, n=100)[98]
+            * 1000, 2) if len(latencies) > 1 else None,
+        'uploads_done': stats.uploads_done,
+        'downloads_done': stats.downloads_done,
+        'errors': stats.errors,
+        'peak_rss_mb': max((sample['rss_mb'] or 0 for sample in samples),
+            default=None),
+        'peak_threads': max((sample['threads'] or 0 for sample in samples),
+            default=None),
+        'peak_fds': max((sample['fds'] or 0 for sample in samples),
+            default=None),
+        'peak_temp_files': max((sample['temp_files'] for sample in samples),
+            default=None),
+        'temp_files_left': count_temp_files(directory),
+    }
+
+def raise_open_file_limit():
+    if resource:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def wait_for_port(port: int, server: subprocess.Popen):
+    async def connect():
+        for _ in range(200):
+            if server.poll() is not None:
+                raise RuntimeError(f'Server exited with {server.returncode}')
+            try:
+                _, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.close()
+                return
+            except OSError:
+                await asyncio.sleep(0.05)
+        raise RuntimeError('Server did not start')
+    asyncio.run(connect())
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slow-uploads', type=int, default=2000,
+        help='Clients uploading slowly [default: 2000]')
+    parser.add_argument('--slow-downloads', type=int, default=200,
+        help='Clients downloading slowly [default: 200]')
+    parser.add_argument('--good-clients', type=int, default=10,
+        help='Clients downloading a small file over keep-alive, whose '
+            'latency is reported [default: 10]')
+    parser.add_argument('--upload-kind', choices=['put', 'form'],
+        default='put', help='Upload with PUT or through /upload '
+            '[default: put]')
+    parser.add_argument('--upload-size', type=int, default=1 << 20,
+        help='Bytes per slow upload [default: 1048576]')
+    parser.add_argument('--upload-rate', type=float, default=16384,
+        help='Bytes per second per slow upload [default: 16384]')
+    parser.add_argument('--download-rate', type=float, default=65536,
+        help='Bytes per second per slow download [default: 65536]')
+    parser.add_argument('--download-size', type=int, default=2 << 20,
+        help='Size of the slowly downloaded file [default: 2097152]')
+    parser.add_argument('--good-interval', type=float, default=0.05,
+        help='Seconds between requests of each good client [default: 0.05]')
+    parser.add_argument('--timeout', type=float, default=30,
+        help='Seconds a good client waits before counting an error '
+            '[default: 30]')
+    parser.add_argument('--duration', type=float, default=60,
+        help='Seconds to run [default: 60]')
+    parser.add_argument('--interval', type=float, default=5,
+        help='Seconds between samples [default: 5]')
+    parser.add_argument('--engine', choices=['threading', 'asyncio'],
+        default='threading', help='Server engine [default: threading]')
+    parser.add_argument('--server-args', default='',
+        help='More options for the server, e.g. "--threads 256"')
+    parser.add_argument('--port', type=int, default=PORT,
+        help=f'Port for the server [default: {PORT}]')
+    parser.add_argument('--output', help='Write the samples and summary as '
+        'JSON to FILE')
+    options = parser.parse_args()
+
+    raise_open_file_limit()
+    os.environ['PYTHONPATH'] = str(ROOT) + os.pathsep + \
+        os.environ.get('PYTHONPATH', '')
+
+    with tempfile.TemporaryDirectory() as directory:
+        root = os.path.join(directory, 'root')
+        os.makedirs(os.path.join(root, 'soak'))
+        with open(os.path.join(root, 'small.bin'), 'wb') as f:
+            f.write(os.urandom(4096))
+        with open(os.path.join(root, 'large.bin'), 'wb') as f:
+            f.truncate(options.download_size)
+
+        server = subprocess.Popen([sys.executable, '-m', 'updownserver',
+            str(options.port), '--bind', '127.0.0.1', '--directory', root,
+            '--spool-dir', os.path.join(directory, 'spool'),
+            '--engine', options.engine, '--allow-replace',
+            '--max-requests', '1000000', *shlex.split(options.server_args)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(options.port, server)
+            summary = asyncio.run(run(options, server.pid, directory))
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f'good clients: {summary["good_requests"]} requests, p50 '
+        f'{summary["good_p50_ms"]} ms, p99 {summary["good_p99_ms"]} ms')
+    print(f'slow clients: {summary["uploads_done"]} uploads and '
+        f'{summary["downloads_done"]} downloads done')
+    print(f'peak: RSS {summary["peak_rss_mb"]} MB, {summary["peak_threads"]} '
+        f'threads, {summary["peak_fds"]} fds, {summary["peak_temp_files"]} '
+        f'temp files ({summary["temp_files_left"]} left at the end)')
+    for kind, count in sorted(summary['errors'].items()):
+        print(f'errors: {kind}: {count}')
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'options': vars(options), **summary}, f, indent=2)
+            f.write('\n')
+
+if __name__ == '__main__':
+    main()
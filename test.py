@@ -1,4 +1,5 @@
-import os, subprocess, time, urllib3, shutil, sys
+import os, subprocess, time, urllib3, shutil, sys, concurrent.futures, json
+import http.client, socket, ssl
 from pathlib import Path
 
 import pytest, requests
@@ -13,6 +14,10 @@ assert 'PROTOCOL' in os.environ, '$PROTOCOL envionment variable not set'
 PROTOCOL = os.environ['PROTOCOL']
 assert PROTOCOL in ['HTTP', 'HTTPS'], 'Unknown $PROTOCOL: {}'.format(PROTOCOL)
 
+# Optional, runs the whole suite against another server engine
+ENGINE = os.environ.get('ENGINE', 'threading')
+assert ENGINE in ['threading', 'asyncio'], 'Unknown $ENGINE: {}'.format(ENGINE)
+
 
 TEST_BASIC_AUTH = requests.auth.HTTPBasicAuth('foo', 'bar')
 TEST_BASIC_AUTH_BAD_USER = requests.auth.HTTPBasicAuth('foo2', 'bar')
@@ -40,8 +45,12 @@ def setup_module():
 def setup_function():
     print()
 
+# Waits for the server to exit, it removes its spool directories on the way out
+# and must not answer the next test's requests meanwhile
 def teardown_function():
-    if server_holder[0]: server_holder[0].terminate()
+    if server_holder[0]:
+        server_holder[0].terminate()
+        server_holder[0].wait(10)
 
 #########
 # Tests #
@@ -284,6 +293,42 @@ def test_large_upload():
     
     with open('a-larger-file') as f: assert f.read() == file_content
 
+# Binary content full of line breaks and partial boundaries, spanning several
+# of the multipart parser's reads
+def test_upload_binary_line_breaks():
+    spawn_server()
+    
+    file_content = (b'\r\n--\n\r\r\n-' + bytes(range(256))) * 10000
+    
+    res = post('/upload', files={
+        'files': ('binary-file', file_content),
+    })
+    assert res.status_code == 204
+    
+    with open('binary-file', 'rb') as f: assert f.read() == file_content
+
+def test_upload_truncated_body():
+    spawn_server()
+    
+    res = post('/upload', headers={
+        'Content-Type': 'multipart/form-data; boundary=xyz',
+    }, data=b'--xyz\r\nContent-Disposition: form-data; name="files"; '
+        b'filename="truncated-file"\r\n\r\nno closing boundary')
+    assert res.status_code == 400
+    
+    assert not Path('truncated-file').exists()
+    assert next(Path('.').glob('tmp*'), None) is None
+
+def test_upload_cgi():
+    spawn_server(cgi=True)
+    
+    res = post('/upload', files={
+        'files': ('cgi-file', 'cgi-file-content'),
+    })
+    assert res.status_code == 204
+    
+    with open('cgi-file') as f: assert f.read() == 'cgi-file-content'
+
 def test_url_encoded_file_name():
     spawn_server()
     
@@ -342,12 +387,143 @@ def test_with_theme_light():
     
     with open('theme-light-file') as f: assert f.read() == 'content-for-light'
 
+# Large enough that the kernel sends it in several pieces
+def test_download_large_file():
+    spawn_server()
+    
+    file_content = os.urandom(8*1024*1024 + 123)
+    with open('download-large-file', 'wb') as f: f.write(file_content)
+    
+    res = get('/download-large-file')
+    assert res.status_code == 200
+    assert int(res.headers['Content-Length']) == len(file_content)
+    assert res.content == file_content
+
+@pytest.mark.parametrize('cgi', [False, True])
+def test_download_range(cgi):
+    spawn_server(cgi=cgi)
+    
+    with open('range-file.txt', 'w') as f: f.write('0123456789')
+    
+    res = get('/range-file.txt')
+    assert res.headers['Accept-Ranges'] == 'bytes'
+    
+    for range_header, content, content_range in [
+        ('bytes=2-5', '2345', 'bytes 2-5/10'),
+        ('bytes=7-', '789', 'bytes 7-9/10'),
+        ('bytes=-3', '789', 'bytes 7-9/10'),
+        ('bytes=8-100', '89', 'bytes 8-9/10'),
+    ]:
+        res = get('/range-file.txt', headers={'Range': range_header})
+        assert res.status_code == 206
+        assert res.text == content
+        assert res.headers['Content-Range'] == content_range
+        assert int(res.headers['Content-Length']) == len(content)
+
+def test_download_multiple_ranges():
+    spawn_server()
+    
+    with open('multi-range-file.txt', 'w') as f: f.write('0123456789')
+    
+    res = get('/multi-range-file.txt', headers={'Range': 'bytes=0-1,-2'})
+    assert res.status_code == 206
+    content_type, boundary = res.headers['Content-Type'].split('; boundary=')
+    assert content_type == 'multipart/byteranges'
+    assert int(res.headers['Content-Length']) == len(res.content)
+    assert res.text == (
+        f'\r\n--{boundary}\r\nContent-Type: text/plain\r\n'
+        f'Content-Range: bytes 0-1/10\r\n\r\n01'
+        f'\r\n--{boundary}\r\nContent-Type: text/plain\r\n'
+        f'Content-Range: bytes 8-9/10\r\n\r\n89'
+        f'\r\n--{boundary}--\r\n'
+    )
+
+def test_download_range_not_satisfiable():
+    spawn_server()
+    
+    with open('short-range-file.txt', 'w') as f: f.write('0123456789')
+    
+    res = get('/short-range-file.txt', headers={'Range': 'bytes=10-20'})
+    assert res.status_code == 416
+    assert res.headers['Content-Range'] == 'bytes */10'
+    
+    # Malformed ranges are ignored
+    res = get('/short-range-file.txt', headers={'Range': 'bytes=5-2'})
+    assert res.status_code == 200
+    assert res.text == '0123456789'
+
+def test_download_if_range():
+    spawn_server()
+    
+    with open('if-range-file.txt', 'w') as f: f.write('0123456789')
+    last_modified = get('/if-range-file.txt').headers['Last-Modified']
+    
+    res = get('/if-range-file.txt', headers={'Range': 'bytes=0-0',
+        'If-Range': last_modified})
+    assert res.status_code == 206
+    assert res.text == '0'
+    
+    res = get('/if-range-file.txt', headers={'Range': 'bytes=0-0',
+        'If-Range': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+    assert res.status_code == 200
+    assert res.text == '0123456789'
+    
+    etag = get('/if-range-file.txt').headers['ETag']
+    res = get('/if-range-file.txt', headers={'Range': 'bytes=0-0',
+        'If-Range': etag})
+    assert res.status_code == 206
+    
+    res = get('/if-range-file.txt', headers={'Range': 'bytes=0-0',
+        'If-Range': '"stale"'})
+    assert res.status_code == 200
+
+def test_download_conditional():
+    spawn_server()
+    
+    with open('conditional-file.txt', 'w') as f: f.write('content')
+    res = get('/conditional-file.txt')
+    etag, last_modified = res.headers['ETag'], res.headers['Last-Modified']
+    assert etag.startswith('"')
+    
+    res = get('/conditional-file.txt', headers={'If-None-Match': etag})
+    assert res.status_code == 304
+    assert res.headers['ETag'] == etag
+    assert res.content == b''
+    
+    res = get('/conditional-file.txt', headers={
+        'If-None-Match': '"other", ' + etag})
+    assert res.status_code == 304
+    
+    res = get('/conditional-file.txt', headers={'If-None-Match': '"other"'})
+    assert res.status_code == 200
+    
+    res = get('/conditional-file.txt',
+        headers={'If-Modified-Since': last_modified})
+    assert res.status_code == 304
+    
+    res = get('/conditional-file.txt', headers={'If-Match': '"other"'})
+    assert res.status_code == 412
+    
+    res = get('/conditional-file.txt', headers={
+        'If-Unmodified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+    assert res.status_code == 412
+
+def test_download_cgi():
+    spawn_server(cgi=True)
+    
+    with open('download-cgi-file', 'w') as f: f.write('cgi-download-content')
+    
+    res = get('/download-cgi-file')
+    assert res.status_code == 200
+    assert res.text == 'cgi-download-content'
+
 def test_directory_listing_injections():
     spawn_server()
     
     res = get('/')
     assert res.status_code == 200
-    assert int(res.headers['Content-Length']) == len(res.text)
+    assert res.headers['Transfer-Encoding'] == 'chunked'
+    assert res.text.endswith('</html>\n')
     assert '<!-- Injected by updownserver -->' in res.text
     assert 'id="drop-zone"' in res.text
 
@@ -357,10 +533,131 @@ def test_directory_listing_injections_cgi():
     
     res = get('/')
     assert res.status_code == 200
-    assert int(res.headers['Content-Length']) == len(res.text)
+    assert res.headers['Transfer-Encoding'] == 'chunked'
+    assert res.text.endswith('</html>\n')
     assert '<!-- Injected by updownserver -->' in res.text
     assert 'id="drop-zone"' in res.text
 
+# Enough entries for several chunks
+def test_directory_listing_entries():
+    spawn_server()
+    
+    os.makedirs('listing-entries/Sub-directory', exist_ok=True)
+    os.symlink('Sub-directory', 'listing-entries/directory-link')
+    for i in range(2000):
+        with open(f'listing-entries/file <{i:04}>.txt', 'w'): pass
+    
+    res = get('/listing-entries/?limit=5000')
+    assert res.status_code == 200
+    items = [line for line in res.text.splitlines() if line.startswith('<li>')]
+    assert len(items) == 2002
+    assert items[0] == '<li><a href="directory-link/">directory-link@</a></li>'
+    assert items[1] == \
+        '<li><a href="file%20%3C0000%3E.txt">file &lt;0000&gt;.txt</a></li>'
+    assert items[-1] == '<li><a href="Sub-directory/">Sub-directory/</a></li>'
+    assert '<title>Directory listing for /listing-entries/</title>' in res.text
+
+def test_directory_listing_pages():
+    spawn_server()
+    
+    os.makedirs('listing-pages', exist_ok=True)
+    for i in range(25):
+        with open(f'listing-pages/file-{i:02}', 'w') as f: f.write('x' * i)
+    
+    def names(query: str) -> list:
+        res = get(f'/listing-pages/?{query}&format=json')
+        assert res.status_code == 200
+        return [entry['name'] for entry in res.json()['entries']]
+    
+    assert names('limit=10&page=3') == [f'file-{i:02}' for i in range(20, 25)]
+    assert names('limit=3&sort=size&order=desc') == \
+        ['file-24', 'file-23', 'file-22']
+    assert names('filter=FILE-1') == [f'file-{i:02}' for i in range(10, 20)]
+    assert names('filter=*-?5') == ['file-05', 'file-15']
+    
+    listing = get('/listing-pages/?limit=10&format=json').json()
+    assert (listing['total'], listing['pages']) == (25, 3)
+    
+    res = get('/listing-pages/?limit=10&page=2&sort=mtime')
+    assert res.text.count('<li>') == 10
+    assert '<a href="?page=3&amp;limit=10&amp;sort=mtime">Next &rsaquo;</a>' \
+        in res.text
+    
+    assert get('/listing-pages/?sort=owner').status_code == 400
+    assert get('/listing-pages/?page=0').status_code == 400
+
+def test_directory_listing_cache():
+    spawn_server()
+    
+    os.makedirs('listing-cache', exist_ok=True)
+    with open('listing-cache/first.txt', 'w'): pass
+    # Directories modified in the last second aren't cached
+    os.utime('listing-cache', (time.time() - 10, time.time() - 10))
+    
+    res = get('/listing-cache/')
+    etag = res.headers['ETag']
+    assert etag.startswith('W/"')
+    assert res.headers['Cache-Control'] == 'no-cache'
+    assert 'Last-Modified' in res.headers
+    
+    cached = get('/listing-cache/')
+    assert cached.headers['ETag'] == etag
+    assert int(cached.headers['Content-Length']) == len(cached.content)
+    assert cached.content == res.content
+    
+    res = get('/listing-cache/', headers={'If-None-Match': etag})
+    assert res.status_code == 304
+    assert res.content == b''
+    
+    # Other pages of the same directory are cached separately
+    assert get('/listing-cache/?limit=1').headers['ETag'] != etag
+    
+    with open('listing-cache/second.txt', 'w'): pass
+    os.utime('listing-cache', (time.time() - 5, time.time() - 5))
+    res = get('/listing-cache/', headers={'If-None-Match': etag})
+    assert res.status_code == 200
+    assert res.headers['ETag'] != etag
+    assert 'second.txt' in res.text
+
+# HTTP/1.0 clients can't read chunked responses, so the listing ends by
+# closing the connection
+def test_directory_listing_http_1_0():
+    spawn_server()
+    
+    connection = connect()
+    connection._http_vsn, connection._http_vsn_str = 10, 'HTTP/1.0'
+    connection.request('GET', '/')
+    res = connection.getresponse()
+    assert res.status == 200
+    assert res.getheader('Transfer-Encoding') is None
+    assert res.getheader('Connection') == 'close'
+    assert res.read().endswith(b'</html>\n')
+
+def test_directory_listing_json():
+    spawn_server()
+    
+    os.makedirs('json-listing/sub folder', exist_ok=True)
+    with open('json-listing/a file.txt', 'w') as f: f.write('12345')
+    
+    res = get('/json-listing/?format=json')
+    assert res.status_code == 200
+    assert res.headers['Content-Type'] == 'application/json'
+    listing = res.json()
+    assert listing['path'] == '/json-listing/'
+    
+    entries = {entry['name']: entry for entry in listing['entries']}
+    assert entries['a file.txt']['href'] == 'a%20file.txt'
+    assert entries['a file.txt']['type'] == 'file'
+    assert entries['a file.txt']['size'] == 5
+    assert entries['a file.txt']['mtime'] == \
+        os.stat('json-listing/a file.txt').st_mtime
+    assert entries['sub folder']['href'] == 'sub%20folder/'
+    assert entries['sub folder']['type'] == 'directory'
+    assert entries['sub folder']['size'] is None
+    
+    # The page gets this in one request, instead of a HEAD per entry
+    assert "method: 'HEAD'" not in get('/json-listing/').text
+
 if PROTOCOL == 'HTTPS':
     def test_client_cert_valid():
         spawn_server(client_certificate=('../client.pem', '../client.crt'))
@@ -590,6 +887,915 @@ def test_folder_upload_to_subdirectory():
     with open('target-subdir/inner/nested-file.txt') as f:
         assert f.read() == 'nested-content'
 
+# Entries in "filenames" are matched to files in order, wherever they are in
+# the form
+def test_folder_upload_names_before_files():
+    spawn_server()
+    
+    res = post('/upload', files=[
+        ('filenames', (None, 'names-first/one.txt')),
+        ('filenames', (None, 'names-first/two.txt')),
+        ('files', ('1.txt', 'one')),
+        ('path', (None, '/')),
+        ('files', ('2.txt', 'two')),
+    ])
+    assert res.status_code == 204
+    
+    with open('names-first/one.txt') as f: assert f.read() == 'one'
+    with open('names-first/two.txt') as f: assert f.read() == 'two'
+
+# In the order the upload page sends a folder (path, then each file followed
+# by its "filenames" entry), each file is in place before the next one arrives
+def test_folder_upload_commits_each_file():
+    shutil.rmtree('../test-spool', ignore_errors=True)
+    spawn_server(spool_dir='../test-spool')
+    
+    def part(name, filename, data):
+        disposition = f'form-data; name="{name}"' + \
+            (f'; filename="{filename}"' if filename else '')
+        return (f'--xyz\r\nContent-Disposition: {disposition}\r\n\r\n'
+            ).encode() + data + b'\r\n'
+    # A part ends where the next boundary begins, so that much of the second
+    # file is sent with the first
+    body = part('path', None, b'/') + \
+        part('files', 'a.txt', b'first') + \
+        part('filenames', None, b'streamed/a.txt') + \
+        part('files', 'b.txt', b'second') + \
+        part('filenames', None, b'streamed/b.txt') + b'--xyz--\r\n'
+    split = body.index(b'second')
+    head, tail = body[:split], body[split:]
+    
+    try:
+        connection = connect()
+        connection.putrequest('POST', '/upload')
+        connection.putheader('Content-Type', 'multipart/form-data; boundary=xyz')
+        connection.putheader('Content-Length', str(len(head) + len(tail)))
+        connection.endheaders()
+        connection.send(head)
+        for _ in range(100):
+            if Path('streamed/a.txt').exists():
+                break
+            time.sleep(0.01)
+        with open('streamed/a.txt', 'rb') as f: assert f.read() == b'first'
+        assert not Path('streamed/b.txt').exists()
+        
+        connection.send(tail)
+        assert connection.getresponse().status == 204
+        connection.close()
+        with open('streamed/b.txt', 'rb') as f: assert f.read() == b'second'
+        assert list(Path('../test-spool').glob('uploads-*/*')) == []
+    finally:
+        server_holder[0].terminate()
+        server_holder[0].wait(10)
+        shutil.rmtree('../test-spool', ignore_errors=True)
+
+#####################
+# Raw PUT Tests     #
+#####################
+
+def test_put_raw_body():
+    spawn_server()
+    
+    res = put('/put-raw-file.bin', data=b'raw\r\n--content')
+    assert res.status_code == 201
+    assert res.headers['Location'] == '/put-raw-file.bin'
+    
+    with open('put-raw-file.bin', 'rb') as f:
+        assert f.read() == b'raw\r\n--content'
+
+def test_put_raw_creates_parents():
+    spawn_server()
+    
+    res = put('/put-parent/put-child/put-file.txt', data=b'nested')
+    assert res.status_code == 201
+    
+    with open('put-parent/put-child/put-file.txt') as f:
+        assert f.read() == 'nested'
+
+def test_put_raw_same_name_default():
+    spawn_server()
+    
+    assert put('/put-autorename.txt', data=b'first').status_code == 201
+    res = put('/put-autorename.txt', data=b'second')
+    assert res.status_code == 201
+    assert res.headers['Location'] == '/put-autorename%20%281%29.txt'
+    
+    with open('put-autorename.txt') as f: assert f.read() == 'first'
+    with open('put-autorename (1).txt') as f: assert f.read() == 'second'
+
+def test_put_raw_same_name_replace():
+    spawn_server(allow_replace=True)
+    
+    assert put('/put-replace.txt', data=b'first').status_code == 201
+    assert put('/put-replace.txt', data=b'second').status_code == 204
+    
+    with open('put-replace.txt') as f: assert f.read() == 'second'
+    assert not Path('put-replace (1).txt').exists()
+
+def test_put_raw_requires_auth():
+    spawn_server(basic_auth_upload=TEST_BASIC_AUTH)
+    
+    assert put('/put-unauth.txt', data=b'content').status_code == 401
+    assert not Path('put-unauth.txt').exists()
+    
+    assert put('/put-auth.txt', data=b'content',
+        auth=TEST_BASIC_AUTH).status_code == 201
+    assert Path('put-auth.txt').exists()
+
+def test_put_raw_preconditions():
+    spawn_server(allow_replace=True)
+    
+    res = put('/put-conditional.txt', data=b'first',
+        headers={'If-None-Match': '*'})
+    assert res.status_code == 201
+    etag = res.headers['ETag']
+    assert get('/put-conditional.txt').headers['ETag'] == etag
+    
+    assert put('/put-conditional.txt', data=b'second',
+        headers={'If-None-Match': '*'}).status_code == 412
+    assert put('/put-conditional.txt', data=b'second',
+        headers={'If-Match': '"other"'}).status_code == 412
+    with open('put-conditional.txt') as f: assert f.read() == 'first'
+    
+    res = put('/put-conditional.txt', data=b'second',
+        headers={'If-Match': etag})
+    assert res.status_code == 204
+    assert res.headers['ETag'] != etag
+    with open('put-conditional.txt') as f: assert f.read() == 'second'
+    
+    # The old ETag no longer matches once the file was replaced
+    assert put('/put-conditional.txt', data=b'third',
+        headers={'If-Match': etag}).status_code == 412
+    assert put('/put-missing.txt', data=b'content',
+        headers={'If-Match': '*'}).status_code == 412
+    assert not Path('put-missing.txt').exists()
+
+def test_put_raw_to_directory():
+    spawn_server()
+    
+    os.mkdir('put-existing-dir')
+    assert put('/put-existing-dir/', data=b'content').status_code == 400
+    assert put('/put-existing-dir', data=b'content').status_code == 409
+
+# Verify example curl command for raw uploads works
+def test_curl_put_example():
+    spawn_server()
+    
+    result = subprocess.run([
+            'curl', '-T', '../test-files/simple-example.txt',
+            f'{PROTOCOL.lower()}://localhost:8000/curl-put/',
+            '--insecure', '--fail',
+        ],
+        stdout=None if VERBOSE else subprocess.DEVNULL,
+        stderr=None if VERBOSE else subprocess.DEVNULL,
+    )
+    assert result.returncode == 0
+    
+    with open('curl-put/simple-example.txt') as f_actual:
+        with open('../test-files/simple-example.txt') as f_expected:
+            assert f_actual.read() == f_expected.read()
+
+##############################
+# Resumable Upload Tests     #
+##############################
+
+def test_resumable_upload():
+    spawn_server()
+    
+    res = post('/upload-sessions', headers={
+        'Upload-Length': '10',
+        'Upload-Path': '/resumable-dir/resumable%20file.txt',
+    })
+    assert res.status_code == 201
+    session = res.headers['Location']
+    
+    res = patch(session, headers={'Upload-Offset': '0'}, data=b'0123')
+    assert res.status_code == 204
+    assert res.headers['Upload-Offset'] == '4'
+    
+    res = head(session)
+    assert res.status_code == 200
+    assert res.headers['Upload-Offset'] == '4'
+    assert res.headers['Upload-Length'] == '10'
+    
+    # Offset must match what the server already has
+    res = patch(session, headers={'Upload-Offset': '0'}, data=b'0123')
+    assert res.status_code == 409
+    assert res.headers['Upload-Offset'] == '4'
+    
+    assert not Path('resumable-dir/resumable file.txt').exists()
+    
+    res = patch(session, headers={'Upload-Offset': '4'}, data=b'456789')
+    assert res.status_code == 201
+    assert res.headers['Location'] == '/resumable-dir/resumable%20file.txt'
+    
+    with open('resumable-dir/resumable file.txt') as f:
+        assert f.read() == '0123456789'
+    assert head(session).status_code == 404
+
+def test_resumable_upload_survives_restart():
+    shutil.rmtree('../test-spool', ignore_errors=True)
+    spawn_server(spool_dir='../test-spool')
+    
+    res = post('/upload-sessions', headers={
+        'Upload-Length': '6',
+        'Upload-Path': '/resumable-restart.txt',
+    })
+    session = res.headers['Location']
+    assert patch(session, headers={'Upload-Offset': '0'},
+        data=b'abc').status_code == 204
+    
+    server_holder[0].terminate()
+    server_holder[0].wait()
+    try:
+        spawn_server(spool_dir='../test-spool')
+        
+        assert head(session).headers['Upload-Offset'] == '3'
+        assert patch(session, headers={'Upload-Offset': '3'},
+            data=b'def').status_code == 201
+    finally:
+        server_holder[0].terminate()
+        server_holder[0].wait(10)
+        shutil.rmtree('../test-spool', ignore_errors=True)
+    
+    with open('resumable-restart.txt') as f: assert f.read() == 'abcdef'
+
+# Sessions that got no data for a day are removed at startup
+def test_resumable_upload_expires():
+    shutil.rmtree('../test-spool', ignore_errors=True)
+    spawn_server(spool_dir='../test-spool')
+    
+    try:
+        res = post('/upload-sessions', headers={
+            'Upload-Length': '6',
+            'Upload-Path': '/resumable-expired.txt',
+        })
+        session = res.headers['Location']
+        assert patch(session, headers={'Upload-Offset': '0'},
+            data=b'abc').status_code == 204
+        server_holder[0].terminate()
+        server_holder[0].wait(10)
+        for path in Path('../test-spool').glob('*.*'):
+            os.utime(path, (0, 0))
+        
+        spawn_server(spool_dir='../test-spool')
+        assert head(session).status_code == 404
+        assert list(Path('../test-spool').glob('*.*')) == []
+    finally:
+        server_holder[0].terminate()
+        server_holder[0].wait(10)
+        shutil.rmtree('../test-spool', ignore_errors=True)
+
+def test_resumable_upload_requires_auth():
+    spawn_server(basic_auth_upload=TEST_BASIC_AUTH)
+    
+    assert post('/upload-sessions', headers={
+        'Upload-Length': '1',
+        'Upload-Path': '/resumable-unauth.txt',
+    }).status_code == 401
+    
+    res = post('/upload-sessions', auth=TEST_BASIC_AUTH, headers={
+        'Upload-Length': '1',
+        'Upload-Path': '/resumable-unauth.txt',
+    })
+    assert res.status_code == 201
+    session = res.headers['Location']
+    
+    assert head(session).status_code == 401
+    assert patch(session, headers={'Upload-Offset': '0'},
+        data=b'a').status_code == 401
+    assert not Path('resumable-unauth.txt').exists()
+
+# Two PATCHes that both complete a session, as when a client retries the last
+# chunk. One moves the file into place, the other finds the session gone
+def test_resumable_upload_completed_twice():
+    # A spool on another filesystem makes finishing a copy, which takes long
+    # enough for the retry to get in
+    spool_dir = '/dev/shm/updownserver-test-spool'
+    if not os.path.isdir('/dev/shm') or \
+    os.stat('/dev/shm').st_dev == os.stat('.').st_dev:
+        spool_dir = '../test-spool'
+    shutil.rmtree(spool_dir, ignore_errors=True)
+    spawn_server(spool_dir=spool_dir)
+    
+    try:
+        file_content = os.urandom(32 << 20)
+        half = len(file_content) // 2
+        res = post('/upload-sessions', headers={
+            'Upload-Length': str(len(file_content)),
+            'Upload-Path': '/resumable-twice.bin',
+        })
+        session = res.headers['Location']
+        assert patch(session, headers={'Upload-Offset': '0'},
+            data=file_content[:half]).status_code == 204
+        
+        # The retry claims to complete the upload with no data. It is refused
+        # until the first PATCH has sent everything, and must not complete the
+        # session a second time once it has
+        def complete(offset: int) -> int:
+            for _ in range(5000):
+                conn = connect()
+                conn.request('PATCH', session, body=file_content[offset:],
+                    headers={'Upload-Offset': str(offset)})
+                status = conn.getresponse().status
+                conn.close()
+                if status != 409:
+                    return status
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            statuses = sorted(executor.map(complete,
+                [half, len(file_content)]))
+        
+        assert statuses == [201, 404]
+        with open('resumable-twice.bin', 'rb') as f:
+            assert f.read() == file_content
+        # Neither a second copy nor one abandoned in the spool
+        assert not Path('resumable-twice (1).bin').exists()
+        assert list(Path('.updownserver-spool').glob('uploads-*/*')) == []
+    finally:
+        server_holder[0].terminate()
+        server_holder[0].wait(10)
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+def test_parallel_upload_session():
+    spawn_server()
+    
+    res = post('/upload-sessions', headers={
+        'Upload-Length': '8',
+        'Upload-Path': '/parallel-file.txt',
+        'Upload-Mode': 'parallel',
+    })
+    assert res.status_code == 201
+    session = res.headers['Location']
+    
+    # Chunks can arrive out of order, and be sent again
+    for _ in range(2):
+        res = patch(session, headers={'Upload-Offset': '4'}, data=b'efgh')
+        assert res.status_code == 204
+        assert res.headers['Upload-Offset'] == '0'
+        assert res.headers['Upload-Ranges'] == '4-7'
+    
+    res = head(session)
+    assert res.headers['Upload-Mode'] == 'parallel'
+    assert res.headers['Upload-Ranges'] == '4-7'
+    assert not Path('parallel-file.txt').exists()
+    
+    res = patch(session, headers={'Upload-Offset': '0'}, data=b'abcd')
+    assert res.status_code == 201
+    
+    with open('parallel-file.txt') as f: assert f.read() == 'abcdefgh'
+
+def test_parallel_upload_concurrent_chunks():
+    spawn_server()
+    
+    chunk_size = 64*1024
+    file_content = os.urandom(16*chunk_size + 123)
+    res = post('/upload-sessions', headers={
+        'Upload-Length': str(len(file_content)),
+        'Upload-Path': '/parallel-concurrent.bin',
+        'Upload-Mode': 'parallel',
+    })
+    session = res.headers['Location']
+    
+    def send_chunk(offset):
+        return patch(session, headers={'Upload-Offset': str(offset)},
+            data=file_content[offset:offset + chunk_size]).status_code
+    
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        statuses = list(executor.map(send_chunk,
+            range(0, len(file_content), chunk_size)))
+    
+    assert statuses.count(201) == 1
+    assert statuses.count(204) == len(statuses) - 1
+    with open('parallel-concurrent.bin', 'rb') as f:
+        assert f.read() == file_content
+
+def test_spool_dir_not_allowed_in_root():
+    result = subprocess.run(
+        ['python', '-m', 'updownserver', '--spool-dir', 'spool'],
+        stdout=None if VERBOSE else subprocess.DEVNULL,
+        stderr=None if VERBOSE else subprocess.DEVNULL,
+    )
+    
+    assert result.returncode == 3
+
+# A spool directory others can get into could leak uploads and session IDs
+@pytest.mark.skipif(os.name != 'posix', reason='No mode bits to check')
+def test_spool_dir_must_be_private():
+    shutil.rmtree('../test-spool', ignore_errors=True)
+    os.mkdir('../test-spool', mode=0o755)
+    os.chmod('../test-spool', 0o755)
+    os.symlink('test-spool', '../test-spool-link')
+    
+    try:
+        for spool_dir in ('../test-spool', '../test-spool-link'):
+            result = subprocess.run(
+                ['python', '-m', 'updownserver', '--spool-dir', spool_dir],
+                stdout=None if VERBOSE else subprocess.DEVNULL,
+                stderr=None if VERBOSE else subprocess.DEVNULL,
+            )
+            assert result.returncode == 3
+    finally:
+        os.remove('../test-spool-link')
+        shutil.rmtree('../test-spool', ignore_errors=True)
+
+# An upload in progress is spooled in the spool directory, not the server root
+def test_upload_spool_outside_root():
+    shutil.rmtree('../test-spool', ignore_errors=True)
+    spawn_server(spool_dir='../test-spool')
+    
+    try:
+        connection = connect()
+        connection.putrequest('PUT', '/spooled-file')
+        connection.putheader('Content-Length', '10')
+        connection.endheaders()
+        connection.send(b'01234')
+        for _ in range(100):
+            if list(Path('../test-spool').glob('uploads-*/*')):
+                break
+            time.sleep(0.01)
+        assert len(list(Path('../test-spool').glob('uploads-*/*'))) == 1
+        assert next(Path('.').glob('tmp*'), None) is None
+        
+        connection.send(b'56789')
+        assert connection.getresponse().status == 201
+        connection.close()
+        with open('spooled-file', 'rb') as f: assert f.read() == b'0123456789'
+        assert list(Path('../test-spool').glob('uploads-*/*')) == []
+    finally:
+        server_holder[0].terminate()
+        server_holder[0].wait(10)
+        shutil.rmtree('../test-spool', ignore_errors=True)
+
+# Spools of servers that died are removed, those of running ones are left alone
+# however old their files
+def test_upload_spool_sweep():
+    shutil.rmtree('../test-spool', ignore_errors=True)
+    os.mkdir('../test-spool', mode=0o700)
+    dead_process = subprocess.Popen(['python', '-c', ''])
+    dead_process.wait()
+    dead_pid = dead_process.pid
+    host = socket.gethostname()
+    for pid in (dead_pid, os.getpid()):
+        spool = Path(f'../test-spool/uploads-{pid}@{host}-test')
+        spool.mkdir()
+        (spool / 'tmp-upload').write_bytes(b'data')
+        os.utime(spool / 'tmp-upload', (0, 0))
+    
+    try:
+        spawn_server(spool_dir='../test-spool')
+        assert os.listdir('../test-spool') == \
+            [f'uploads-{os.getpid()}@{host}-test']
+    finally:
+        server_holder[0].terminate()
+        server_holder[0].wait(10)
+        shutil.rmtree('../test-spool', ignore_errors=True)
+
+# With no spool directory on the server root's filesystem, uploads are spooled
+# in a hidden directory in the root that can't be reached over HTTP
+def test_upload_spool_other_filesystem():
+    spool_dir = '/dev/shm/updownserver-test-spool'
+    if not os.path.isdir('/dev/shm') or \
+    os.stat('/dev/shm').st_dev == os.stat('.').st_dev:
+        pytest.skip('No other filesystem to put the spool directory on')
+    
+    try:
+        spawn_server(spool_dir=spool_dir)
+        
+        assert post('/upload', files={
+            'files': ('spooled-form-file', b'form content'),
+        }).status_code == 204
+        assert put('/spooled-put-file', data=b'put content').status_code == 201
+        with open('spooled-form-file', 'rb') as f:
+            assert f.read() == b'form content'
+        with open('spooled-put-file', 'rb') as f:
+            assert f.read() == b'put content'
+        
+        assert list(Path('.updownserver-spool').glob('uploads-*/*')) == []
+        assert '.updownserver-spool' not in get('/').text
+        assert get('/.updownserver-spool/').status_code == 404
+        assert post('/mkdir', files={
+            'path': (None, '/.updownserver-spool'),
+            'foldername': (None, 'sub'),
+        }).status_code == 403
+    finally:
+        server_holder[0].terminate()
+        server_holder[0].wait(10)
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+####################
+# Keep-Alive Tests #
+####################
+
+# A directory listing followed by a file download, a raw upload and a delete,
+# all on one connection. The listing rewrites its own Content-Length, which
+# must not leak into later responses
+@pytest.mark.parametrize('cgi', [False, True])
+def test_keep_alive(cgi):
+    spawn_server(cgi=cgi, basic_auth=TEST_BASIC_AUTH)
+    
+    with open('keep-alive-file.txt', 'w') as f: f.write('keep-alive-content')
+    auth = {'Authorization': 'Basic Zm9vOmJhcg=='}
+    
+    connection = connect()
+    connection.request('GET', '/', headers=auth)
+    res = connection.getresponse()
+    assert res.status == 200
+    assert b'<!-- Injected by updownserver -->' in res.read()
+    sock = connection.sock
+    
+    connection.request('GET', '/keep-alive-file.txt', headers=auth)
+    res = connection.getresponse()
+    assert res.status == 200
+    assert res.read() == b'keep-alive-content'
+    
+    connection.request('PUT', '/keep-alive-put.txt', body=b'put-content',
+        headers=auth)
+    res = connection.getresponse()
+    assert res.status == 201
+    assert res.read() == b''
+    
+    connection.request('DELETE', '/keep-alive-file.txt', headers=auth)
+    res = connection.getresponse()
+    assert res.status == 204
+    assert res.read() == b''
+    
+    assert connection.sock is sock
+    assert not Path('keep-alive-file.txt').exists()
+    with open('keep-alive-put.txt') as f: assert f.read() == 'put-content'
+
+def test_keep_alive_max_requests():
+    spawn_server(max_requests=2)
+    
+    connection = connect()
+    for expected in [None, 'close']:
+        connection.request('GET', '/')
+        res = connection.getresponse()
+        res.read()
+        assert res.getheader('Connection') == expected
+
+def test_keep_alive_idle_timeout():
+    spawn_server(keep_alive_timeout=0.5)
+    
+    connection = connect()
+    connection.request('GET', '/')
+    connection.getresponse().read()
+    
+    time.sleep(1)
+    assert connection.sock.recv(1) == b''
+
+# The rejected upload's body is never read, so the server can't find where the
+# next request starts
+def test_keep_alive_unread_body():
+    spawn_server(basic_auth_upload=TEST_BASIC_AUTH)
+    
+    connection = connect()
+    connection.request('PUT', '/unread-body.txt', body=b'x' * 100)
+    res = connection.getresponse()
+    res.read()
+    assert res.status == 401
+    assert res.getheader('Connection') == 'close'
+
+################
+# Engine Tests #
+################
+
+def test_max_connections():
+    spawn_server(max_connections=2)
+    # Let the connection spawn_server() checked the server with close
+    time.sleep(0.5)
+    
+    idle = [connect() for _ in range(2)]
+    for connection in idle:
+        connection.request('GET', '/')
+        res = connection.getresponse()
+        assert res.status == 200
+        res.read()
+    
+    connection = connect()
+    connection.request('GET', '/')
+    res = connection.getresponse()
+    assert res.status == 503
+    assert res.getheader('Retry-After') == '5'
+    connection.close()
+    
+    idle[0].close()
+    time.sleep(0.5)
+    assert get('/').status_code == 200
+    idle[1].close()
+
+def test_max_uploads():
+    spawn_server(max_uploads=1)
+    
+    # Send only half of the body, so the upload stays in progress
+    slow = connect()
+    slow.putrequest('PUT', '/slow-upload.txt')
+    slow.putheader('Content-Length', '8')
+    slow.endheaders(b'slow')
+    time.sleep(0.5)
+    
+    res = put('/refused-upload.txt', data=b'content')
+    assert res.status_code == 503
+    assert res.headers['Retry-After'] == '5'
+    assert not Path('refused-upload.txt').exists()
+    
+    slow.send(b'-put')
+    assert slow.getresponse().status == 201
+    slow.close()
+    with open('slow-upload.txt') as f: assert f.read() == 'slow-put'
+    
+    assert put('/accepted-upload.txt', data=b'content').status_code == 201
+
+# With every thread taken, idle keep-alive connections give theirs up to
+# connections waiting for one
+def test_busy_keep_alive():
+    spawn_server(threads=1, keep_alive_timeout=30)
+    
+    idle = connect()
+    idle.request('GET', '/')
+    res = idle.getresponse()
+    assert res.status == 200
+    res.read()
+    
+    start = time.monotonic()
+    assert get('/').status_code == 200
+    assert time.monotonic() - start < 5
+    idle.close()
+
+if PROTOCOL == 'HTTPS':
+    # Clients that connect but never start the handshake only hold up
+    # themselves
+    def test_tls_handshake_stalled():
+        spawn_server()
+        
+        stalled = [socket.create_connection(('127.0.0.1', 8000))
+            for _ in range(3)]
+        start = time.monotonic()
+        assert get('/').status_code == 200
+        assert time.monotonic() - start < 5
+        for connection in stalled:
+            connection.close()
+
+if PROTOCOL == 'HTTPS':
+    def test_tls_session_resumption():
+        spawn_server()
+        
+        context = ssl._create_unverified_context()
+        session = None
+        for reused in [False, True, True]:
+            connection = context.wrap_socket(socket.create_connection(
+                ('127.0.0.1', 8000)), session=session)
+            connection.sendall(b'GET / HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+                b'Connection: close\r\n\r\n')
+            # With TLS 1.3 the session ticket arrives after the handshake
+            while connection.recv(65536):
+                pass
+            assert connection.session_reused == reused
+            session = connection.session
+            connection.close()
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='Requires os.fork()')
+def test_workers():
+    spawn_server(workers=3)
+    
+    # Each upload is likely to land in a different process, and every process
+    # sees the others' files
+    for i in range(6):
+        res = put(f'/worker-upload-{i}.txt', data=f'content-{i}')
+        assert res.status_code == 201
+    for i in range(6):
+        assert get(f'/worker-upload-{i}.txt').text == f'content-{i}'
+    
+    # Stopping the main process stops the workers, so the port is closed
+    server_holder[0].terminate()
+    server_holder[0].wait(10)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        get('/')
+
+def test_asyncio_engine():
+    spawn_server(engine='asyncio', basic_auth=TEST_BASIC_AUTH)
+    
+    with open('asyncio-file.txt', 'w') as f: f.write('asyncio-content')
+    
+    # Idle keep-alive connections don't hold up other requests
+    idle = [connect() for _ in range(100)]
+    for connection in idle:
+        connection.request('GET', '/asyncio-file.txt', headers={
+            'Authorization': 'Basic Zm9vOmJhcg=='})
+        assert connection.getresponse().read() == b'asyncio-content'
+    
+    res = post('/upload', auth=TEST_BASIC_AUTH, files={
+        'files': ('asyncio-upload.txt', 'uploaded-content')})
+    assert res.status_code == 204
+    with open('asyncio-upload.txt') as f: assert f.read() == 'uploaded-content'
+    
+    res = get('/asyncio-file.txt', auth=TEST_BASIC_AUTH,
+        headers={'Range': 'bytes=8-'})
+    assert res.status_code == 206
+    assert res.text == 'content'
+    
+    for connection in idle:
+        connection.close()
+
+# Requests sent back to back without waiting are answered in order
+def test_asyncio_engine_pipelining():
+    spawn_server(engine='asyncio')
+    
+    with open('pipelined-file.txt', 'w') as f: f.write('pipelined-content')
+    
+    connection = connect()
+    connection.connect()
+    connection.sock.sendall(b'PUT /pipelined-put.txt HTTP/1.1\r\n'
+        b'Host: 127.0.0.1\r\nContent-Length: 11\r\n\r\nput-content'
+        b'GET /pipelined-file.txt HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n')
+    
+    rfile = connection.sock.makefile('rb')
+    for status, body in [(b'201', b''), (b'200', b'pipelined-content')]:
+        assert rfile.readline().split()[1] == status
+        headers = http.client.parse_headers(rfile)
+        assert rfile.read(int(headers['Content-Length'])) == body
+    rfile.close()
+    connection.close()
+    
+    with open('pipelined-put.txt') as f: assert f.read() == 'put-content'
+
+def test_asyncio_engine_cgi():
+    res = subprocess.run([sys.executable, '-u', '-m', 'updownserver', '--cgi',
+        '--engine', 'asyncio'], capture_output=True, text=True, timeout=10)
+    assert res.returncode == 2
+    assert 'CGI is not supported by the asyncio engine' in res.stdout
+
+#################
+# Metrics Tests #
+#################
+
+def test_metrics():
+    spawn_server(metrics=True, basic_auth=TEST_BASIC_AUTH,
+        basic_auth_upload=TEST_BASIC_AUTH_2)
+    
+    with open('metrics-file.txt', 'w') as f: f.write('metrics-content')
+    assert get('/metrics-file.txt', auth=TEST_BASIC_AUTH).status_code == 200
+    assert get('/', auth=TEST_BASIC_AUTH).status_code == 200
+    assert put('/metrics-upload.txt', auth=TEST_BASIC_AUTH_2,
+        data=b'12345').status_code == 201
+    
+    # Protected like uploads
+    assert get('/metrics', auth=TEST_BASIC_AUTH).status_code == 401
+    res = get('/metrics', auth=TEST_BASIC_AUTH_2)
+    assert res.status_code == 200
+    assert res.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    
+    samples = {}
+    for line in res.text.splitlines():
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    
+    assert samples['updownserver_requests_total{code="200",route="file"}'] >= 1
+    assert samples['updownserver_requests_total{code="200",route="listing"}'] \
+        == 1
+    assert samples['updownserver_requests_total{code="201",route="put"}'] == 1
+    assert samples['updownserver_requests_total{code="401",route="metrics"}'] \
+        == 1
+    assert samples['updownserver_request_duration_seconds_count{route="put"}'] \
+        == 1
+    assert samples['updownserver_request_duration_seconds_bucket{route="put",'
+        'le="+Inf"}'] == 1
+    assert samples['updownserver_request_body_bytes_total{route="put"}'] == 5
+    assert samples['updownserver_response_bytes_total{route="file"}'] > 15
+    assert samples['updownserver_auth_failures_total{reason="Bad username"}'] \
+        == 1
+    assert samples['updownserver_uploads_in_progress'] == 0
+    assert 'updownserver_spool_bytes' in samples
+    assert samples['updownserver_tls_handshake_failures_total'] == 0
+    if PROTOCOL == 'HTTPS':
+        assert samples['updownserver_tls_handshakes_total{resumed="false"}'] \
+            >= 1
+
+def test_metrics_disabled():
+    spawn_server()
+    
+    res = get('/metrics')
+    assert res.status_code == 404
+    assert 'Server-Timing' not in res.headers
+
+def test_server_timing():
+    spawn_server(server_timing=True)
+    
+    res = put('/timed-dir/timed-put.txt', data=b'timed-content')
+    assert res.status_code == 201
+    phases = [phase.split(';')[0]
+        for phase in res.headers['Server-Timing'].split(', ')]
+    assert phases == ['resolve', 'mkdir', 'read', 'write', 'commit', 'total']
+    
+    res = post('/upload', files={'files': ('timed-upload.txt', 'content')})
+    assert res.status_code == 204
+    phases = dict(phase.split(';dur=')
+        for phase in res.headers['Server-Timing'].split(', '))
+    assert {'read', 'parse', 'resolve', 'mkdir', 'commit'} < set(phases)
+    assert all(float(duration) >= 0 for duration in phases.values())
+
+# Bodies larger than one buffer are written to disk by another thread, which
+# reports how long each side waited for the other
+@pytest.mark.parametrize('method', ['put', 'form'])
+def test_pipelined_upload(method):
+    spawn_server(server_timing=True, metrics=True)
+    
+    content = os.urandom(5*1024*1024 + 123)
+    if method == 'put':
+        res = put(f'/pipelined-{method}.bin', data=content)
+        assert res.status_code == 201
+    else:
+        res = post('/upload', files={
+            'files': (f'pipelined-{method}.bin', content),
+        })
+        assert res.status_code == 204
+    with open(f'pipelined-{method}.bin', 'rb') as f:
+        assert f.read() == content
+    
+    phases = dict(phase.split(';dur=')
+        for phase in res.headers['Server-Timing'].split(', '))
+    assert {'write', 'network-stall', 'disk-stall'} < set(phases)
+    metrics = get('/metrics').text
+    assert 'updownserver_upload_stall_seconds_total{side="network"}' in metrics
+    assert 'updownserver_upload_stall_seconds_total{side="disk"}' in metrics
+
+def test_profile_every():
+    spawn_server(profile_every=2, profile_dir='../test-profiles')
+    
+    try:
+        for _ in range(4):
+            assert get('/').status_code == 200
+        # The profile is written after the response
+        time.sleep(0.5)
+        profiles = sorted(os.listdir('../test-profiles'))
+        assert len(profiles) == 2
+        assert all(name.endswith('-listing.prof') for name in profiles)
+    finally:
+        shutil.rmtree('../test-profiles', ignore_errors=True)
+
+def test_access_log():
+    spawn_server(access_log='../test-access.log',
+        basic_auth_upload=TEST_BASIC_AUTH)
+    
+    try:
+        assert get('/').status_code == 200
+        res = put('/logged-upload.txt', auth=TEST_BASIC_AUTH, data=b'12345',
+            headers={'X-Request-ID': 'test-request-1'})
+        assert res.status_code == 201
+        assert res.headers['X-Request-ID'] == 'test-request-1'
+        
+        # Requests are logged once they are done, just after the response.
+        # Queued records are written out when the server stops
+        time.sleep(0.3)
+        server_holder[0].terminate()
+        server_holder[0].wait(10)
+        with open('../test-access.log') as f:
+            records = [json.loads(line) for line in f]
+    finally:
+        os.remove('../test-access.log')
+    
+    requests_logged = [record for record in records if 'method' in record]
+    assert [record['route'] for record in requests_logged][-2:] == \
+        ['listing', 'put']
+    listing, upload = requests_logged[-2:]
+    assert listing['status'] == 200
+    assert listing['bytes_out'] > 0
+    assert listing['user'] is None
+    assert upload['request_id'] == 'test-request-1'
+    assert upload['client'] == '127.0.0.1'
+    assert upload['status'] == 201
+    assert upload['bytes_in'] == 5
+    assert upload['user'] == 'foo'
+    assert upload['duration_ms'] >= 0
+    
+    messages = [record['message'] for record in records
+        if record.get('request_id') == 'test-request-1' and 'message' in record]
+    assert messages == ['[Uploaded] "/logged-upload.txt" --> ' +
+        str(Path('logged-upload.txt').resolve())]
+
+def test_access_log_rotation():
+    spawn_server(access_log='../test-rotated.log', access_log_max_bytes=1)
+    
+    try:
+        for _ in range(3):
+            assert get('/').status_code == 200
+            time.sleep(0.3)
+        assert os.path.exists('../test-rotated.log.1')
+        assert os.path.exists('../test-rotated.log.2')
+    finally:
+        server_holder[0].terminate()
+        server_holder[0].wait(10)
+        for name in os.listdir('..'):
+            if name.startswith('test-rotated.log'):
+                os.remove(os.path.join('..', name))
+
+def test_profile_dir_not_allowed_in_root():
+    result = subprocess.run([sys.executable, '-m', 'updownserver',
+        '--profile-every', '10', '--profile-dir', 'profiles'],
+        capture_output=True, text=True, timeout=10)
+    assert result.returncode == 3
+    assert 'inside web server root' in result.stdout
+
 #################
 # Mkdir Tests   #
 #################
@@ -661,6 +1867,22 @@ def test_delete_file():
     assert res.status_code == 204
     assert not Path('file-to-delete.txt').exists()
 
+def test_delete_if_match():
+    spawn_server(basic_auth=TEST_BASIC_AUTH)
+    
+    with open('conditional-delete.txt', 'w') as f: f.write('content')
+    etag = get('/conditional-delete.txt', auth=TEST_BASIC_AUTH).headers['ETag']
+    
+    res = requests.delete(f'{PROTOCOL.lower()}://127.0.0.1:8000/conditional-delete.txt',
+        verify=False, auth=TEST_BASIC_AUTH, headers={'If-Match': '"other"'})
+    assert res.status_code == 412
+    assert Path('conditional-delete.txt').exists()
+    
+    res = requests.delete(f'{PROTOCOL.lower()}://127.0.0.1:8000/conditional-delete.txt',
+        verify=False, auth=TEST_BASIC_AUTH, headers={'If-Match': etag})
+    assert res.status_code == 204
+    assert not Path('conditional-delete.txt').exists()
+
 def test_delete_empty_directory():
     spawn_server(basic_auth=TEST_BASIC_AUTH)
     
@@ -758,7 +1980,24 @@ def spawn_server(
     client_certificate: str = None,
     basic_auth: requests.auth.HTTPBasicAuth = None,
     basic_auth_upload: requests.auth.HTTPBasicAuth = None,
+    keep_alive_timeout: float = None,
+    max_requests: int = None,
+    threads: int = None,
+    max_connections: int = None,
+    max_uploads: int = None,
+    workers: int = None,
+    metrics: bool = False,
+    server_timing: bool = False,
+    profile_every: int = None,
+    profile_dir: str = None,
+    access_log: str = None,
+    access_log_max_bytes: int = None,
+    spool_dir: str = None,
+    engine: str = ENGINE,
 ):
+    if cgi and engine == 'asyncio':
+        pytest.skip('CGI is not supported by the asyncio engine')
+    
     args = [sys.executable, '-u', '-m', 'updownserver']
     if port: args += [str(port)]
     if cgi: args += ['--cgi']
@@ -773,6 +2012,25 @@ def spawn_server(
     if basic_auth_upload:
         args += ['--basic-auth-upload',
             f'{basic_auth_upload.username}:{basic_auth_upload.password}']
+    if keep_alive_timeout is not None:
+        args += ['--keep-alive-timeout', str(keep_alive_timeout)]
+    if max_requests is not None: args += ['--max-requests', str(max_requests)]
+    if threads is not None: args += ['--threads', str(threads)]
+    if max_connections is not None:
+        args += ['--max-connections', str(max_connections)]
+    if max_uploads is not None: args += ['--max-uploads', str(max_uploads)]
+    if workers is not None: args += ['--workers', str(workers)]
+    if metrics: args += ['--metrics']
+    if server_timing: args += ['--server-timing']
+    if profile_every is not None:
+        args += ['--profile-every', str(profile_every)]
+    if profile_dir: args += ['--profile-dir', profile_dir]
+    if access_log: args += ['--access-log', access_log,
+        '--access-log-flush', '0.1']
+    if access_log_max_bytes is not None:
+        args += ['--access-log-max-bytes', str(access_log_max_bytes)]
+    if spool_dir: args += ['--spool-dir', spool_dir]
+    if engine != 'threading': args += ['--engine', engine]
     
     server_holder[0] = subprocess.Popen(args)
     
@@ -800,3 +2058,18 @@ def post(path: str, port: int = 8000, *args, **kwargs) -> requests.Response:
 def put(path: str, port: int = 8000, *args, **kwargs) -> requests.Response:
     return requests.put(f'{PROTOCOL.lower()}://127.0.0.1:{port}{path}',
         verify=False, *args, **kwargs)
+
+def head(path: str, port: int = 8000, *args, **kwargs) -> requests.Response:
+    return requests.head(f'{PROTOCOL.lower()}://127.0.0.1:{port}{path}',
+        verify=False, *args, **kwargs)
+
+def patch(path: str, port: int = 8000, *args, **kwargs) -> requests.Response:
+    return requests.patch(f'{PROTOCOL.lower()}://127.0.0.1:{port}{path}',
+        verify=False, *args, **kwargs)
+
+# A raw connection, for checking what happens to it between requests
+def connect(port: int = 8000) -> http.client.HTTPConnection:
+    if PROTOCOL == 'HTTPS':
+        return http.client.HTTPSConnection('127.0.0.1', port,
+            context=ssl._create_unverified_context())
+    return http.client.HTTPConnection('127.0.0.1', port)
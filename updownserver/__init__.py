@@ -1,5 +1,12 @@
 import http.server, http, pathlib, sys, argparse, ssl, os, builtins, tempfile, threading, shutil
-import base64, binascii, functools, contextlib
+import base64, binascii, functools, contextlib, urllib.parse, json, re, secrets
+import errno, time, email.utils, datetime, select, io, html, collections, fnmatch, hashlib
+import queue, signal, traceback, cProfile, itertools, atexit, stat
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
 
 # Does not seem to do be used, but leaving this import out causes updownserver
 # to not receive IPv4 requests when started with default options under Windows
@@ -12,6 +19,8 @@ if sys.version_info.major == 3 and sys.version_info.minor < 13:
 else:
     import updownserver.cgi
 
+from updownserver import accesslog, aio, metrics, multipart, pipeline
+
 COLOR_SCHEME = {
     'light': 'light',
     'auto': 'light dark',
@@ -134,6 +143,29 @@ def get_directory_head_injection(theme: str) -> bytes:
     input[type="file"] {
         display: none;
     }
+    
+    /* Sorting, filtering and paging of large directories */
+    .listing-controls, .pager {
+        font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif;
+        margin: 10px 0;
+    }
+    
+    .listing-controls a, .pager a {
+        color: var(--accent-color);
+        text-decoration: none;
+        margin-right: 5px;
+    }
+    
+    .listing-controls input {
+        margin-left: 10px;
+        padding: 5px;
+        border-radius: 4px;
+        border: 1px solid #ccc;
+    }
+    
+    .pager span {
+        opacity: 0.5;
+    }
 </style>
 <!-- End injection by updownserver -->
 ''', 'utf-8')
@@ -305,48 +337,201 @@ DIRECTORY_BODY_INJECTION = b'''<!-- Injected by updownserver -->
         uploadFilesWithPaths(filesWithPaths);
     }
 
-    function uploadFilesWithPaths(filesWithPaths) {
-        const url = '/upload';
-        const formData = new FormData();
+    // Files at least this large are sent through a parallel upload session:
+    // the file is sliced into chunks and several chunks are in flight at once,
+    // so a high-latency link isn't limited to one TCP stream, and a failed
+    // chunk is retried on its own instead of restarting the whole file
+    const PARALLEL_THRESHOLD = 16 * 1024 * 1024;
+    const CHUNK_SIZE = 8 * 1024 * 1024;
+    const PARALLEL_CHUNKS = 4;
+    const CHUNK_RETRIES = 5;
 
+    async function uploadFilesWithPaths(filesWithPaths) {
         // Get current directory path from URL
         const currentPath = decodeURIComponent(window.location.pathname);
+        const small = filesWithPaths.filter(item => item.file.size < PARALLEL_THRESHOLD);
+        const large = filesWithPaths.filter(item => item.file.size >= PARALLEL_THRESHOLD);
+
+        const totalBytes = filesWithPaths.reduce((sum, item) => sum + item.file.size, 0);
+        let doneBytes = 0;
+        const showProgress = (loaded) => {
+            if (totalBytes > 0) {
+                const percentComplete = ((doneBytes + loaded) / totalBytes) * 100;
+                statusDiv.textContent = `Uploading: ${Math.round(percentComplete)}%`;
+            }
+        };
+
+        statusDiv.textContent = `Uploading ${filesWithPaths.length} file(s)...`;
+
+        try {
+            if (small.length > 0) {
+                for (let attempt = 0; ; attempt++) {
+                    try {
+                        await uploadForm(small, currentPath, showProgress);
+                        break;
+                    } catch (err) {
+                        if (err.status !== 503 || attempt >= CHUNK_RETRIES) {
+                            throw err;
+                        }
+                        statusDiv.textContent = 'Server busy, retrying...';
+                        await wait(err.retryAfter || 1);
+                    }
+                }
+                doneBytes += small.reduce((sum, item) => sum + item.file.size, 0);
+            }
+            for (const item of large) {
+                await uploadParallel(item, currentPath, showProgress);
+                doneBytes += item.file.size;
+            }
+        } catch (err) {
+            if (err.status === 401) {
+                statusDiv.textContent = 'Authentication required.';
+                location.href = '/upload';
+            } else {
+                statusDiv.textContent = err.message;
+            }
+            return;
+        }
+
+        statusDiv.textContent = 'Upload successful! Reloading...';
+        setTimeout(() => location.reload(), 1000);
+    }
+
+    function httpError(status, statusText, retryAfter) {
+        const err = new Error(`Error: ${status} ${statusText}`);
+        err.status = status;
+        // Seconds to wait before retrying, when the server is busy (503)
+        err.retryAfter = Number(retryAfter) || 0;
+        return err;
+    }
+
+    function wait(seconds) {
+        return new Promise(resolve => setTimeout(resolve, 1000 * seconds));
+    }
+
+    // All small files go in one multipart POST to /upload
+    function uploadForm(filesWithPaths, currentPath, onProgress) {
+        const formData = new FormData();
         formData.append('path', currentPath);
 
         for (const item of filesWithPaths) {
             formData.append('files', item.file);
             formData.append('filenames', item.path); // Send relative path
         }
+        const size = filesWithPaths.reduce((sum, item) => sum + item.file.size, 0);
 
-        statusDiv.textContent = `Uploading ${filesWithPaths.length} file(s)...`;
+        return new Promise((resolve, reject) => {
+            const xhr = new XMLHttpRequest();
+            xhr.open('POST', '/upload', true);
 
-        const xhr = new XMLHttpRequest();
-        xhr.open('POST', url, true);
+            xhr.upload.onprogress = function(e) {
+                if (e.lengthComputable) {
+                    onProgress(size * e.loaded / e.total);
+                }
+            };
 
-        xhr.upload.onprogress = function(e) {
-            if (e.lengthComputable) {
-                const percentComplete = (e.loaded / e.total) * 100;
-                statusDiv.textContent = `Uploading: ${Math.round(percentComplete)}%`;
-            }
-        };
+            xhr.onload = function() {
+                if (xhr.status === 204) {
+                    resolve();
+                } else {
+                    reject(httpError(xhr.status, xhr.statusText,
+                        xhr.getResponseHeader('Retry-After')));
+                }
+            };
 
-        xhr.onload = function() {
-            if (xhr.status === 204) {
-                statusDiv.textContent = 'Upload successful! Reloading...';
-                setTimeout(() => location.reload(), 1000);
-            } else if (xhr.status === 401) {
-                 statusDiv.textContent = 'Authentication required.';
-                 location.href = '/upload'; 
-            } else {
-                statusDiv.textContent = `Error: ${xhr.status} ${xhr.statusText}`;
+            xhr.onerror = function() {
+                reject(new Error('Upload failed due to connection error.'));
+            };
+
+            xhr.send(formData);
+        });
+    }
+
+    async function uploadParallel(item, currentPath, onProgress) {
+        const file = item.file;
+        const target = currentPath + (currentPath.endsWith('/') ? '' : '/') + item.path;
+
+        const response = await fetch('/upload-sessions', {
+            method: 'POST',
+            headers: {
+                'Upload-Length': String(file.size),
+                'Upload-Path': encodeURI(target),
+                'Upload-Mode': 'parallel',
+            },
+        });
+        if (response.status !== 201) {
+            throw httpError(response.status, response.statusText);
+        }
+        const session = response.headers.get('Location');
+
+        const chunkCount = Math.ceil(file.size / CHUNK_SIZE);
+        const loaded = new Array(chunkCount).fill(0);
+        let next = 0;
+        let failed = false;
+
+        const report = () => onProgress(loaded.reduce((sum, bytes) => sum + bytes, 0));
+
+        async function worker() {
+            while (next < chunkCount && !failed) {
+                const index = next++;
+                const start = index * CHUNK_SIZE;
+                const chunk = file.slice(start, Math.min(start + CHUNK_SIZE, file.size));
+
+                for (let attempt = 0; ; attempt++) {
+                    try {
+                        await sendChunk(session, start, chunk, bytes => {
+                            loaded[index] = bytes;
+                            report();
+                        });
+                        break;
+                    } catch (err) {
+                        loaded[index] = 0;
+                        if (failed || attempt >= CHUNK_RETRIES ||
+                            [401, 403, 404].includes(err.status)) {
+                            failed = true;
+                            throw err;
+                        }
+                        // Back off before retrying, e.g. while Wi-Fi reconnects
+                        await wait(err.retryAfter || 2 ** attempt);
+                    }
+                }
             }
-        };
+        }
 
-        xhr.onerror = function() {
-            statusDiv.textContent = 'Upload failed due to connection error.';
-        };
+        const workers = [];
+        for (let i = 0; i < Math.min(PARALLEL_CHUNKS, chunkCount); i++) {
+            workers.push(worker());
+        }
+        await Promise.all(workers);
+    }
+
+    function sendChunk(session, offset, chunk, onProgress) {
+        return new Promise((resolve, reject) => {
+            const xhr = new XMLHttpRequest();
+            xhr.open('PATCH', session, true);
+            xhr.setRequestHeader('Upload-Offset', String(offset));
+
+            xhr.upload.onprogress = function(e) {
+                onProgress(e.loaded);
+            };
+
+            xhr.onload = function() {
+                // 201 means this chunk completed the file
+                if (xhr.status === 204 || xhr.status === 201) {
+                    onProgress(chunk.size);
+                    resolve();
+                } else {
+                    reject(httpError(xhr.status, xhr.statusText,
+                        xhr.getResponseHeader('Retry-After')));
+                }
+            };
+
+            xhr.onerror = function() {
+                reject(new Error('Upload failed due to connection error.'));
+            };
 
-        xhr.send(formData);
+            xhr.send(chunk);
+        });
     }
 
     // --- New Feature: Create Folder ---
@@ -384,6 +569,9 @@ DIRECTORY_BODY_INJECTION = b'''<!-- Injected by updownserver -->
         const list = document.querySelector('ul');
         if (!list) return;
 
+        // href -> span that shows the entry's size and date
+        const infoSpans = {};
+        
         const items = list.querySelectorAll('li');
         items.forEach(li => {
             const link = li.querySelector('a');
@@ -400,26 +588,7 @@ DIRECTORY_BODY_INJECTION = b'''<!-- Injected by updownserver -->
             infoSpan.style.fontSize = '0.85em';
             infoSpan.textContent = '';
             li.appendChild(infoSpan);
-
-            // Fetch file info using HEAD request
-            fetch(name, { method: 'HEAD' })
-                .then(response => {
-                    const size = response.headers.get('Content-Length');
-                    const modified = response.headers.get('Last-Modified');
-                    let info = [];
-                    
-                    if (size && !name.endsWith('/')) {
-                        info.push(formatFileSize(parseInt(size)));
-                    }
-                    if (modified) {
-                        info.push(formatDate(modified));
-                    }
-                    
-                    if (info.length > 0) {
-                        infoSpan.textContent = '(' + info.join(', ') + ')';
-                    }
-                })
-                .catch(() => {});
+            infoSpans[name] = infoSpan;
 
             // Add delete button if auth enabled
             if (typeof ENABLE_DELETE !== 'undefined' && ENABLE_DELETE) {
@@ -440,6 +609,29 @@ DIRECTORY_BODY_INJECTION = b'''<!-- Injected by updownserver -->
                 li.appendChild(delBtn);
             }
         });
+        
+        // Sizes and dates of all entries on this page in one request
+        const params = new URLSearchParams(location.search);
+        params.set('format', 'json');
+        fetch('?' + params.toString())
+            .then(response => response.json())
+            .then(listing => {
+                listing.entries.forEach(entry => {
+                    const infoSpan = infoSpans[entry.href];
+                    if (!infoSpan) return;
+                    
+                    let info = [];
+                    if (entry.size !== null) {
+                        info.push(formatFileSize(entry.size));
+                    }
+                    if (entry.mtime !== null) {
+                        info.push(formatDate(entry.mtime * 1000));
+                    }
+                    if (info.length === 0) return;
+                    infoSpan.textContent = '(' + info.join(', ') + ')';
+                });
+            })
+            .catch(() => {});
     });
 
     function formatFileSize(bytes) {
@@ -450,6 +642,7 @@ DIRECTORY_BODY_INJECTION = b'''<!-- Injected by updownserver -->
         return parseFloat((bytes / Math.pow(k, i)).toFixed(1)) + ' ' + sizes[i];
     }
 
+    // Takes anything Date() accepts, e.g. milliseconds since the epoch
     function formatDate(dateStr) {
         try {
             const date = new Date(dateStr);
@@ -484,17 +677,309 @@ DIRECTORY_BODY_INJECTION = b'''<!-- Injected by updownserver -->
 
 
 
+# Uploads are written to a temp file in a spool directory and renamed into
+# place once complete. A rename only works within one filesystem, so each one
+# gets its own spool, in the first --spool-dir on that filesystem or failing
+# that in a hidden UPLOAD_SPOOL_NAME directory at the top of that filesystem
+# within the server root, which is never listed, served or written to over
+# HTTP. Every process has spools of its own, named after it, so servers
+# sharing a spool directory never touch each other's uploads
+UPLOAD_SPOOL_NAME = '.updownserver-spool'
+UPLOAD_SPOOL_PATTERN = re.compile(r'uploads-(\d+)@(.+)-[a-z0-9_]+')
+# Spooled files not written to for this long, and no longer used by a request,
+# were left behind by an error and are removed by sweep_upload_spools()
+UPLOAD_SPOOL_MAX_IDLE = 3600
+UPLOAD_SPOOL_SWEEP_INTERVAL = 600
+
+# Device number -> this process's upload spool directory on that device
+upload_spools = {}
+upload_spools_lock = threading.Lock()
+# Spooled files of this process's requests in progress, which the sweeper
+# leaves alone however long ago they were written to
+spool_files_in_use = set()
+# Spooled files of the request the current thread is handling
+request_spool_files = threading.local()
+
+# A forked worker makes spools of its own
+def forget_upload_spools():
+    upload_spools.clear()
+    spool_files_in_use.clear()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=forget_upload_spools)
+
+# True argument type for directory is str | pathlib.Path, but Python 3.9
+# doesn't support |
+def get_upload_spool(directory: pathlib.Path) -> pathlib.Path:
+    device = os.stat(directory).st_dev
+    with upload_spools_lock:
+        spool = upload_spools.get(device)
+    if spool is not None and spool.is_dir():
+        return spool
+    
+    for spool_dir in get_spool_dirs():
+        with contextlib.suppress(OSError):
+            spool_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+            if os.stat(spool_dir).st_dev == device:
+                parent = spool_dir
+                break
+    else:
+        server_root = pathlib.Path(args.directory).resolve()
+        parent = pathlib.Path(directory).resolve()
+        while server_root in parent.parents and \
+        os.stat(parent.parent).st_dev == device:
+            parent = parent.parent
+        parent /= UPLOAD_SPOOL_NAME
+        parent.mkdir(mode=0o700, exist_ok=True)
+        problem = check_spool_dir(parent)
+        if problem:
+            raise PermissionError(f'Spool directory "{parent}" {problem}')
+    spool = pathlib.Path(tempfile.mkdtemp(
+        prefix=f'uploads-{os.getpid()}@{socket.gethostname()}-', dir=parent))
+    
+    with upload_spools_lock:
+        upload_spools[device] = spool
+    return spool
+
+# True argument type for path is str | pathlib.Path, but Python 3.9 doesn't
+# support |
+def is_upload_spool_path(path: pathlib.Path) -> bool:
+    relative = os.path.relpath(path, args.directory)
+    return UPLOAD_SPOOL_NAME in pathlib.PurePath(relative).parts
+
+# Directories that may hold other processes' upload spools
+def get_upload_spool_parents() -> list:
+    return [*get_spool_dirs(),
+        pathlib.Path(args.directory).resolve() / UPLOAD_SPOOL_NAME]
+
+# A temp file in the upload spool for `directory`'s filesystem, in use until
+# the request that made it is done. True argument type for directory is str |
+# pathlib.Path, but Python 3.9 doesn't support |
+def make_spool_file(directory: pathlib.Path, **kwargs) -> object:
+    f = tempfile.NamedTemporaryFile(dir=get_upload_spool(directory),
+        delete=False, **kwargs)
+    with upload_spools_lock:
+        spool_files_in_use.add(f.name)
+    names = getattr(request_spool_files, 'names', None)
+    if names is not None:
+        names.append(f.name)
+    return f
+
+# Marks the files spooled by the request handled within as no longer in use
+# once it's done. Those still there by then were left behind by an error
+@contextlib.contextmanager
+def track_spool_files():
+    request_spool_files.names = []
+    try:
+        yield
+    finally:
+        with upload_spools_lock:
+            spool_files_in_use.difference_update(request_spool_files.names)
+        request_spool_files.names = None
+
+# Remove this process's spooled files that no request is using and that
+# haven't been written to for UPLOAD_SPOOL_MAX_IDLE. Returns how many were
+# removed
+def sweep_upload_spools() -> int:
+    removed = 0
+    cutoff = time.time() - UPLOAD_SPOOL_MAX_IDLE
+    with upload_spools_lock:
+        spools = list(upload_spools.values())
+    for spool in spools:
+        with contextlib.suppress(OSError), os.scandir(spool) as entries:
+            for entry in entries:
+                with upload_spools_lock:
+                    if entry.path in spool_files_in_use:
+                        continue
+                with contextlib.suppress(OSError):
+                    if entry.is_file(follow_symlinks=False) and \
+                    entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+    return removed
+
+# Only processes on this host can be checked, and only where os.kill() can
+# probe a process without killing it
+def is_process_gone(pid: int, host: str) -> bool:
+    if os.name != 'posix' or host != socket.gethostname():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass
+    return False
+
+# Remove the upload spools of processes that died without removing them.
+# Returns how many files they held
+def remove_stale_upload_spools() -> int:
+    removed = 0
+    for parent in get_upload_spool_parents():
+        with contextlib.suppress(OSError), os.scandir(parent) as entries:
+            for entry in entries:
+                match = UPLOAD_SPOOL_PATTERN.fullmatch(entry.name)
+                if not match or not entry.is_dir(follow_symlinks=False) or \
+                not is_process_gone(int(match[1]), match[2]):
+                    continue
+                with contextlib.suppress(OSError):
+                    removed += len(os.listdir(entry.path))
+                shutil.rmtree(entry.path, ignore_errors=True)
+    return removed
+
+# Remove the spools this process made, on the way out
+def remove_spools():
+    with upload_spools_lock:
+        spools = list(upload_spools.values())
+        upload_spools.clear()
+    for spool in spools:
+        shutil.rmtree(spool, ignore_errors=True)
+    if default_spool_dir is not None and \
+    default_spool_dir_owner == os.getpid():
+        shutil.rmtree(default_spool_dir, ignore_errors=True)
+atexit.register(remove_spools)
+
+def clean_spools() -> int:
+    return sweep_upload_spools() + remove_stale_upload_spools() + \
+        sweep_upload_sessions()
+
+def run_spool_sweeper():
+    while True:
+        time.sleep(UPLOAD_SPOOL_SWEEP_INTERVAL)
+        removed = clean_spools()
+        if removed:
+            print(f'[Spool] Removed {removed} abandoned upload(s)')
+
+# True argument type for directory is str | pathlib.Path | None, but Python 3.9
+# doesn't support |
+def make_upload_file(directory: pathlib.Path = None) -> object:
+    return make_spool_file(directory or args.directory, mode='wb+')
+
+# Linux ioctl that makes a file share another one's data (a reflink), on
+# filesystems that support it such as Btrfs and XFS
+FICLONE = 0x40049409
+# Largest single copy_file_range() or sendfile() call
+COPY_CHUNK_SIZE = 1 << 30
+# Errors that mean a copy method doesn't work for these two files
+COPY_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP,
+    errno.EINVAL)
+
+# Copy a whole file into an empty one without passing the data through
+# Python where possible: a reflink, then copy_file_range() and sendfile() in
+# the kernel, and a read/write loop only when none of those work
+def copy_file_data(source: object, target: object):
+    source_fd = source.fileno()
+    target_fd = target.fileno()
+    if fcntl and sys.platform.startswith('linux'):
+        with contextlib.suppress(OSError):
+            fcntl.ioctl(target_fd, FICLONE, source_fd)
+            return
+    
+    size = os.fstat(source_fd).st_size
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size:
+                count = os.copy_file_range(source_fd, target_fd,
+                    min(size - copied, COPY_CHUNK_SIZE), copied, copied)
+                if not count:
+                    break
+                copied += count
+            return
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRORS:
+                raise
+    
+    # Only Linux can sendfile() to a regular file
+    if sys.platform.startswith('linux'):
+        try:
+            os.lseek(target_fd, copied, os.SEEK_SET)
+            while copied < size:
+                count = os.sendfile(target_fd, source_fd, copied,
+                    min(size - copied, COPY_CHUNK_SIZE))
+                if not count:
+                    break
+                copied += count
+            return
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRORS:
+                raise
+    
+    source.seek(copied)
+    target.seek(copied)
+    shutil.copyfileobj(source, target, BODY_CHUNK_SIZE)
+
+# Returns `source` if it's on the same filesystem as `directory`, so it can be
+# renamed into it. Otherwise copies it to that filesystem's upload spool,
+# removes it and returns the copy
+def move_to_device(source: str, directory: pathlib.Path) -> str:
+    if os.stat(source).st_dev == os.stat(directory).st_dev:
+        return source
+    
+    with open(source, 'rb') as f, make_spool_file(directory) as target:
+        try:
+            copy_file_data(f, target)
+        except BaseException:
+            target.close()
+            os.remove(target.name)
+            raise
+    os.remove(source)
+    return target.name
+
 class PersistentFieldStorage(cgi.FieldStorage):
     # Override cgi.FieldStorage.make_file() method. Valid for Python 3.1 ~ 3.10.
     # Modified version of the original .make_file() method (base copied from
     # Python 3.10)
     def make_file(self) -> object:
         if self._binary_file:
-            return tempfile.NamedTemporaryFile(mode = 'wb+',
-                dir = args.directory, delete = False)
+            return make_upload_file()
         else:
-            return tempfile.NamedTemporaryFile("w+", dir = args.directory,
-                delete = False, encoding = self.encoding, newline = '\n')
+            return make_spool_file(args.directory, mode = 'w+',
+                encoding = self.encoding, newline = '\n')
+    
+    # Uploads are moved out of their temp files by receive_upload(), so there
+    # is nothing to clean up here. Provided to match multipart.MultipartForm
+    def cleanup(self):
+        pass
+
+# Returns the boundary and length of a multipart body with a known length,
+# which the streaming parser in multipart.py can read. True return type is
+# tuple[bytes, int] | None, but Python 3.9 doesn't support |
+def get_multipart_body(handler: http.server.BaseHTTPRequestHandler) -> tuple:
+    content_type, params = cgi.parse_header(
+        handler.headers.get('Content-Type', ''))
+    content_length = handler.headers.get('Content-Length')
+    if content_type != 'multipart/form-data' or 'boundary' not in params or \
+    content_length is None:
+        return None
+    
+    try:
+        content_length = int(content_length)
+    except ValueError:
+        raise multipart.MultipartError('Invalid Content-Length')
+    return (params['boundary'].encode('utf-8', 'replace'), content_length)
+
+# Multipart bodies with a known length go through the streaming parser in
+# multipart.py. Anything else (url-encoded forms, bodies without
+# Content-Length) falls back to the vendored cgi.FieldStorage
+def parse_form(handler: http.server.BaseHTTPRequestHandler) -> object:
+    body = get_multipart_body(handler)
+    
+    # Parsing time is whatever wasn't spent waiting for the client
+    start = time.perf_counter()
+    reader = get_body_reader(handler)
+    
+    if body:
+        form = multipart.parse_form(reader, *body,
+            lambda part: make_upload_file())
+    else:
+        form = PersistentFieldStorage(fp=reader,
+            headers=handler.headers, environ={'REQUEST_METHOD': 'POST'})
+    
+    handler.body_consumed = True
+    if handler.timings:
+        handler.timings.add('parse', time.perf_counter() - start -
+            reader.seconds)
+    return form
 
 # True argument/return type is str | pathlib.Path, but Python 3.9 doesn't
 # support |
@@ -508,13 +993,345 @@ def auto_rename(path: pathlib.Path) -> pathlib.Path:
             return renamed_path
     raise FileExistsError(f'File {path} already exists.')
 
+# Resolve a path given relative to the server root. Returns None if the result
+# (after following symlinks) is outside the server root
+def resolve_in_root(relative_path: str) -> pathlib.Path:
+    server_root = pathlib.Path(args.directory).resolve()
+    path = (server_root / relative_path.lstrip('/\\')).resolve()
+    if server_root not in path.parents and server_root != path:
+        return None
+    if is_upload_spool_path(path):
+        return None
+    return path
+
+# Held while checking a write's preconditions and committing it, so two
+# conditional writes to one file can't both pass their checks, and a commit
+# can't replace a file another one just created. Copies to the destination's
+# filesystem are made before taking it. With --workers, a lock file in the
+# spool directory covers writes in the other processes too
+class CommitLock:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file = None
+    
+    def __enter__(self):
+        self._lock.acquire()
+        if fcntl is None or getattr(args, 'workers', 1) <= 1:
+            return
+        try:
+            spool_dir = get_spool_dir()
+            spool_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+            self._file = open(spool_dir / 'commit.lock', 'a')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        except BaseException:
+            if self._file:
+                self._file.close()
+                self._file = None
+            self._lock.release()
+            raise
+    
+    def __exit__(self, *exc_info):
+        if self._file:
+            # Closing releases the flock()
+            self._file.close()
+            self._file = None
+        self._lock.release()
+
+commit_lock = CommitLock()
+
+# Move a finished upload into place. An existing file is replaced if
+# --allow-replace was given, otherwise the upload is renamed. Returns the final
+# destination and whether it was renamed
+def commit_upload(source: str, destination: pathlib.Path,
+) -> tuple[pathlib.Path, bool]:
+    if os.path.exists(destination):
+        if args.allow_replace and os.path.isfile(destination):
+            os.replace(source, destination)
+            return (destination, False)
+        destination = pathlib.Path(auto_rename(destination))
+        os.rename(source, destination)
+        return (destination, True)
+    os.rename(source, destination)
+    return (destination, False)
+
+active_uploads = 0
+active_uploads_lock = threading.Lock()
+
+# For receive_*() functions that read an upload body. Past --max-uploads at a
+# time, uploads are refused with 503 before their body is read, so a burst of
+# uploads can't take every thread and fill the disk with temp files
+def limit_uploads(receive):
+    @functools.wraps(receive)
+    def limited_receive(handler: http.server.BaseHTTPRequestHandler,
+    *arguments) -> tuple:
+        global active_uploads
+        with active_uploads_lock:
+            if active_uploads >= args.max_uploads:
+                return (http.HTTPStatus.SERVICE_UNAVAILABLE,
+                    'Too many uploads in progress',
+                    {'Retry-After': str(RETRY_AFTER)})
+            active_uploads += 1
+        try:
+            return receive(handler, *arguments)
+        finally:
+            with active_uploads_lock:
+                active_uploads -= 1
+    return limited_receive
+
+@limit_uploads
 def receive_upload(handler: http.server.BaseHTTPRequestHandler,
 ) -> tuple[http.HTTPStatus, str]:
+    try:
+        body = get_multipart_body(handler)
+        if body:
+            return receive_upload_stream(handler, *body)
+        form = parse_form(handler)
+    except multipart.MultipartError as e:
+        return (http.HTTPStatus.BAD_REQUEST, f'Malformed upload: {e}')
+    
+    try:
+        return receive_upload_form(handler, form)
+    finally:
+        # Removes temp files of any parts that were not moved into place
+        form.cleanup()
+
+# Where an uploaded file goes, relative to the upload's target directory: its
+# "filenames" entry (a path within a dropped folder) if it has a usable one,
+# otherwise its own name
+def get_upload_relative_path(filename: str, custom_path: str) -> str:
+    if custom_path:
+        # Sanitize: remove leading slashes and normalize
+        relative_path = os.path.normpath(custom_path.lstrip('/\\'))
+        # Security: prevent directory traversal
+        if not relative_path.startswith('..') and \
+        not os.path.isabs(relative_path):
+            return relative_path
+    return pathlib.Path(filename).name
+
+# Resolve an uploaded file's destination and create its parent directories.
+# Returns None if it would be outside the server root
+def prepare_upload_destination(handler: http.server.BaseHTTPRequestHandler,
+target_dir: pathlib.Path, relative_path: str) -> pathlib.Path:
+    server_root = pathlib.Path(args.directory).resolve()
+    # Security check: ensure destination is still within server root
+    with timed(handler, 'resolve'):
+        destination = resolve_in_root(
+            str(target_dir.relative_to(server_root) / relative_path))
+    if destination is None or destination == server_root:
+        handler.log_message('[Upload Rejected] Path traversal attempt: %s',
+            relative_path)
+        return None
+    
+    # Create parent directories if needed (for folder uploads)
+    with timed(handler, 'mkdir'):
+        destination.parent.mkdir(parents=True, exist_ok=True)
+    return destination
+
+# A multipart upload, moved into place part by part while the body streams in.
+# Each file part is spooled to a temp file and committed as soon as its
+# destination is known, which takes the "path" field and the file's
+# "filenames" entry. Entries are matched to file parts in order. The upload
+# page sends path first and each file's entry right after the file, so only
+# one part is spooled at a time however many files a folder drop has. Forms
+# in other orders keep their parts spooled until the fields they wait for
+# arrive, or until the form ends
+class UploadStream:
+    def __init__(self, handler: http.server.BaseHTTPRequestHandler):
+        self.handler = handler
+        # None until the "path" field arrives. True type is pathlib.Path |
+        # None, but Python 3.9 doesn't support |
+        self.target_dir = None
+        # Files waiting to be committed, in order, as [filename, temp file
+        # name, "filenames" entry]. Temp file name is None for a file input
+        # that had nothing selected. The last `unnamed` of them haven't got
+        # their "filenames" entry yet
+        self.pending = collections.deque()
+        self.unnamed = 0
+        # "filenames" entries that arrived before their file
+        self.names = collections.deque()
+        
+        self.files = 0
+        self.empty = 0
+        self.committed = 0
+        self.name_conflict = False
+        # Set when the upload is refused. The rest of the body is still read,
+        # so the connection stays usable
+        self.error = None
+        # Time spent resolving paths and committing files, which isn't parsing
+        self.commit_seconds = 0.0
+        # Shared by every file of the upload, so one writer thread serves them
+        # all. Closed by cleanup()
+        self.writer = make_upload_writer()
+    
+    def receive_path(self, upload_path: str):
+        if self.target_dir is not None or self.error:
+            return
+        
+        start = time.perf_counter()
+        # Remove leading slash and sanitize
+        upload_path = upload_path.lstrip('/')
+        # Build target directory, validate it's within the served directory
+        with timed(self.handler, 'resolve'):
+            target_dir = resolve_in_root(upload_path)
+            if target_dir is None:
+                self.error = (http.HTTPStatus.FORBIDDEN, 'Invalid upload path')
+            elif not target_dir.is_dir():
+                self.error = (http.HTTPStatus.BAD_REQUEST,
+                    'Target directory does not exist')
+            else:
+                self.target_dir = target_dir
+        self.commit_seconds += time.perf_counter() - start
+        self.commit_ready()
+    
+    def receive_name(self, custom_path: str):
+        if self.error:
+            return
+        if self.unnamed:
+            self.pending[-self.unnamed][2] = custom_path
+            self.unnamed -= 1
+        else:
+            self.names.append(custom_path)
+        self.commit_ready()
+    
+    # True argument type for part is multipart.Part | None, but Python 3.9
+    # doesn't support |. None stands for a file input with nothing selected
+    def receive_file(self, part: multipart.Part):
+        self.files += 1
+        if self.error:
+            return
+        if part is None or not part.filename:
+            self.empty += 1
+            entry = [None, None, None]
+        else:
+            # Spooled for the target directory's filesystem once it is known
+            file = make_upload_file(self.target_dir)
+            try:
+                try:
+                    part.write_to(functools.partial(self.writer.write, file))
+                finally:
+                    # The writer thread may still be writing to the file
+                    try:
+                        self.writer.flush()
+                    finally:
+                        file.close()
+            except BaseException:
+                os.remove(file.name)
+                raise
+            entry = [part.filename, file.name, None]
+        
+        if self.names:
+            entry[2] = self.names.popleft()
+        else:
+            self.unnamed += 1
+        self.pending.append(entry)
+        self.commit_ready()
+    
+    # Commit the files at the front of the queue that have everything they
+    # need. At the end of the form nothing more can arrive, so files without a
+    # "filenames" entry use their own name, and without a "path" field files
+    # go to the server root
+    def commit_ready(self, finished: bool = False):
+        if finished and self.target_dir is None:
+            self.receive_path('/')
+        if self.target_dir is None or self.error:
+            return
+        
+        start = time.perf_counter()
+        while len(self.pending) > (0 if finished else self.unnamed):
+            self.commit(*self.pending.popleft())
+        if finished:
+            self.unnamed = 0
+        self.commit_seconds += time.perf_counter() - start
+    
+    def commit(self, filename: str, temp_name: str, custom_path: str):
+        if temp_name is None:
+            return
+        try:
+            relative_path = get_upload_relative_path(filename, custom_path)
+            destination = prepare_upload_destination(self.handler,
+                self.target_dir, relative_path)
+            if destination is None:
+                os.remove(temp_name)
+                return
+            
+            with timed(self.handler, 'commit'):
+                # Spooled before the target directory was known, or the
+                # destination is a mount point below it
+                source = move_to_device(temp_name, destination.parent)
+                with commit_lock:
+                    destination, renamed = commit_upload(source, destination)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temp_name)
+            raise
+        self.committed += 1
+        self.name_conflict = self.name_conflict or renamed
+        self.handler.log_message('[Uploaded] "%s" --> %s', relative_path,
+            destination)
+    
+    # Stop the writer and remove temp files of parts that were not moved into
+    # place
+    def cleanup(self):
+        try:
+            self.writer.close()
+        finally:
+            record_upload_writer(self.handler, self.writer)
+        
+        for _, temp_name, _ in self.pending:
+            if temp_name is not None:
+                with contextlib.suppress(OSError):
+                    os.remove(temp_name)
+        self.pending.clear()
+    
+    def result(self) -> tuple[http.HTTPStatus, str]:
+        if self.error:
+            return self.error
+        if not self.files:
+            return (http.HTTPStatus.BAD_REQUEST, 'Field "files" not found')
+        if self.committed:
+            return (http.HTTPStatus.NO_CONTENT, 'Some filename(s) changed '
+                'due to name conflict' if self.name_conflict else
+                'Files accepted')
+        if self.empty:
+            return (http.HTTPStatus.BAD_REQUEST, 'No files selected')
+        return (http.HTTPStatus.INTERNAL_SERVER_ERROR, 'Server error')
+
+def receive_upload_stream(handler: http.server.BaseHTTPRequestHandler,
+boundary: bytes, length: int) -> tuple[http.HTTPStatus, str]:
+    upload = UploadStream(handler)
+    
+    # Parsing time is whatever wasn't spent waiting for the client or moving
+    # files into place
+    start = time.perf_counter()
+    reader = get_body_reader(handler)
+    try:
+        for part in multipart.MultipartParser(reader, boundary, length):
+            if part.name == 'files':
+                upload.receive_file(part if part.filename is not None
+                    else None)
+            elif part.name in ('path', 'filenames') and part.filename is None:
+                value = part.read().decode('utf-8', 'replace')
+                if part.name == 'path':
+                    upload.receive_path(value)
+                else:
+                    upload.receive_name(value)
+        upload.commit_ready(finished=True)
+    finally:
+        upload.cleanup()
+    
+    handler.body_consumed = True
+    if handler.timings:
+        handler.timings.add('parse', time.perf_counter() - start -
+            reader.seconds - upload.commit_seconds)
+    return upload.result()
+
+# Uploads that don't stream through UploadStream (url-encoded forms, bodies
+# without Content-Length) are parsed whole by cgi.FieldStorage, then committed
+def receive_upload_form(handler: http.server.BaseHTTPRequestHandler,
+form: object) -> tuple[http.HTTPStatus, str]:
     result = (http.HTTPStatus.INTERNAL_SERVER_ERROR, 'Server error')
     name_conflict = False
     
-    form = PersistentFieldStorage(fp=handler.rfile, headers=handler.headers,
-        environ={'REQUEST_METHOD': 'POST'})
     if 'files' not in form:
         return (http.HTTPStatus.BAD_REQUEST, 'Field "files" not found')
     
@@ -523,16 +1340,14 @@ def receive_upload(handler: http.server.BaseHTTPRequestHandler,
     # Remove leading slash and sanitize
     upload_path = upload_path.lstrip('/')
     # Build target directory, validate it's within the served directory
-    target_dir = pathlib.Path(args.directory) / upload_path
-    target_dir = target_dir.resolve()
-    server_root = pathlib.Path(args.directory).resolve()
-    
-    # Security check: ensure target is within server root
-    if server_root not in target_dir.parents and server_root != target_dir:
-        return (http.HTTPStatus.FORBIDDEN, 'Invalid upload path')
-    
-    if not target_dir.is_dir():
-        return (http.HTTPStatus.BAD_REQUEST, 'Target directory does not exist')
+    with timed(handler, 'resolve'):
+        target_dir = resolve_in_root(upload_path)
+        if target_dir is None:
+            return (http.HTTPStatus.FORBIDDEN, 'Invalid upload path')
+        
+        if not target_dir.is_dir():
+            return (http.HTTPStatus.BAD_REQUEST,
+                'Target directory does not exist')
     
     fields = form['files']
     if not isinstance(fields, list):
@@ -551,113 +1366,668 @@ def receive_upload(handler: http.server.BaseHTTPRequestHandler,
         return (http.HTTPStatus.BAD_REQUEST, 'No files selected')
     
     for idx, field in enumerate(fields):
-        if field.file and field.filename:
-            # Use custom filename (with path) if provided, otherwise use original filename
-            if idx < len(filenames_list) and filenames_list[idx]:
-                relative_path = filenames_list[idx]
-                # Sanitize: remove leading slashes and normalize
-                relative_path = relative_path.lstrip('/\\')
-                # Security: prevent directory traversal
-                relative_path = os.path.normpath(relative_path)
-                if relative_path.startswith('..') or os.path.isabs(relative_path):
-                    relative_path = pathlib.Path(field.filename).name
-            else:
-                relative_path = pathlib.Path(field.filename).name
-        else:
-            relative_path = None
+        # Use custom filename (with path) if provided, otherwise use original
+        # filename
+        relative_path = get_upload_relative_path(field.filename,
+            filenames_list[idx] if idx < len(filenames_list) else None)
         
         if relative_path:
-            destination = target_dir / relative_path
-            destination = destination.resolve()
-            
-            # Security check: ensure destination is still within server root
-            if server_root not in destination.parents and server_root != destination.parent:
-                handler.log_message('[Upload Rejected] Path traversal attempt: %s', relative_path)
+            destination = prepare_upload_destination(handler, target_dir,
+                relative_path)
+            if destination is None:
                 continue
             
-            # Create parent directories if needed (for folder uploads)
-            destination.parent.mkdir(parents=True, exist_ok=True)
-            
-            if os.path.exists(destination):
-                if args.allow_replace and os.path.isfile(destination):
-                    os.remove(destination)
-                else:
-                    destination = auto_rename(destination)
-                    name_conflict = True
             if hasattr(field.file, 'name'):
-                source = field.file.name
                 field.file.close()
-                os.rename(source, destination)
+                with timed(handler, 'commit'):
+                    # Parts are spooled on the server root's filesystem. A
+                    # destination on another one gets a copy
+                    source = move_to_device(field.file.name,
+                        destination.parent)
+                    with commit_lock:
+                        destination, renamed = commit_upload(source,
+                            destination)
+                name_conflict = name_conflict or renamed
             # class '_io.BytesIO', small file (< 1000B, in cgi.py), in-memory
             # buffer
             else:
-                with open(destination, 'wb') as f:
-                    f.write(field.file.read())
+                with timed(handler, 'commit'), commit_lock:
+                    if os.path.exists(destination) and not (args.allow_replace
+                    and os.path.isfile(destination)):
+                        destination = auto_rename(destination)
+                        name_conflict = True
+                    with open(destination, 'wb') as f:
+                        f.write(field.file.read())
             handler.log_message('[Uploaded] "%s" --> %s', relative_path, destination)
             result = (http.HTTPStatus.NO_CONTENT, 'Some filename(s) changed '
                 'due to name conflict' if name_conflict else 'Files accepted')
     
     return result
 
-def receive_mkdir(handler: http.server.BaseHTTPRequestHandler
-) -> tuple[http.HTTPStatus, str]:
-    if args.basic_auth_upload and not check_http_authentication(handler):
-         # This should have been handled by do_POST but double check
-         return (http.HTTPStatus.UNAUTHORIZED, 'Authentication required')
+# Chunk size for copying raw request bodies to disk
+BODY_CHUNK_SIZE = 1 << 20
+# Buffers of BODY_CHUNK_SIZE per upload for pipeline.PipelinedWriter, so the
+# socket is still read while the disk is busy
+UPLOAD_BUFFERS = 4
 
-    form = PersistentFieldStorage(fp=handler.rfile, headers=handler.headers,
-        environ={'REQUEST_METHOD': 'POST'})
+def make_upload_writer() -> pipeline.PipelinedWriter:
+    return pipeline.PipelinedWriter(BODY_CHUNK_SIZE, UPLOAD_BUFFERS)
+
+# Report an upload writer's time once it's closed. Its writes happened on
+# another thread, so they can't be timed as they happen
+def record_upload_writer(handler: http.server.BaseHTTPRequestHandler,
+writer: pipeline.PipelinedWriter):
+    if writer.pipelined:
+        UPLOAD_STALL_SECONDS.inc(writer.network_stall, side='network')
+        UPLOAD_STALL_SECONDS.inc(writer.disk_stall, side='disk')
+    if handler.timings:
+        handler.timings.add('write', writer.write_seconds)
+        if writer.pipelined:
+            handler.timings.add('network-stall', writer.network_stall)
+            handler.timings.add('disk-stall', writer.disk_stall)
+
+# Copy exactly `length` bytes of the request body into `file`
+def copy_request_body(handler: http.server.BaseHTTPRequestHandler,
+file: object, length: int):
+    reader = get_body_reader(handler)
+    writer = make_upload_writer()
+    try:
+        while length > 0:
+            count = writer.readinto(file, reader.readinto,
+                min(length, BODY_CHUNK_SIZE))
+            if not count:
+                raise ConnectionError('Request body ended early')
+            length -= count
+    finally:
+        # Whatever was received is written before returning, resumable
+        # sessions keep it
+        try:
+            writer.close()
+        finally:
+            record_upload_writer(handler, writer)
+    handler.body_consumed = True
+
+# Handles PUT to any path other than /upload and /mkdir: the raw request body
+# becomes the file at that path. Avoids multipart encoding and parsing entirely
+# for scripted clients, e.g. curl -T
+@limit_uploads
+def receive_put(handler: http.server.BaseHTTPRequestHandler,
+) -> tuple[http.HTTPStatus, str, dict]:
+    url_path = urllib.parse.unquote(urllib.parse.urlsplit(handler.path).path)
+    if url_path.endswith('/'):
+        return (http.HTTPStatus.BAD_REQUEST, 'PUT target must be a file path',
+            {})
     
-    if 'foldername' not in form:
-        return (http.HTTPStatus.BAD_REQUEST, 'Field "foldername" not found')
+    with timed(handler, 'resolve'):
+        destination = resolve_in_root(url_path)
+        server_root = pathlib.Path(args.directory).resolve()
+        if destination is None or destination == server_root:
+            return (http.HTTPStatus.FORBIDDEN, 'Invalid upload path', {})
+        if destination.is_dir():
+            return (http.HTTPStatus.CONFLICT,
+                'A directory exists at that path', {})
     
-    foldername = form['foldername'].value
-    if not foldername:
-        return (http.HTTPStatus.BAD_REQUEST, 'Folder name is empty')
-        
-    # Sanitize folder name - prevent directory traversal or absolute paths
-    foldername = os.path.basename(foldername)
+    try:
+        length = int(handler.headers['Content-Length'])
+    except (TypeError, ValueError):
+        return (http.HTTPStatus.LENGTH_REQUIRED, 'Content-Length required', {})
+    if length < 0:
+        return (http.HTTPStatus.BAD_REQUEST, 'Invalid Content-Length', {})
     
-    # Get the current path from form data
-    current_path = form.getvalue('path', '/')
-    current_path = current_path.lstrip('/')
+    # Checked before the body is read, so a stale write is refused early, and
+    # again at commit time
+    status = evaluate_file_preconditions(handler, destination)
+    if status is not None:
+        return (status, 'Precondition failed', {})
     
-    # Build target directory
-    base_dir = pathlib.Path(args.directory) / current_path
-    base_dir = base_dir.resolve()
-    server_root = pathlib.Path(args.directory).resolve()
+    try:
+        with timed(handler, 'mkdir'):
+            destination.parent.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        return (http.HTTPStatus.CONFLICT, 'Cannot create parent directory', {})
     
-    # Security check: ensure target is within server root
-    if server_root not in base_dir.parents and server_root != base_dir:
-        return (http.HTTPStatus.FORBIDDEN, 'Invalid path')
+    # Spooled on the destination's filesystem, so the commit is a rename
+    f = make_spool_file(destination.parent, mode='wb')
+    try:
+        with f:
+            copy_request_body(handler, f, length)
+    except ConnectionError:
+        os.remove(f.name)
+        return (http.HTTPStatus.BAD_REQUEST, 'Upload incomplete', {})
+    except BaseException:
+        os.remove(f.name)
+        raise
     
-    target_path = base_dir / foldername
+    with timed(handler, 'commit'), commit_lock:
+        status = evaluate_file_preconditions(handler, destination)
+        if status is not None:
+            os.remove(f.name)
+            return (status, 'Precondition failed', {})
+        
+        existed = destination.exists()
+        destination, renamed = commit_upload(f.name, destination)
+    handler.log_message('[Uploaded] "%s" --> %s', url_path, destination)
     
-    if os.path.exists(target_path):
-        return (http.HTTPStatus.CONFLICT, 'Directory or file already exists')
+    headers = {
+        'Location': '/' + urllib.parse.quote(
+            destination.relative_to(server_root).as_posix()),
+        'ETag': get_file_etag(os.stat(destination)),
+    }
+    if existed and not renamed:
+        return (http.HTTPStatus.NO_CONTENT, 'File replaced', headers)
+    return (http.HTTPStatus.CREATED, 'Filename changed due to name conflict'
+        if renamed else 'File created', headers)
+
+###########################
+# Resumable upload sessions
+###########################
+
+# A session is created with POST /upload-sessions, giving the target path and
+# total size in the Upload-Path and Upload-Length headers. Bytes are then sent
+# with PATCH /upload-sessions/<id> at the offset in Upload-Offset, and HEAD
+# /upload-sessions/<id> reports how many bytes the server has. The PATCH that
+# completes the upload moves the file into place.
+#
+# Each session is two files in the spool directory: <id>.json with the target
+# and total size, and <id>.part with the data received so far. The size of the
+# .part file is the committed offset, so sessions survive a server restart.
+# Sessions that get no data for UPLOAD_SESSION_MAX_IDLE are removed.
+#
+# Sessions created with "Upload-Mode: parallel" accept chunks at any offset,
+# in any order and concurrently, which is what the browser widget uses for
+# large files. Their .part file is preallocated to the full size, each chunk is
+# written at its own offset, and finished chunks are logged to <id>.ranges.
+# The upload is moved into place once the logged ranges cover the whole file
+UPLOAD_SESSIONS_PATH = '/upload-sessions'
+SESSION_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{16,64}')
+
+# Sessions are kept in the first --spool-dir. Every one of them is also used
+# for uploads to its filesystem, see get_upload_spool(). Without --spool-dir,
+# a private directory is made in the system temp directory and removed on
+# exit, so sessions only survive a restart with --spool-dir
+default_spool_dir = None
+# The process that made it. Forked --workers share it and leave it alone
+default_spool_dir_owner = None
+default_spool_dir_lock = threading.Lock()
+
+def get_spool_dirs() -> list:
+    global default_spool_dir, default_spool_dir_owner
+    if args.spool_dir:
+        return [pathlib.Path(spool_dir).resolve()
+            for spool_dir in args.spool_dir]
     
-    try:
-        os.mkdir(target_path)
-        handler.log_message('[Mkdir] Created directory "%s"', target_path)
-        return (http.HTTPStatus.CREATED, 'Directory created')
-    except OSError as e:
-        return (http.HTTPStatus.INTERNAL_SERVER_ERROR, f'Failed to create directory: {e}')
+    with default_spool_dir_lock:
+        if default_spool_dir is None:
+            # mkdtemp() makes a new directory only this user can get into, so
+            # no one else can have made it first or replaced it with a symlink
+            default_spool_dir = pathlib.Path(tempfile.mkdtemp(
+                prefix='updownserver-spool-')).resolve()
+            default_spool_dir_owner = os.getpid()
+    return [default_spool_dir]
 
+# Spool directories hold uploads in progress and the IDs of sessions, which
+# are all it takes to write to them. Returns why `path` can't be one, or None
+# if it can. True return type is str | None, but Python 3.9 doesn't support |
+def check_spool_dir(path: pathlib.Path) -> str:
+    info = os.lstat(path)
+    if stat.S_ISLNK(info.st_mode):
+        return 'is a symlink'
+    if not stat.S_ISDIR(info.st_mode):
+        return 'is not a directory'
+    # Windows has no owners or mode bits to check
+    if hasattr(os, 'getuid'):
+        if info.st_uid != os.getuid():
+            return 'is owned by another user'
+        if stat.S_IMODE(info.st_mode) != 0o700:
+            return 'is not mode 0700'
+    return None
 
-# True return type is tuple[bool, str | None], but Python 3.9 doesn't support |
-def check_http_authentication_header(
-handler: http.server.BaseHTTPRequestHandler, auth: str,
-) -> tuple[bool, str]:
-    auth_header = handler.headers.get('Authorization')
-    if auth_header is None:
-        return (False, 'No credentials given')
+def get_spool_dir() -> pathlib.Path:
+    return get_spool_dirs()[0]
+
+def is_session_path(path: str) -> bool:
+    return path == UPLOAD_SESSIONS_PATH or \
+        path.startswith(UPLOAD_SESSIONS_PATH + '/')
+
+# Returns the (metadata, data, ranges) paths of the session in the request
+# path. True return type is tuple[pathlib.Path, ...] | None, but Python 3.9
+# doesn't support |
+def get_session_files(handler: http.server.BaseHTTPRequestHandler) -> tuple:
+    session_id = handler.path[len(UPLOAD_SESSIONS_PATH) + 1:]
+    if not SESSION_ID_PATTERN.fullmatch(session_id):
+        return None
     
-    auth_header_words = auth_header.split(' ')
-    if len(auth_header_words) != 2:
-        return (False, 'Credentials incorrectly formatted')
+    metadata = get_spool_dir() / f'{session_id}.json'
+    if not metadata.is_file():
+        return None
+    return (metadata, get_spool_dir() / f'{session_id}.part',
+        get_spool_dir() / f'{session_id}.ranges')
+
+def read_header_int(handler: http.server.BaseHTTPRequestHandler, header: str,
+) -> int:
+    try:
+        value = int(handler.headers[header])
+    except (TypeError, ValueError):
+        return None
+    return value if value >= 0 else None
+
+def receive_session_create(handler: http.server.BaseHTTPRequestHandler,
+) -> tuple[http.HTTPStatus, str, dict]:
+    length = read_header_int(handler, 'Upload-Length')
+    if length is None:
+        return (http.HTTPStatus.BAD_REQUEST, 'Upload-Length required', {})
     
-    if auth_header_words[0].lower() != 'basic':
-        return (False, 'Credentials incorrectly formatted')
+    url_path = urllib.parse.unquote(handler.headers.get('Upload-Path', ''))
+    if not url_path or url_path.endswith('/'):
+        return (http.HTTPStatus.BAD_REQUEST, 'Upload-Path must be a file path',
+            {})
+    destination = resolve_in_root(url_path)
+    if destination is None or destination == \
+    pathlib.Path(args.directory).resolve():
+        return (http.HTTPStatus.FORBIDDEN, 'Invalid upload path', {})
+    
+    spool_dir = get_spool_dir()
+    spool_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+    
+    parallel = handler.headers.get('Upload-Mode', '').lower() == 'parallel'
+    session_id = secrets.token_urlsafe(24)
+    with open(spool_dir / f'{session_id}.part', 'wb') as f:
+        if parallel:
+            try:
+                preallocate(f, length)
+            except OSError as e:
+                f.close()
+                os.remove(f.name)
+                return (http.HTTPStatus.INSUFFICIENT_STORAGE,
+                    f'Cannot allocate {length} bytes: {e.strerror}', {})
+            (spool_dir / f'{session_id}.ranges').touch(mode=0o600)
+    metadata = {
+        'path': url_path,
+        'length': length,
+        'parallel': parallel,
+        'root': str(pathlib.Path(args.directory).resolve()),
+        'created': time.time(),
+    }
+    # Written under a temporary name, so a crash never leaves a half-written
+    # session behind
+    temp_path = spool_dir / f'{session_id}.json.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(metadata, f)
+    os.replace(temp_path, spool_dir / f'{session_id}.json')
+    
+    handler.log_message('[Session] Created %s for "%s" (%d bytes)', session_id,
+        url_path, length)
+    return (http.HTTPStatus.CREATED, 'Upload session created', {
+        'Location': f'{UPLOAD_SESSIONS_PATH}/{session_id}',
+        'Upload-Offset': '0',
+        'Upload-Length': str(length),
+    })
+
+def load_session(files: tuple) -> dict:
+    with open(files[0], encoding='utf-8') as f:
+        return json.load(f)
+
+# Reserve disk space up front where the OS supports it, so a parallel upload
+# can't run out of space halfway through. Elsewhere the file is just extended
+def preallocate(f: object, length: int):
+    if hasattr(os, 'posix_fallocate') and length > 0:
+        try:
+            os.posix_fallocate(f.fileno(), 0, length)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+    f.truncate(length)
+
+# Ranges received by a parallel session, merged and sorted, as [start, end)
+# pairs. True return type is list[tuple[int, int]]
+def read_session_ranges(files: tuple) -> list:
+    with open(files[2], encoding='ascii') as f:
+        chunks = sorted(tuple(map(int, line.split())) for line in f if line)
+    
+    ranges = []
+    for start, length in chunks:
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], start + length))
+        else:
+            ranges.append((start, start + length))
+    return ranges
+
+# True return type is tuple[int, list[tuple[int, int]] | None]. The offset of a
+# parallel session is the end of the first contiguous range
+def get_session_progress(files: tuple, session: dict) -> tuple:
+    if not session.get('parallel'):
+        return (os.path.getsize(files[1]), None)
+    
+    ranges = read_session_ranges(files)
+    offset = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+    return (offset, ranges)
+
+def format_ranges(ranges: list) -> str:
+    return ','.join(f'{start}-{end - 1}' for start, end in ranges
+        if end > start)
+
+def receive_session_head(handler: http.server.BaseHTTPRequestHandler,
+) -> tuple[http.HTTPStatus, str, dict]:
+    files = get_session_files(handler)
+    if files is None:
+        return (http.HTTPStatus.NOT_FOUND, 'Upload session not found', {})
+    
+    try:
+        session = load_session(files)
+        offset, ranges = get_session_progress(files, session)
+    except FileNotFoundError:
+        # Finished, cancelled or expired since it was looked up
+        return (http.HTTPStatus.NOT_FOUND, 'Upload session not found', {})
+    headers = {
+        'Upload-Offset': str(offset),
+        'Upload-Length': str(session['length']),
+        'Upload-Path': urllib.parse.quote(session['path']),
+        'Cache-Control': 'no-store',
+        'Content-Length': '0',
+    }
+    if ranges is not None:
+        headers['Upload-Mode'] = 'parallel'
+        headers['Upload-Ranges'] = format_ranges(ranges)
+    return (http.HTTPStatus.OK, 'Upload session found', headers)
+
+# Claim a completed session for the one request that moves it into place, by
+# renaming its data to <id>.done. Returns the new path, or None if another
+# request claimed it first. True return type is pathlib.Path | None, but
+# Python 3.9 doesn't support |
+def claim_session(files: tuple) -> pathlib.Path:
+    claimed = files[1].with_suffix('.done')
+    try:
+        os.rename(files[1], claimed)
+    except FileNotFoundError:
+        return None
+    return claimed
+
+# Move a claimed session's data from `source` to its destination. Renames if
+# the spool is on the same filesystem, otherwise copies it to that filesystem
+# first so the final step is still a rename
+def finish_session(handler: http.server.BaseHTTPRequestHandler, files: tuple,
+session: dict, source: pathlib.Path) -> tuple[http.HTTPStatus, str, dict]:
+    server_root = pathlib.Path(args.directory).resolve()
+    destination = resolve_in_root(session['path'])
+    if destination is None or session['root'] != str(server_root):
+        return (http.HTTPStatus.FORBIDDEN, 'Invalid upload path', {})
+    
+    with timed(handler, 'mkdir'):
+        destination.parent.mkdir(parents=True, exist_ok=True)
+    with timed(handler, 'commit'):
+        try:
+            # The metadata goes first, so a DELETE that came in since the
+            # claim cancels the upload
+            os.remove(files[0])
+            source = move_to_device(str(source), destination.parent)
+            with commit_lock:
+                destination, renamed = commit_upload(source, destination)
+        except FileNotFoundError:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(source)
+            return (http.HTTPStatus.NOT_FOUND, 'Upload session not found', {})
+    handler.log_message('[Uploaded] "%s" --> %s', session['path'], destination)
+    
+    return (http.HTTPStatus.CREATED, 'Filename changed due to name conflict'
+        if renamed else 'Upload complete', {
+        'Location': '/' + urllib.parse.quote(
+            destination.relative_to(server_root).as_posix()),
+        'Upload-Offset': str(session['length']),
+    })
+
+@limit_uploads
+def receive_session_patch(handler: http.server.BaseHTTPRequestHandler,
+) -> tuple[http.HTTPStatus, str, dict]:
+    files = get_session_files(handler)
+    if files is None:
+        return (http.HTTPStatus.NOT_FOUND, 'Upload session not found', {})
+    try:
+        session = load_session(files)
+    except FileNotFoundError:
+        return (http.HTTPStatus.NOT_FOUND, 'Upload session not found', {})
+    
+    offset = read_header_int(handler, 'Upload-Offset')
+    length = read_header_int(handler, 'Content-Length')
+    if offset is None or length is None:
+        return (http.HTTPStatus.BAD_REQUEST,
+            'Upload-Offset and Content-Length required', {})
+    if offset + length > session['length']:
+        return (http.HTTPStatus.BAD_REQUEST, 'Data exceeds Upload-Length', {})
+    
+    if session.get('parallel'):
+        return receive_parallel_chunk(handler, files, session, offset, length)
+    
+    source = None
+    try:
+        f = open(files[1], 'r+b')
+    except FileNotFoundError:
+        # A retried PATCH that arrives after the session was finished, or one
+        # that raced a DELETE
+        return (http.HTTPStatus.NOT_FOUND, 'Upload session not found', {})
+    with f:
+        # Two PATCHes to one session at once can't both be right, so the
+        # second is refused rather than queued
+        if fcntl:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return (http.HTTPStatus.CONFLICT, 'Upload session busy', {})
+        
+        current = os.fstat(f.fileno()).st_size
+        if offset != current:
+            return (http.HTTPStatus.CONFLICT, 'Upload-Offset does not match',
+                {'Upload-Offset': str(current)})
+        
+        f.seek(offset)
+        try:
+            copy_request_body(handler, f, length)
+        except ConnectionError:
+            # Whatever arrived is kept, the client resumes from there
+            return (http.HTTPStatus.BAD_REQUEST, 'Upload incomplete', {})
+        offset = f.tell()
+        
+        # Claimed before the lock is released, so a retried final PATCH
+        # waiting for it finds the session gone. Windows can't rename an open
+        # file, but has no lock to release either
+        if offset >= session['length'] and fcntl:
+            source = claim_session(files)
+    
+    if offset < session['length']:
+        return (http.HTTPStatus.NO_CONTENT, 'Data accepted',
+            {'Upload-Offset': str(offset)})
+    
+    if not fcntl:
+        source = claim_session(files)
+    if source is None:
+        return (http.HTTPStatus.NOT_FOUND, 'Upload session not found', {})
+    return finish_session(handler, files, session, source)
+
+# Chunks of a parallel session each get their own file handle, so concurrent
+# requests write at their own offsets without sharing a file position
+def receive_parallel_chunk(handler: http.server.BaseHTTPRequestHandler,
+files: tuple, session: dict, offset: int, length: int,
+) -> tuple[http.HTTPStatus, str, dict]:
+    try:
+        with open(files[1], 'r+b') as f:
+            # Shared with other chunks, keeps sweep_upload_sessions() off
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_SH)
+            f.seek(offset)
+            copy_request_body(handler, f, length)
+    except ConnectionError:
+        # The chunk is not logged, so the client sends all of it again
+        return (http.HTTPStatus.BAD_REQUEST, 'Upload incomplete', {})
+    except FileNotFoundError:
+        return (http.HTTPStatus.NOT_FOUND, 'Upload session not found', {})
+    
+    try:
+        # A short O_APPEND write, so concurrent chunks can't interleave lines
+        fd = os.open(files[2], os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, f'{offset} {length}\n'.encode('ascii'))
+        finally:
+            os.close(fd)
+        
+        offset, ranges = get_session_progress(files, session)
+    except FileNotFoundError:
+        # The session was cancelled, or completed by a duplicate chunk
+        return (http.HTTPStatus.NOT_FOUND, 'Upload session not found', {})
+    if sum(end - start for start, end in ranges) < session['length']:
+        return (http.HTTPStatus.NO_CONTENT, 'Data accepted', {
+            'Upload-Offset': str(offset),
+            'Upload-Ranges': format_ranges(ranges),
+        })
+    
+    # Removing the ranges log claims the session, so when the last chunks
+    # finish together only one of them moves the file into place
+    try:
+        os.remove(files[2])
+    except FileNotFoundError:
+        return (http.HTTPStatus.NO_CONTENT, 'Data accepted',
+            {'Upload-Offset': str(session['length'])})
+    source = claim_session(files)
+    if source is None:
+        # Cancelled since
+        return (http.HTTPStatus.NOT_FOUND, 'Upload session not found', {})
+    return finish_session(handler, files, session, source)
+
+# Sessions nobody has sent data to for this long were abandoned, and are
+# removed by sweep_upload_sessions()
+UPLOAD_SESSION_MAX_IDLE = 24 * 3600
+SESSION_FILE_PATTERN = re.compile(
+    r'([A-Za-z0-9_-]{16,64})\.(?:json|json\.tmp|part|ranges|done)')
+
+# Remove the files of sessions in the spool directory that haven't been written
+# to for UPLOAD_SESSION_MAX_IDLE. Returns how many were removed
+def sweep_upload_sessions() -> int:
+    spool_dir = get_spool_dir()
+    # Session ID -> when any of its files was last written to
+    sessions = {}
+    with contextlib.suppress(OSError), os.scandir(spool_dir) as entries:
+        for entry in entries:
+            match = SESSION_FILE_PATTERN.fullmatch(entry.name)
+            if not match:
+                continue
+            with contextlib.suppress(OSError):
+                mtime = entry.stat(follow_symlinks=False).st_mtime
+                sessions[match[1]] = max(sessions.get(match[1], 0), mtime)
+    
+    cutoff = time.time() - UPLOAD_SESSION_MAX_IDLE
+    removed = 0
+    for session_id, mtime in sessions.items():
+        if mtime < cutoff and remove_idle_session(spool_dir / session_id,
+        cutoff):
+            removed += 1
+    return removed
+
+# PATCH requests lock the .part file while they write to it, in any process,
+# so a session that is still receiving data however slowly is left alone.
+# Returns whether the session was removed
+def remove_idle_session(base: pathlib.Path, cutoff: float) -> bool:
+    try:
+        f = open(base.with_name(base.name + '.part'), 'rb')
+    except FileNotFoundError:
+        f = None
+    except OSError:
+        return False
+    
+    try:
+        if f and fcntl:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+        if f and os.fstat(f.fileno()).st_mtime >= cutoff:
+            return False
+        # The metadata goes first, so the session is gone for new requests
+        for suffix in ('.json', '.json.tmp', '.ranges', '.part', '.done'):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(base.with_name(base.name + suffix))
+        return True
+    finally:
+        if f:
+            f.close()
+
+def receive_session_delete(handler: http.server.BaseHTTPRequestHandler,
+) -> tuple[http.HTTPStatus, str, dict]:
+    files = get_session_files(handler)
+    if files is None:
+        return (http.HTTPStatus.NOT_FOUND, 'Upload session not found', {})
+    
+    for path in files:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+    handler.log_message('[Session] Cancelled %s', files[0].stem)
+    return (http.HTTPStatus.NO_CONTENT, 'Upload session cancelled', {})
+
+def receive_mkdir(handler: http.server.BaseHTTPRequestHandler
+) -> tuple[http.HTTPStatus, str]:
+    if args.basic_auth_upload and not check_http_authentication(handler):
+         # This should have been handled by do_POST but double check
+         return (http.HTTPStatus.UNAUTHORIZED, 'Authentication required')
+
+    try:
+        form = parse_form(handler)
+    except multipart.MultipartError as e:
+        return (http.HTTPStatus.BAD_REQUEST, f'Malformed request: {e}')
+    
+    try:
+        foldername = form.getvalue('foldername')
+        # Get the current path from form data
+        current_path = form.getvalue('path', '/')
+    finally:
+        form.cleanup()
+    
+    if foldername is None:
+        return (http.HTTPStatus.BAD_REQUEST, 'Field "foldername" not found')
+    
+    if not foldername:
+        return (http.HTTPStatus.BAD_REQUEST, 'Folder name is empty')
+        
+    # Sanitize folder name - prevent directory traversal or absolute paths
+    foldername = os.path.basename(foldername)
+    
+    current_path = current_path.lstrip('/')
+    
+    # Build target directory
+    base_dir = pathlib.Path(args.directory) / current_path
+    base_dir = base_dir.resolve()
+    server_root = pathlib.Path(args.directory).resolve()
+    
+    # Security check: ensure target is within server root
+    if server_root not in base_dir.parents and server_root != base_dir:
+        return (http.HTTPStatus.FORBIDDEN, 'Invalid path')
+    
+    target_path = base_dir / foldername
+    if is_upload_spool_path(target_path):
+        return (http.HTTPStatus.FORBIDDEN, 'Invalid path')
+    
+    if os.path.exists(target_path):
+        return (http.HTTPStatus.CONFLICT, 'Directory or file already exists')
+    
+    try:
+        os.mkdir(target_path)
+        handler.log_message('[Mkdir] Created directory "%s"', target_path)
+        return (http.HTTPStatus.CREATED, 'Directory created')
+    except OSError as e:
+        return (http.HTTPStatus.INTERNAL_SERVER_ERROR, f'Failed to create directory: {e}')
+
+
+# True return type is tuple[bool, str | None], but Python 3.9 doesn't support |
+def check_http_authentication_header(
+handler: http.server.BaseHTTPRequestHandler, auth: str,
+) -> tuple[bool, str]:
+    auth_header = handler.headers.get('Authorization')
+    if auth_header is None:
+        return (False, 'No credentials given')
+    
+    auth_header_words = auth_header.split(' ')
+    if len(auth_header_words) != 2:
+        return (False, 'Credentials incorrectly formatted')
+    
+    if auth_header_words[0].lower() != 'basic':
+        return (False, 'Credentials incorrectly formatted')
     
     try:
         http_username_password = base64.b64decode(auth_header_words[1]).decode()
@@ -669,6 +2039,7 @@ handler: http.server.BaseHTTPRequestHandler, auth: str,
     if http_username != args_username: return (False, 'Bad username')
     if http_password != args_password: return (False, 'Bad password')
     
+    handler.auth_user = http_username
     return (True, None)
 
 def check_http_authentication(handler: http.server.BaseHTTPRequestHandler
@@ -687,10 +2058,13 @@ def check_http_authentication(handler: http.server.BaseHTTPRequestHandler
         valid, message = check_http_authentication_header(handler, args.basic_auth)
     else:
         # If --basic-auth-upload is supplied, it's always required for /upload
-        # and other write operations (mkdir, delete)
+        # and other write operations (mkdir, delete), and for /metrics
         is_write_op = (handler.path == '/upload' or 
                        handler.path == '/mkdir' or 
-                       (hasattr(handler, 'command') and handler.command == 'DELETE'))
+                       is_session_path(handler.path) or
+                       is_metrics_path(handler.path) or
+                       (hasattr(handler, 'command') and
+                        handler.command in ('PUT', 'DELETE')))
         
         if is_write_op:
             valid, message = check_http_authentication_header(handler,
@@ -710,71 +2084,1513 @@ def check_http_authentication(handler: http.server.BaseHTTPRequestHandler
                     args.basic_auth_upload)
     
     if not valid:
+        AUTH_FAILURES.inc(reason=message)
         handler.send_response(http.HTTPStatus.UNAUTHORIZED)
         handler.send_header('WWW-Authenticate', 'Basic realm="Upload"')
+        handler.send_header('Content-Length', '0')
         handler.end_headers()
     return valid
 
-# Let's not inherit http.server.SimpleHTTPRequestHandler - that would cause
-# diamond-pattern inheritance
-class ListDirectoryInterception:
-    # Only runs when serving directory listings
-    def flush_headers_interceptor(self):
-        # Calculate auth state for delete JS injection size matching copyfile_interceptor
-        has_auth = args.basic_auth or args.basic_auth_upload or args.client_certificate
-        enable_delete_js = b'<script>const ENABLE_DELETE = ' + \
-            (b'true' if has_auth else b'false') + b';</script>'
+# Send the response for a (status, message[, headers]) tuple returned by one
+# of the receive_*() functions
+def send_result(handler: http.server.BaseHTTPRequestHandler, result: tuple):
+    headers = result[2] if len(result) > 2 else {}
+    if result[0] < http.HTTPStatus.BAD_REQUEST:
+        handler.send_response(result[0], result[1])
+        for keyword, value in headers.items():
+            handler.send_header(keyword, value)
+        # No body, but a kept-alive connection needs to know that
+        if result[0] not in (http.HTTPStatus.NO_CONTENT,
+        http.HTTPStatus.NOT_MODIFIED) and 'Content-Length' not in headers:
+            handler.send_header('Content-Length', '0')
+        handler.end_headers()
+    elif not headers:
+        handler.send_error(result[0], result[1])
+    else:
+        # send_error() can't add headers, so this is a plain text equivalent
+        handler.log_error('code %d, message %s', result[0], result[1])
+        body = result[1].encode('utf-8', 'replace')
+        handler.send_response(result[0], result[1])
+        for keyword, value in headers.items():
+            handler.send_header(keyword, value)
+        handler.send_header('Content-Type', 'text/plain; charset=utf-8')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        if handler.command != 'HEAD':
+            handler.wfile.write(body)
+
+# Seconds clients are asked to wait when the server refuses them for being busy
+RETRY_AFTER = 5
+
+# Sent to connections past --max-connections, without reading their request
+BUSY_MESSAGE = b'Server busy, try again later\n'
+BUSY_RESPONSE = (b'HTTP/1.1 503 Service Unavailable\r\n'
+    b'Retry-After: %d\r\n'
+    b'Content-Type: text/plain; charset=utf-8\r\n'
+    b'Content-Length: %d\r\n'
+    b'Connection: close\r\n\r\n' % (RETRY_AFTER, len(BUSY_MESSAGE))) + \
+    BUSY_MESSAGE
+
+# Listen backlog, for connections the kernel has accepted but the server
+# hasn't picked up yet. socketserver's default of 5 drops connections in bursts
+LISTEN_BACKLOG = 128
+
+# Time a client gets to complete the TLS handshake
+TLS_HANDSHAKE_TIMEOUT = 10
+
+# Replaces ThreadingHTTPServer's thread per connection with a fixed pool of
+# worker threads. Accepted connections queue for a free worker; past
+# max_connections, counting the queued ones, they are answered with
+# BUSY_RESPONSE straight from the accept loop.
+#
+# With ssl_context set, the worker does the TLS handshake, so a slow or stalled
+# client only holds up its own worker and never the accept loop. Refused
+# connections need a handshake too before they can be answered, which one extra
+# thread does for up to request_queue_size of them at a time.
+#
+# A kept-alive connection keeps its worker while waiting for its next request,
+# so when a connection has to queue, one idle connection is woken up through
+# wakeup_reader to give its worker up, see PersistentConnections
+class PooledHTTPServer(http.server.HTTPServer):
+    request_queue_size = LISTEN_BACKLOG
+    threads = 64
+    max_connections = 1024
+    ssl_context = None
+    handshake_timeout = TLS_HANDSHAKE_TIMEOUT
+    
+    wakeup_reader = None
+    wakeup_writer = None
+    
+    def __init__(self, *arguments, **kwargs):
+        super().__init__(*arguments, **kwargs)
+        self.pending = queue.SimpleQueue()
+        self.refused = queue.SimpleQueue()
+        self.connections = 0
+        self.free_workers = 0
+        self.lock = threading.Lock()
+    
+    # Threads and the wakeup socketpair are only created here, in the process
+    # that serves, since --workers forks after the server was created
+    def serve_forever(self, poll_interval: float = 0.5):
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        
+        for _ in range(self.threads):
+            threading.Thread(target=self.process_pending, daemon=True).start()
+        if self.ssl_context:
+            threading.Thread(target=self.process_refused, daemon=True).start()
+        
+        super().serve_forever(poll_interval)
+    
+    # Whether connections are waiting for a worker
+    def busy(self) -> bool:
+        return self.pending.qsize() > self.free_workers
+    
+    # Called by idle connections when wakeup_reader is readable. Returns True
+    # for the one that should give its worker up
+    def take_wakeup(self) -> bool:
+        try:
+            self.wakeup_reader.recv(1)
+        except BlockingIOError:
+            return False
+        return self.busy()
+    
+    def process_request(self, request, client_address):
+        with self.lock:
+            admitted = self.connections < self.max_connections
+            if admitted:
+                self.connections += 1
+        
+        if not admitted:
+            if self.ssl_context and \
+            self.refused.qsize() < self.request_queue_size:
+                self.refused.put(request)
+                return
+            if not self.ssl_context:
+                with contextlib.suppress(OSError):
+                    request.sendall(BUSY_RESPONSE)
+            self.shutdown_request(request)
+            return
+        
+        self.pending.put((request, client_address))
+        if self.busy():
+            with contextlib.suppress(OSError):
+                self.wakeup_writer.send(b'\0')
+    
+    def process_pending(self):
+        while True:
+            with self.lock:
+                self.free_workers += 1
+            request, client_address = self.pending.get()
+            with self.lock:
+                self.free_workers -= 1
+            
+            try:
+                if self.ssl_context:
+                    request = self.wrap_request(request)
+                if request:
+                    self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                if request:
+                    self.shutdown_request(request)
+                with self.lock:
+                    self.connections -= 1
+    
+    def process_refused(self):
+        while True:
+            request = self.wrap_request(self.refused.get())
+            if request:
+                with contextlib.suppress(OSError):
+                    request.sendall(BUSY_RESPONSE)
+                self.shutdown_request(request)
+    
+    # Returns the connection with the TLS handshake done, or None after
+    # closing it if the handshake failed or took too long
+    def wrap_request(self, request: socket.socket) -> ssl.SSLSocket:
+        try:
+            request.settimeout(self.handshake_timeout)
+            request = self.ssl_context.wrap_socket(request, server_side=True,
+                do_handshake_on_connect=False)
+            request.do_handshake()
+            request.settimeout(None)
+            return request
+        except (OSError, ValueError):
+            self.shutdown_request(request)
+            return None
+    
+    def server_close(self):
+        super().server_close()
+        if self.wakeup_reader:
+            self.wakeup_reader.close()
+            self.wakeup_writer.close()
+
+METRICS_PATH = '/metrics'
+
+REQUESTS = metrics.Counter('updownserver_requests_total',
+    'Requests handled, by route and status code')
+REQUEST_SECONDS = metrics.Histogram('updownserver_request_duration_seconds',
+    'Time from the request line until the response was sent, by route')
+REQUEST_BODY_BYTES = metrics.Counter('updownserver_request_body_bytes_total',
+    'Request body bytes received, by route')
+RESPONSE_BYTES = metrics.Counter('updownserver_response_bytes_total',
+    'Response bytes sent, headers included, by route')
+REQUESTS_IN_PROGRESS = metrics.Gauge('updownserver_requests_in_progress',
+    'Requests being handled')
+REQUESTS_IN_PROGRESS.set(0)
+UPLOADS_IN_PROGRESS = metrics.Gauge('updownserver_uploads_in_progress',
+    'Uploads counted against --max-uploads', lambda: active_uploads)
+AUTH_FAILURES = metrics.Counter('updownserver_auth_failures_total',
+    'Requests refused with 401, by reason')
+UPLOAD_STALL_SECONDS = metrics.Counter('updownserver_upload_stall_seconds_total',
+    'Time pipelined uploads spent stalled, by side: network is the disk writer '
+    'waiting for data, disk is the socket reader waiting for a free buffer')
+
+# Disk space taken by unfinished resumable uploads and uploads in progress
+def get_spool_usage() -> int:
+    total = 0
+    with upload_spools_lock:
+        spools = [get_spool_dir(), *upload_spools.values()]
+    for spool in spools:
+        with contextlib.suppress(OSError), os.scandir(spool) as entries:
+            for entry in entries:
+                with contextlib.suppress(OSError):
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                    # .part files are preallocated, so count blocks on disk
+                    # where the platform reports them
+                    total += stat.st_blocks * 512 \
+                        if hasattr(stat, 'st_blocks') else stat.st_size
+    return total
+
+SPOOL_BYTES = metrics.Gauge('updownserver_spool_bytes',
+    'Disk space used by spool directories', get_spool_usage)
+
+def is_metrics_path(path: str) -> bool:
+    return args.metrics and path == METRICS_PATH
 
-        for i, header in enumerate(self._headers_buffer):
-            if header[:15] == b'Content-Length:':
-                length = int(header[15:]) + len(DIRECTORY_BODY_INJECTION) + \
-                    len(get_directory_head_injection(args.theme)) + \
-                    len(enable_delete_js) + \
-                    len(get_shutdown_timer_injection())
+def send_metrics(handler: http.server.BaseHTTPRequestHandler):
+    body = metrics.render().encode('utf-8')
+    handler.send_response(http.HTTPStatus.OK)
+    handler.send_header('Content-Type', 'text/plain; version=0.0.4; '
+        'charset=utf-8')
+    handler.send_header('Cache-Control', 'no-store')
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+# Route label for a request's metrics, from its method and path
+def get_route(handler: http.server.BaseHTTPRequestHandler) -> str:
+    if handler.route:
+        return handler.route
+    if is_metrics_path(handler.path):
+        return 'metrics'
+    if is_session_path(handler.path):
+        return 'upload_session'
+    if handler.path == '/upload':
+        return 'upload_page' if handler.command in ('GET', 'HEAD') \
+            else 'upload'
+    if handler.path == '/mkdir' and handler.command in ('POST', 'PUT'):
+        return 'mkdir'
+    return {
+        'GET': 'file',
+        'HEAD': 'file',
+        'PUT': 'put',
+        'DELETE': 'delete',
+    }.get(handler.command, 'other')
+
+def record_request(handler: http.server.BaseHTTPRequestHandler,
+seconds: float, bytes_written: int):
+    route = get_route(handler)
+    # No status code means the handler failed or the client went away before
+    # a response was started
+    REQUESTS.inc(route=route, code=str(int(handler.response_code))
+        if handler.response_code not in (None, '-') else 'none')
+    REQUEST_SECONDS.observe(seconds, route=route)
+    RESPONSE_BYTES.inc(bytes_written, route=route)
+    REQUEST_BODY_BYTES.inc(get_body_size(handler), route=route)
+
+# Request body bytes read, counted from Content-Length
+def get_body_size(handler: http.server.BaseHTTPRequestHandler) -> int:
+    if not handler.body_consumed:
+        return 0
+    try:
+        return int(handler.headers.get('Content-Length', 0))
+    except ValueError:
+        return 0
+
+# Response writer that counts the bytes passing through it, for --metrics and
+# --access-log
+class CountingWriter(io.BufferedIOBase):
+    def __init__(self, wfile: io.BufferedIOBase):
+        self._wfile = wfile
+        self.bytes_written = 0
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, b) -> int:
+        self._wfile.write(b)
+        with memoryview(b) as view:
+            self.bytes_written += view.nbytes
+            return view.nbytes
+    
+    def flush(self):
+        self._wfile.flush()
+    
+    # The CGI handler gives this to scripts as their stdout
+    def fileno(self) -> int:
+        return self._wfile.fileno()
+
+# Time spent in each phase of one request, for --server-timing. Phases are
+# timed with timed() or added with add(), and a phase timed more than once
+# adds up
+class RequestTimings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        # Seconds per phase, in the order the phases first happened
+        self.phases = {}
+    
+    def add(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+    
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+    
+    # Server-Timing header value, in milliseconds. total is the time until the
+    # header is sent, so a download's body isn't included
+    def header(self) -> str:
+        return ', '.join(f'{name};dur={seconds * 1000:.3f}' for name, seconds
+            in self.phases.items()) + \
+            f'{", " if self.phases else ""}total;dur=' \
+            f'{(time.perf_counter() - self.start) * 1000:.3f}'
+
+NOT_TIMED = contextlib.nullcontext()
+
+# Context manager timing a phase of the handler's request, or doing nothing
+# without --server-timing
+def timed(handler: http.server.BaseHTTPRequestHandler, name: str) -> object:
+    return handler.timings.phase(name) if handler.timings else NOT_TIMED
+
+# Request body reader that counts the time spent waiting for the client as the
+# read phase
+class TimedReader:
+    def __init__(self, rfile: io.BufferedIOBase, timings: RequestTimings):
+        self._rfile = rfile
+        self._timings = timings
+        self.seconds = 0.0
+    
+    def _timed(self, read, *arguments) -> object:
+        start = time.perf_counter()
+        try:
+            return read(*arguments)
+        finally:
+            seconds = time.perf_counter() - start
+            self.seconds += seconds
+            self._timings.add('read', seconds)
+    
+    def read(self, *arguments) -> bytes:
+        return self._timed(self._rfile.read, *arguments)
+    
+    def readinto(self, b) -> int:
+        return self._timed(self._rfile.readinto, b)
+    
+    def readinto1(self, b) -> int:
+        return self._timed(getattr(self._rfile, 'readinto1',
+            self._rfile.readinto), b)
+    
+    def readline(self, *arguments) -> bytes:
+        return self._timed(self._rfile.readline, *arguments)
+
+def get_body_reader(handler: http.server.BaseHTTPRequestHandler) -> object:
+    if handler.timings:
+        return TimedReader(handler.rfile, handler.timings)
+    return handler.rfile
+
+def log_timings(handler: http.server.BaseHTTPRequestHandler, seconds: float):
+    handler.log_message('[Timing] %s', json.dumps({
+        'method': handler.command,
+        'path': handler.path,
+        'status': int(handler.response_code)
+            if handler.response_code not in (None, '-') else None,
+        'total_ms': round(seconds * 1000, 3),
+        'phases_ms': {name: round(phase_seconds * 1000, 3)
+            for name, phase_seconds in handler.timings.phases.items()},
+    }))
+
+# The --access-log writer, None without it
+access_log = None
+
+ACCESS_LOG_DROPPED = metrics.Gauge('updownserver_access_log_dropped',
+    'Access log records dropped because the buffer was full',
+    lambda: access_log.dropped if access_log else 0)
+
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._:-]{1,64}')
+
+# Keeps the client's or a proxy's X-Request-ID if it looks sane
+def get_request_id(handler: http.server.BaseHTTPRequestHandler) -> str:
+    request_id = handler.headers.get('X-Request-ID', '') \
+        if handler.headers else ''
+    if REQUEST_ID_PATTERN.fullmatch(request_id):
+        return request_id
+    return secrets.token_hex(8)
+
+def get_log_time() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(
+        timespec='milliseconds').replace('+00:00', 'Z')
+
+def log_access(handler: http.server.BaseHTTPRequestHandler, seconds: float,
+bytes_written: int):
+    record = {
+        'time': get_log_time(),
+        'request_id': handler.request_id,
+        'client': handler.client_address[0] if handler.client_address
+            else None,
+        'method': handler.command,
+        'path': handler.path,
+        'route': get_route(handler),
+        'status': int(handler.response_code)
+            if handler.response_code not in (None, '-') else None,
+        'bytes_in': get_body_size(handler),
+        'bytes_out': bytes_written,
+        'duration_ms': round(seconds * 1000, 3),
+        'user': handler.auth_user,
+    }
+    if handler.timings:
+        record['phases_ms'] = {name: round(phase_seconds * 1000, 3)
+            for name, phase_seconds in handler.timings.phases.items()}
+    access_log.log(record)
+
+def open_access_log():
+    global access_log
+    
+    server_root = pathlib.Path(args.directory).resolve()
+    if args.access_log != '-' and \
+    server_root in pathlib.Path(args.access_log).resolve().parents:
+        print(f'Access log "{args.access_log}" is inside web server root '
+            f'"{server_root}", exiting')
+        sys.exit(3)
+    
+    try:
+        access_log = accesslog.AccessLog(args.access_log,
+            buffer_size=args.access_log_buffer,
+            batch_size=args.access_log_batch,
+            flush_interval=args.access_log_flush,
+            max_bytes=args.access_log_max_bytes)
+    except OSError as e:
+        print(f'Unable to open access log "{args.access_log}": {e}, exiting')
+        sys.exit(4)
+
+# SIGTERM handler: write out queued --access-log records and remove this
+# process's spool directories, then die of SIGTERM as usual. Doesn't wait for
+# open connections
+def flush_and_terminate(signum: int, frame: object):
+    if access_log:
+        access_log.close()
+    remove_spools()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+profile_lock = threading.Lock()
+profile_counter = itertools.count(1)
+
+# Run every --profile-every'th request under cProfile, and write the profile to
+# --profile-dir. One request is profiled at a time, a sampled request that
+# comes in meanwhile runs normally. Before Python 3.12 the profile only covers
+# the request's own thread; since then it covers whatever ran in the meantime
+def handle_profiled(handler: http.server.BaseHTTPRequestHandler):
+    number = next(profile_counter)
+    if number % args.profile_every or not profile_lock.acquire(blocking=False):
+        http.server.BaseHTTPRequestHandler.handle_one_request(handler)
+        return
+    
+    try:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(http.server.BaseHTTPRequestHandler.handle_one_request,
+                handler)
+        finally:
+            if handler.command:
+                profile_dir = get_profile_dir()
+                profile_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+                profiler.dump_stats(profile_dir / '{}-{}-{}-{}.prof'.format(
+                    time.strftime('%Y%m%d-%H%M%S'), os.getpid(), number,
+                    get_route(handler)))
+    finally:
+        profile_lock.release()
+
+def get_profile_dir() -> pathlib.Path:
+    if args.profile_dir:
+        return pathlib.Path(args.profile_dir).resolve()
+    return pathlib.Path(tempfile.gettempdir(),
+        'updownserver-profiles').resolve()
+
+# HTTP/1.1 persistent connections. Every response must be framed by
+# Content-Length (or end with the connection closing), and a request body that
+# wasn't read would be parsed as the next request, so the connection is closed
+# instead. Not a subclass of http.server.BaseHTTPRequestHandler, same as
+# ListDirectoryInterception
+class PersistentConnections:
+    protocol_version = 'HTTP/1.1'
+    # The head and body of a response are separate writes. With Nagle's
+    # algorithm the body waits for the client to ACK the head, which it delays
+    # by up to 40 ms on a keep-alive connection
+    disable_nagle_algorithm = True
+    
+    requests_handled = 0
+    # Set by parse_form() and copy_request_body() once the whole request body
+    # has been read
+    body_consumed = False
+    # For --metrics and --server-timing. The route is set by handlers that
+    # know better than get_route(), and the status code by log_request()
+    route = None
+    response_code = None
+    timings = None
+    # For --access-log
+    request_id = None
+    auth_user = None
+    
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        if args.metrics or args.access_log:
+            self.wfile = CountingWriter(self.wfile)
+    
+    def handle_one_request(self):
+        if self.requests_handled and not self.wait_for_request():
+            self.close_connection = True
+            return
+        
+        self.requests_handled += 1
+        self.body_consumed = False
+        
+        # Files the request spools are in use until it's done
+        with track_spool_files():
+            if not (args.metrics or args.server_timing or
+            args.profile_every or args.access_log):
+                # Can't use super() - avoiding diamond-pattern inheritance
+                http.server.BaseHTTPRequestHandler.handle_one_request(self)
+                return
+            
+            # An empty request line leaves the previous request's command set
+            self.command = None
+            self.route = None
+            self.response_code = None
+            self.request_id = None
+            self.auth_user = None
+            self.timings = RequestTimings() if args.server_timing else None
+            start = time.perf_counter()
+            bytes_written = self.wfile.bytes_written \
+                if isinstance(self.wfile, CountingWriter) else 0
+            REQUESTS_IN_PROGRESS.inc()
+            try:
+                if args.profile_every:
+                    handle_profiled(self)
+                else:
+                    http.server.BaseHTTPRequestHandler.handle_one_request(self)
+            finally:
+                REQUESTS_IN_PROGRESS.dec()
+                if self.command:
+                    seconds = time.perf_counter() - start
+                    if isinstance(self.wfile, CountingWriter):
+                        bytes_written = \
+                            self.wfile.bytes_written - bytes_written
+                    if args.metrics:
+                        record_request(self, seconds, bytes_written)
+                    if access_log:
+                        log_access(self, seconds, bytes_written)
+                    elif self.timings:
+                        log_timings(self, seconds)
+    
+    def parse_request(self) -> bool:
+        valid = http.server.BaseHTTPRequestHandler.parse_request(self)
+        if access_log:
+            self.request_id = get_request_id(self) if valid \
+                else secrets.token_hex(8)
+        return valid
+    
+    # With --access-log, the request is logged once it's done, see
+    # log_access()
+    def log_request(self, code: object = '-', size: object = '-'):
+        self.response_code = code
+        if not access_log:
+            http.server.BaseHTTPRequestHandler.log_request(self, code, size)
+    
+    def log_message(self, format: str, *arguments):
+        if not access_log:
+            http.server.BaseHTTPRequestHandler.log_message(self, format,
+                *arguments)
+            return
+        access_log.log({
+            'time': get_log_time(),
+            'request_id': self.request_id,
+            'client': self.client_address[0] if self.client_address else None,
+            'message': format % arguments,
+        })
+    
+    def server_busy(self) -> bool:
+        return isinstance(self.server, PooledHTTPServer) and self.server.busy()
+    
+    # Wait up to --keep-alive-timeout for the next request on this connection.
+    # Returns False if the client closed the connection or stayed idle, or if
+    # a queued connection needs this thread. Unlike letting the request line
+    # read time out, this doesn't log an error
+    def wait_for_request(self) -> bool:
+        deadline = time.monotonic() + args.keep_alive_timeout
+        wakeup = self.server.wakeup_reader \
+            if isinstance(self.server, PooledHTTPServer) else None
+        readable = False
+        try:
+            # Non-blocking, so peek() only returns what has already arrived
+            self.connection.settimeout(0)
+            while True:
+                try:
+                    if hasattr(self.rfile, 'peek'):
+                        if self.rfile.peek(1):
+                            return True
+                        if readable:
+                            # Readable, but nothing to read: closed by the
+                            # client
+                            return False
+                    # CGIHTTPRequestHandler reads unbuffered, so nothing can
+                    # be waiting in rfile, but TLS may have decrypted data
+                    # select() can't see
+                    elif readable or isinstance(self.connection,
+                    ssl.SSLSocket) and self.connection.pending():
+                        return True
+                except ssl.SSLWantReadError:
+                    # Only part of a TLS record has arrived
+                    pass
                 
-                # Use same encoding that self.send_header() uses
-                self._headers_buffer[i] = f'Content-Length: {length}\r\n' \
-                    .encode('latin-1', 'strict')
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                ready = select.select([self.connection] +
+                    ([wakeup] if wakeup else []), [], [], remaining)[0]
+                if wakeup in ready and self.server.take_wakeup():
+                    return False
+                readable = self.connection in ready
+        except OSError:
+            return False
+        finally:
+            with contextlib.suppress(OSError):
+                self.connection.settimeout(None)
+    
+    def request_body_pending(self) -> bool:
+        if self.body_consumed:
+            return False
+        if 'Transfer-Encoding' in self.headers:
+            return True
+        try:
+            return int(self.headers.get('Content-Length', 0)) > 0
+        except ValueError:
+            return True
+    
+    # Tell the client when this is the last response on the connection
+    def end_headers(self):
+        if self.timings:
+            self.send_header('Server-Timing', self.timings.header())
+        if self.request_id:
+            self.send_header('X-Request-ID', self.request_id)
+        if self.request_version != 'HTTP/0.9' and not self.close_connection:
+            if args.keep_alive_timeout <= 0 or \
+            self.requests_handled >= args.max_requests or \
+            self.request_body_pending() or self.server_busy():
+                self.send_header('Connection', 'close')
+            elif self.request_version == 'HTTP/1.0':
+                self.send_header('Connection', 'keep-alive')
+        
+        http.server.BaseHTTPRequestHandler.end_headers(self)
+    
+    # Bad credentials are refused before the client sends the body. Skips
+    # end_headers() above: the request body hasn't been read yet when 100
+    # Continue is sent
+    def handle_expect_100(self) -> bool:
+        if not check_http_authentication(self):
+            return False
+        
+        self.send_response_only(http.HTTPStatus.CONTINUE)
+        http.server.BaseHTTPRequestHandler.end_headers(self)
+        return True
+
+# For the asyncio engine, which waits for each request on its event loop and
+# creates a handler per request. The connection is an aio.Channel
+class AsyncioRequests:
+    # aio.AsyncioHTTPServer sets TCP_NODELAY itself, the connection is not a
+    # socket
+    disable_nagle_algorithm = False
+    
+    def handle(self):
+        self.requests_handled = self.connection.requests_handled
+        self.close_connection = True
+        self.handle_one_request()
+        self.connection.requests_handled = self.requests_handled
+        self.connection.close_connection = self.close_connection
+    
+    # The event loop has already received the request head
+    def wait_for_request(self) -> bool:
+        return True
+
+# Directory listings are paged, sorted and filtered with query parameters:
+# page (from 1), limit (entries per page), sort (name, size or mtime), order
+# (asc or desc) and filter (a name prefix, or a glob if it contains *, ? or [,
+# both case-insensitive). The same parameters work with ?format=json
+LISTING_DEFAULT_LIMIT = 1000
+LISTING_SORT_KEYS = ('name', 'size', 'mtime')
+LISTING_DEFAULT_QUERY = {
+    'page': 1,
+    'limit': LISTING_DEFAULT_LIMIT,
+    'sort': 'name',
+    'order': 'asc',
+    'filter': '',
+}
+
+# Returns None if a parameter is invalid. True return type is dict | None, but
+# Python 3.9 doesn't support |
+def parse_listing_query(url: str) -> dict:
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+    listing_query = {name: query[name][-1] if name in query else default
+        for name, default in LISTING_DEFAULT_QUERY.items()}
+    
+    try:
+        listing_query['page'] = int(listing_query['page'])
+        listing_query['limit'] = int(listing_query['limit'])
+    except ValueError:
+        return None
+    if listing_query['page'] < 1 or listing_query['limit'] < 1 or \
+    listing_query['sort'] not in LISTING_SORT_KEYS or \
+    listing_query['order'] not in ('asc', 'desc'):
+        return None
+    return listing_query
+
+# Query string for a listing page, leaving out parameters at their defaults
+def get_listing_url(listing_query: dict, **changes) -> str:
+    listing_query = {**listing_query, **changes}
+    return '?' + urllib.parse.urlencode({name: value
+        for name, value in listing_query.items()
+        if value != LISTING_DEFAULT_QUERY[name]})
+
+# Sorted views of a directory, so paging through a large directory doesn't
+# re-read and re-sort it for every page. Entries are (name, is_dir, is_link,
+# lowercase name) tuples, in the same order as the stdlib listing.
+class DirectoryIndex:
+    # True argument type for path is str | pathlib.Path, but Python 3.9 doesn't
+    # support |
+    def __init__(self, path: pathlib.Path, identity: tuple, scandir: object):
+        self.path = path
+        self.identity = identity
+        self.created = time.monotonic()
+        
+        self.entries = []
+        # Name -> os.DirEntry, which caches the entry's stat once read
+        self._dir_entries = {}
+        with scandir:
+            for entry in scandir:
+                if entry.name == UPLOAD_SPOOL_NAME:
+                    continue
+                self._dir_entries[entry.name] = entry
+                try:
+                    is_dir = entry.is_dir()
+                    is_link = entry.is_symlink()
+                except OSError:
+                    is_dir = is_link = False
+                self.entries.append((entry.name, is_dir, is_link,
+                    entry.name.lower()))
+        self.entries.sort(key=lambda entry: entry[3])
         
-        # Can't use super() - avoiding diamond-pattern inheritance'
-        http.server.SimpleHTTPRequestHandler.flush_headers(self)
+        # (size, mtime) of each entry, only read when sorting by them
+        self._stats = None
+        # (sort, descending) -> entries in that order
+        self._orders = {}
+        self._lock = threading.Lock()
     
-    # Only runs when serving directory listings
-    def copyfile_interceptor(self, source, outputfile):
-        content = source.read()
-        content = content.replace(b'</head>',
-            get_directory_head_injection(args.theme) + b'</head>')
+    def _get_stats(self) -> list:
+        if self._stats is None:
+            self._stats = []
+            for name, is_dir, _, _ in self.entries:
+                try:
+                    stat = self._dir_entries[name].stat()
+                except OSError:
+                    # Broken symlink, or the entry was removed since
+                    self._stats.append((-1, 0))
+                    continue
+                # Directories sort before files of any size
+                self._stats.append((-1 if is_dir else stat.st_size,
+                    stat.st_mtime))
+        return self._stats
+    
+    def _get_order(self, sort: str, descending: bool) -> list:
+        with self._lock:
+            if (sort, descending) not in self._orders:
+                if sort == 'name':
+                    order = self.entries[::-1] if descending else self.entries
+                else:
+                    # The sort is stable, so ties stay in name order
+                    column = LISTING_SORT_KEYS.index(sort) - 1
+                    values = [stat[column] for stat in self._get_stats()]
+                    order = [self.entries[i] for i in sorted(
+                        range(len(values)), key=values.__getitem__,
+                        reverse=descending)]
+                self._orders[(sort, descending)] = order
+            return self._orders[(sort, descending)]
+    
+    # Stat of an entry from the scan, following symlinks except broken ones.
+    # True return type is os.stat_result | None, but Python 3.9 doesn't
+    # support |
+    def get_stat(self, name: str) -> os.stat_result:
+        entry = self._dir_entries[name]
+        try:
+            return entry.stat()
+        except OSError:
+            # Broken symlink, or the entry was removed since
+            try:
+                return entry.stat(follow_symlinks=False)
+            except OSError:
+                return None
+    
+    def select(self, listing_query: dict) -> list:
+        entries = self._get_order(listing_query['sort'],
+            listing_query['order'] == 'desc')
         
-        # Determine if delete/mkdir should be enabled based on auth
-        has_auth = args.basic_auth or args.basic_auth_upload or args.client_certificate
+        name_filter = listing_query['filter'].lower()
+        if any(char in name_filter for char in '*?['):
+            match = re.compile(fnmatch.translate(name_filter)).match
+            entries = [entry for entry in entries if match(entry[3])]
+        elif name_filter:
+            entries = [entry for entry in entries
+                if entry[3].startswith(name_filter)]
+        return entries
+
+# An index is reused while the directory's inode and mtime are unchanged,
+# which covers entries being added, removed or renamed, and for at most
+# LISTING_INDEX_MAX_AGE seconds, since files changed in place don't touch the
+# directory's mtime but do change size and date order. Least recently used
+# indexes are dropped once the cached ones hold LISTING_INDEX_MAX_ENTRIES
+LISTING_INDEX_MAX_AGE = 30
+LISTING_INDEX_MAX_ENTRIES = 500000
+directory_indexes = collections.OrderedDict()
+directory_indexes_lock = threading.Lock()
+
+# scandir is an os.scandir() iterator for the directory, used if the index
+# has to be built, and closed either way
+# True argument type for path is str | pathlib.Path, but Python 3.9 doesn't
+# support |
+def get_directory_index(path: pathlib.Path, scandir: object = None,
+) -> DirectoryIndex:
+    path = os.fspath(path)
+    try:
+        stat = os.stat(path)
+        identity = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+        
+        with directory_indexes_lock:
+            index = directory_indexes.get(path)
+            if index is not None and index.identity == identity and \
+            time.monotonic() - index.created < LISTING_INDEX_MAX_AGE:
+                directory_indexes.move_to_end(path)
+                return index
+        
+        index = DirectoryIndex(path, identity, scandir or os.scandir(path))
+    finally:
+        if scandir is not None:
+            scandir.close()
+    
+    # A change in the same timestamp tick as the scan wouldn't change the
+    # mtime, so directories modified just now aren't cached. Same idea as
+    # git's "racily clean" index entries
+    if time.time() - stat.st_mtime < 1:
+        return index
+    
+    with directory_indexes_lock:
+        directory_indexes[path] = index
+        directory_indexes.move_to_end(path)
+        cached = sum(len(cached_index.entries) for cached_index in
+            directory_indexes.values())
+        while cached > LISTING_INDEX_MAX_ENTRIES and len(directory_indexes) > 1:
+            _, evicted = directory_indexes.popitem(last=False)
+            cached -= len(evicted.entries)
+    return index
+
+# Entries for one page of a listing, the number of matching entries and the
+# number of pages
+def get_listing_page(index: DirectoryIndex, listing_query: dict,
+) -> tuple[list, int, int]:
+    entries = index.select(listing_query)
+    limit = listing_query['limit']
+    start = (listing_query['page'] - 1) * limit
+    return (entries[start:start + limit], len(entries),
+        max(1, -(-len(entries) // limit)))
+
+# Sort links and filter box above the listing
+def render_listing_controls(listing_query: dict) -> str:
+    links = []
+    for sort, label in [('name', 'name'), ('size', 'size'), ('mtime', 'date')]:
+        if sort == listing_query['sort']:
+            ascending = listing_query['order'] == 'asc'
+            url = get_listing_url(listing_query, sort=sort, page=1,
+                order='desc' if ascending else 'asc')
+            label += ' &#9650;' if ascending else ' &#9660;'
+        else:
+            url = get_listing_url(listing_query, sort=sort, page=1,
+                order='asc')
+        links.append(f'<a href="{html.escape(url)}">{label}</a>')
+    
+    hidden = ''.join(f'<input type="hidden" name="{name}" '
+        f'value="{html.escape(str(listing_query[name]))}">'
+        for name in ('sort', 'order', 'limit')
+        if listing_query[name] != LISTING_DEFAULT_QUERY[name])
+    
+    return f'<form class="listing-controls" method="get">Sort by ' \
+        f'{" ".join(links)} <input type="search" name="filter" value="' \
+        f'{html.escape(listing_query["filter"])}" placeholder="Filter names ' \
+        f'(prefix or glob)">{hidden}</form>\n'
+
+# Links to the first, previous, next and last pages, if there is more than one
+def render_listing_pager(listing_query: dict, total: int, pages: int) -> str:
+    if pages <= 1:
+        return ''
+    
+    page = listing_query['page']
+    def link(label: str, target: int) -> str:
+        if target == page or not 1 <= target <= pages:
+            return f'<span>{label}</span>'
+        url = html.escape(get_listing_url(listing_query, page=target))
+        return f'<a href="{url}">{label}</a>'
+    
+    return f'<p class="pager">{link("&laquo; First", 1)} ' \
+        f'{link("&lsaquo; Previous", page - 1)} Page {page} of {pages} ' \
+        f'({total} entries) {link("Next &rsaquo;", page + 1)} ' \
+        f'{link("Last &raquo;", pages)}</p>\n'
+
+# Pieces of the directory listing page that don't depend on the directory,
+# built once per combination of theme, auth and timeout. The page is
+# before_title + title + between_titles + title + after_title + controls +
+# entries + tail
+LISTING_TEMPLATES = {}
+# Number of entries rendered into each chunk of a listing
+LISTING_BATCH_SIZE = 512
+
+# The arguments that change the listing page's injections
+def get_listing_template_key() -> tuple:
+    # Determine if delete/mkdir should be enabled based on auth
+    has_auth = bool(args.basic_auth or args.basic_auth_upload or
+        args.client_certificate)
+    return (args.theme, has_auth, args.timeout)
+
+def get_listing_template() -> tuple[bytes, bytes, bytes, bytes]:
+    key = get_listing_template_key()
+    if key not in LISTING_TEMPLATES:
+        theme, has_auth, _ = key
         enable_delete_js = b'<script>const ENABLE_DELETE = ' + \
             (b'true' if has_auth else b'false') + b';</script>'
-            
-        content = content.replace(b'<ul>', enable_delete_js + DIRECTORY_BODY_INJECTION + b'<ul>')
+        LISTING_TEMPLATES[key] = (
+            b'<!DOCTYPE HTML>\n<html lang="en">\n<head>\n<meta charset="' +
+                sys.getfilesystemencoding().encode() + b'">\n<title>',
+            b'</title>\n' + get_directory_head_injection(theme) +
+                b'</head>\n<body>\n<h1>',
+            b'</h1>\n<hr>\n' + enable_delete_js + DIRECTORY_BODY_INJECTION,
+            b'<hr>\n' + get_shutdown_timer_injection() +
+                b'</body>\n</html>\n',
+        )
+    return LISTING_TEMPLATES[key]
+
+# Rendered listing pages by weak ETag, so a directory that hasn't changed isn't
+# rendered again. Only name-sorted pages are cached: they depend on nothing but
+# the directory's entries, so its inode and mtime tell when they are stale.
+# Least recently used pages are dropped beyond LISTING_CACHE_MAX_BYTES, and
+# pages over LISTING_CACHE_MAX_PAGE aren't kept
+LISTING_CACHE_MAX_BYTES = 16 << 20
+LISTING_CACHE_MAX_PAGE = 1 << 20
+listing_cache = collections.OrderedDict()
+listing_cache_lock = threading.Lock()
+
+# Returns the weak ETag and Last-Modified date of a listing page, or None if
+# it can't be cached. True return type is tuple[str, str] | None, but Python
+# 3.9 doesn't support |
+# True argument type for path is str | pathlib.Path, but Python 3.9 doesn't
+# support |
+def get_listing_validators(path: pathlib.Path, url_path: str,
+listing_query: dict) -> tuple[str, str]:
+    if listing_query['sort'] != 'name':
+        return None
+    
+    stat = os.stat(path)
+    # Same "racily clean" rule as get_directory_index()
+    if time.time() - stat.st_mtime < 1:
+        return None
+    
+    key = (stat.st_dev, stat.st_ino, stat.st_mtime_ns,
+        get_listing_template_key(), sys.getfilesystemencoding(), url_path,
+        sorted(listing_query.items()))
+    digest = hashlib.blake2b(repr(key).encode('utf-8', 'surrogateescape'),
+        digest_size=12).hexdigest()
+    return (f'W/"{digest}"', email.utils.formatdate(stat.st_mtime,
+        usegmt=True))
+
+# True return type is bytes | None, but Python 3.9 doesn't support |
+def get_cached_listing(etag: str) -> bytes:
+    with listing_cache_lock:
+        page = listing_cache.get(etag)
+        if page is not None:
+            listing_cache.move_to_end(etag)
+        return page
+
+def cache_listing(etag: str, page: bytes):
+    if len(page) > LISTING_CACHE_MAX_PAGE:
+        return
+    
+    with listing_cache_lock:
+        listing_cache[etag] = page
+        listing_cache.move_to_end(etag)
+        cached = sum(len(cached_page) for cached_page in
+            listing_cache.values())
+        while cached > LISTING_CACHE_MAX_BYTES:
+            _, evicted = listing_cache.popitem(last=False)
+            cached -= len(evicted)
+
+# Compare an ETag against the list in an If-Match/If-None-Match header. Weak
+# comparison ignores the W/ prefix, strong comparison never matches a weak tag.
+# True argument type for etag is str | None, but Python 3.9 doesn't support |
+def etag_matches(header: str, etag: str, weak: bool = True) -> bool:
+    if etag is None:
+        return False
+    if header.strip() == '*':
+        return True
+    if not weak and etag.startswith('W/'):
+        return False
+    
+    opaque_tag = etag[2:] if etag.startswith('W/') else etag
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag == opaque_tag:
+            return True
+    return False
+
+# Streams a directory listing page, in the same format as
+# http.server.SimpleHTTPRequestHandler.list_directory() plus the injections and
+# listing controls. The head of the page goes out before the directory is
+# read, and entries follow in batches. Returned by list_directory() in place
+# of a file
+class DirectoryListing:
+    # True argument type for path is str | pathlib.Path, but Python 3.9
+    # doesn't support |
+    # The finished page is added to the listing cache if etag is given. True
+    # argument type for etag is str | None, but Python 3.9 doesn't support |
+    def __init__(self, path: pathlib.Path, url_path: str,
+    listing_query: dict, chunked: bool, etag: str = None):
+        self._path = path
+        self._etag = etag
+        self._recorded = []
+        # Opened here so a permission error can still become a 404
+        self._scandir = os.scandir(path)
+        self._listing_query = listing_query
+        self._chunked = chunked
+        self._encoding = sys.getfilesystemencoding()
         
-        # Inject shutdown timer if enabled (or warning if disabled)
-        content = content.replace(b'</body>', get_shutdown_timer_injection() + b'</body>')
+        try:
+            display_path = urllib.parse.unquote(url_path,
+                errors='surrogatepass')
+        except UnicodeDecodeError:
+            display_path = urllib.parse.unquote(url_path)
+        self._title = html.escape(f'Directory listing for {display_path}',
+            quote=False).encode(self._encoding, 'surrogateescape')
+    
+    def _write(self, outputfile, data: bytes):
+        if not data:
+            return
+        if self._etag:
+            self._recorded.append(data)
+        if self._chunked:
+            outputfile.write(b'%X\r\n%s\r\n' % (len(data), data))
+        else:
+            outputfile.write(data)
+    
+    def write_to(self, outputfile):
+        before_title, between_titles, after_title, tail = \
+            get_listing_template()
+        self._write(outputfile, before_title + self._title + between_titles +
+            self._title + after_title)
+        
+        index = get_directory_index(self._path, self._scandir)
+        entries, total, pages = get_listing_page(index, self._listing_query)
+        pager = render_listing_pager(self._listing_query, total, pages)
+        self._write(outputfile, (render_listing_controls(self._listing_query)
+            + pager + '<ul>\n').encode(self._encoding, 'surrogateescape'))
+        
+        for i in range(0, len(entries), LISTING_BATCH_SIZE):
+            lines = []
+            for name, is_dir, is_link, _ in entries[i:i + LISTING_BATCH_SIZE]:
+                # Append / for directories or @ for symbolic links. A link to
+                # a directory displays with @ and links with /
+                link_name = name + '/' if is_dir else name
+                display_name = name + '@' if is_link else link_name
+                lines.append('<li><a href="%s">%s</a></li>\n' % (
+                    urllib.parse.quote(link_name, errors='surrogatepass'),
+                    html.escape(display_name, quote=False)))
+            self._write(outputfile, ''.join(lines).encode(self._encoding,
+                'surrogateescape'))
         
-        outputfile.write(content)
+        self._write(outputfile, ('</ul>\n' + pager).encode(self._encoding,
+            'surrogateescape') + tail)
+        # Cached before the response ends, so a client's next request for the
+        # page is sure to find it
+        if self._etag:
+            cache_listing(self._etag, b''.join(self._recorded))
+        
+        if self._chunked:
+            outputfile.write(b'0\r\n\r\n')
     
+    def close(self):
+        self._scandir.close()
+
+# Let's not inherit http.server.SimpleHTTPRequestHandler - that would cause
+# diamond-pattern inheritance
+class ListDirectoryInterception:
+    # Same contract as the stdlib version: headers are sent, and the return
+    # value is sent with copyfile() unless it is None
     # True argument type is str | pathlib.Path, but Python 3.9 doesn't support |
     def list_directory(self, path: pathlib.Path) -> object:
-        setattr(self, 'flush_headers', self.flush_headers_interceptor)
-        setattr(self, 'copyfile', self.copyfile_interceptor)
+        self.route = 'listing'
+        listing_query = parse_listing_query(self.path)
+        if listing_query is None:
+            self.send_error(http.HTTPStatus.BAD_REQUEST,
+                'Invalid listing parameters')
+            return None
+        
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        if query.get('format') == ['json']:
+            return self.send_directory_json(path, listing_query)
         
-        # Can't use super() - avoiding diamond-pattern inheritance'
-        return http.server.SimpleHTTPRequestHandler.list_directory(self, path)
+        url_path = urllib.parse.urlsplit(self.path).path
+        try:
+            validators = get_listing_validators(path, url_path, listing_query)
+        except OSError:
+            self.send_error(http.HTTPStatus.NOT_FOUND, 'No permission to list '
+                'directory')
+            return None
+        etag = validators[0] if validators else None
+        
+        if etag and etag_matches(self.headers.get('If-None-Match', ''), etag):
+            self.send_response(http.HTTPStatus.NOT_MODIFIED)
+            self.send_listing_validators(validators)
+            self.end_headers()
+            return None
+        
+        page = get_cached_listing(etag) if etag else None
+        if page is not None:
+            self.send_response(http.HTTPStatus.OK)
+            self.send_header('Content-type',
+                f'text/html; charset={sys.getfilesystemencoding()}')
+            self.send_header('Content-Length', str(len(page)))
+            self.send_listing_validators(validators)
+            self.end_headers()
+            return io.BytesIO(page)
+        
+        # The length isn't known until the directory has been read, so the
+        # page is sent chunked, or delimited by closing the connection for
+        # HTTP/1.0 clients
+        chunked = self.request_version != 'HTTP/1.0'
+        try:
+            listing = DirectoryListing(path, url_path, listing_query, chunked,
+                etag)
+        except OSError:
+            self.send_error(http.HTTPStatus.NOT_FOUND, 'No permission to list '
+                'directory')
+            return None
+        
+        self.send_response(http.HTTPStatus.OK)
+        self.send_header('Content-type',
+            f'text/html; charset={sys.getfilesystemencoding()}')
+        self.send_listing_validators(validators)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        return listing
+    
+    # True argument type is tuple[str, str] | None, but Python 3.9 doesn't
+    # support |
+    def send_listing_validators(self, validators: tuple[str, str]):
+        if validators:
+            self.send_header('ETag', validators[0])
+            self.send_header('Last-Modified', validators[1])
+        # Listings change without their URL changing, so browsers must
+        # revalidate instead of guessing a freshness lifetime from
+        # Last-Modified
+        self.send_header('Cache-Control', 'no-cache')
+    
+    # Metadata of a page of entries in one response, so the listing page
+    # doesn't need a HEAD request per entry
+    def send_directory_json(self, path: pathlib.Path, listing_query: dict,
+    ) -> object:
+        try:
+            index = get_directory_index(path)
+        except OSError:
+            self.send_error(http.HTTPStatus.NOT_FOUND, 'No permission to list '
+                'directory')
+            return None
+        entries, total, pages = get_listing_page(index, listing_query)
+        
+        body = json.dumps({
+            'path': urllib.parse.unquote(urllib.parse.urlsplit(self.path).path,
+                errors='surrogatepass'),
+            'page': listing_query['page'],
+            'pages': pages,
+            'limit': listing_query['limit'],
+            'total': total,
+            'entries': [describe_entry(index, name, is_dir)
+                for name, is_dir, _, _ in entries],
+        }).encode('utf-8')
+        
+        self.send_response(http.HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        return io.BytesIO(body)
+
+# One entry as sent by ?format=json. href is the link the HTML listing uses for
+# the entry, size is None for directories, and mtime is in seconds since the
+# epoch. Stats come from the index's scan, so like its size and date order
+# they may be up to LISTING_INDEX_MAX_AGE old
+def describe_entry(index: DirectoryIndex, name: str, is_dir: bool) -> dict:
+    stat = index.get_stat(name)
+    return {
+        'name': name,
+        'href': urllib.parse.quote(name + '/' if is_dir else name,
+            errors='surrogatepass'),
+        'type': 'directory' if is_dir else 'file',
+        'size': None if is_dir or stat is None else stat.st_size,
+        'mtime': None if stat is None else stat.st_mtime,
+    }
+
+# Most byte ranges served for one request. Beyond this the Range header is
+# ignored, so a client can't turn one request into thousands of tiny sends
+MAX_BYTE_RANGES = 64
+BYTE_RANGE_PATTERN = re.compile(r'(\d*)-(\d*)')
+
+# Parse a Range header into (offset, count) pairs. Returns None if the header
+# should be ignored, and an empty list if no range can be satisfied. True
+# return type is list[tuple[int, int]] | None, but Python 3.9 doesn't support |
+def parse_byte_ranges(header: str, size: int) -> list:
+    unit, sep, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not sep:
+        return None
+    
+    specs = [spec.strip() for spec in specs.split(',') if spec.strip()]
+    if not specs or len(specs) > MAX_BYTE_RANGES:
+        return None
+    
+    ranges = []
+    for spec in specs:
+        match = BYTE_RANGE_PATTERN.fullmatch(spec)
+        if not match or match.group(1) == match.group(2) == '':
+            return None
+        first, last = match.groups()
+        
+        if first == '':
+            # Suffix range: the last N bytes
+            start = max(size - int(last), 0)
+            end = size - 1 if int(last) else -1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if end < start:
+                return None
+            end = min(end, size - 1)
+        
+        if start <= end:
+            ranges.append((start, end - start + 1))
+    return ranges
+
+# socket.sendfile() lets the kernel copy file data straight to the socket.
+# TLS sockets need the data in userspace to encrypt it, so they can't use it
+def can_sendfile(handler: http.server.BaseHTTPRequestHandler, source: object,
+) -> bool:
+    if isinstance(handler.connection, aio.Channel):
+        plain_tcp = not handler.connection.is_tls
+    else:
+        plain_tcp = isinstance(handler.connection, socket.socket) and \
+            not isinstance(handler.connection, ssl.SSLSocket)
+    return plain_tcp and hasattr(os, 'sendfile') and hasattr(source, 'fileno')
 
-class SimpleHTTPRequestHandler(ListDirectoryInterception,
-    http.server.SimpleHTTPRequestHandler):
+# Strong ETag of a file. Uploads are written to a new file and renamed into
+# place, so each one gets a new inode even within one timestamp tick
+def get_file_etag(stat: os.stat_result) -> str:
+    return f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+# Same parsing as the stdlib's If-Modified-Since handling. True return type is
+# float | None, but Python 3.9 doesn't support |
+def parse_http_date(value: str) -> float:
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, IndexError, OverflowError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    if date.tzinfo is not datetime.timezone.utc:
+        return None
+    return date.timestamp()
+
+# Evaluate If-Match, If-Unmodified-Since, If-None-Match and If-Modified-Since
+# in the order RFC 9110 section 13.2.2 gives. stat is the target's, or None if
+# it doesn't exist, and etag is its ETag, if it has one. Returns the status to
+# answer with instead of going ahead with the request (412, or 304 for GET and
+# HEAD), or None. True return type is http.HTTPStatus | None, and etag is
+# str | None, but Python 3.9 doesn't support |
+def evaluate_preconditions(handler: http.server.BaseHTTPRequestHandler,
+stat: os.stat_result, etag: str) -> http.HTTPStatus:
+    headers = handler.headers
+    # Dates in headers have whole seconds
+    mtime = int(stat.st_mtime) if stat else None
+    
+    if 'If-Match' in headers:
+        if stat is None or (headers['If-Match'].strip() != '*' and
+        not etag_matches(headers['If-Match'], etag, weak=False)):
+            return http.HTTPStatus.PRECONDITION_FAILED
+    elif 'If-Unmodified-Since' in headers and stat:
+        date = parse_http_date(headers['If-Unmodified-Since'])
+        if date is not None and mtime > date:
+            return http.HTTPStatus.PRECONDITION_FAILED
+    
+    if 'If-None-Match' in headers:
+        if stat and (headers['If-None-Match'].strip() == '*' or
+        etag_matches(headers['If-None-Match'], etag)):
+            return http.HTTPStatus.NOT_MODIFIED \
+                if handler.command in ('GET', 'HEAD') \
+                else http.HTTPStatus.PRECONDITION_FAILED
+    elif 'If-Modified-Since' in headers and stat and \
+    handler.command in ('GET', 'HEAD'):
+        date = parse_http_date(headers['If-Modified-Since'])
+        if date is not None and mtime <= date:
+            return http.HTTPStatus.NOT_MODIFIED
+    
+    return None
+
+# evaluate_preconditions() for a path that is a file, a directory (which has no
+# ETag) or nothing. True return type is http.HTTPStatus | None, but Python 3.9
+# doesn't support |
+# True argument type is str | pathlib.Path, but Python 3.9 doesn't support |
+def evaluate_file_preconditions(handler: http.server.BaseHTTPRequestHandler,
+path: pathlib.Path) -> http.HTTPStatus:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return evaluate_preconditions(handler, None, None)
+    return evaluate_preconditions(handler, stat,
+        get_file_etag(stat) if os.path.isfile(path) else None)
+
+# File downloads with Range support. Not a subclass of
+# http.server.SimpleHTTPRequestHandler, same as ListDirectoryInterception
+class FileDownloads:
+    # Same as the stdlib version for directories. Files get Range support
+    def send_head(self):
+        self.byte_ranges = None
+        
+        path = self.translate_path(self.path)
+        if is_upload_spool_path(path):
+            self.send_error(http.HTTPStatus.NOT_FOUND, 'File not found')
+            return None
+        if os.path.isdir(path) or path.endswith('/'):
+            return http.server.SimpleHTTPRequestHandler.send_head(self)
+        
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(http.HTTPStatus.NOT_FOUND, 'File not found')
+            return None
+        
+        try:
+            return self.send_file_head(path, f)
+        except:
+            f.close()
+            raise
+    
+    # True return type is io.BufferedReader | None, but Python 3.9 doesn't
+    # support |
+    def send_file_head(self, path: str, f: object) -> object:
+        fs = os.fstat(f.fileno())
+        last_modified = self.date_time_string(fs.st_mtime)
+        etag = get_file_etag(fs)
+        
+        status = evaluate_preconditions(self, fs, etag)
+        if status == http.HTTPStatus.NOT_MODIFIED:
+            f.close()
+            self.send_response(status)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            return None
+        if status is not None:
+            f.close()
+            self.send_error(status)
+            return None
+        
+        ctype = self.guess_type(path)
+        size = fs.st_size
+        
+        ranges = None
+        if 'Range' in self.headers and size > 0 and \
+        self.if_range_matches(etag, last_modified):
+            ranges = parse_byte_ranges(self.headers['Range'], size)
+        
+        if ranges == []:
+            f.close()
+            self.send_response(http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        
+        if ranges is None:
+            self.send_response(http.HTTPStatus.OK)
+            self.send_header('Content-type', ctype)
+            self.send_header('Content-Length', str(size))
+        elif len(ranges) == 1:
+            offset, count = ranges[0]
+            self.send_response(http.HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Content-type', ctype)
+            self.send_header('Content-Range',
+                f'bytes {offset}-{offset + count - 1}/{size}')
+            self.send_header('Content-Length', str(count))
+            self.byte_ranges = ranges
+        else:
+            # multipart/byteranges: each range gets its own part headers
+            boundary = secrets.token_hex(16)
+            self.byte_ranges = [(f'\r\n--{boundary}\r\nContent-Type: {ctype}'
+                f'\r\nContent-Range: bytes {offset}-{offset + count - 1}/'
+                f'{size}\r\n\r\n'.encode('latin-1'), offset, count)
+                for offset, count in ranges]
+            self.byte_ranges_end = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+            length = len(self.byte_ranges_end) + sum(len(part_head) + count
+                for part_head, _, count in self.byte_ranges)
+            
+            self.send_response(http.HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Content-type',
+                f'multipart/byteranges; boundary={boundary}')
+            self.send_header('Content-Length', str(length))
+        
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        return f
+    
+    # If-Range makes a Range request conditional on the file being unchanged,
+    # given either its ETag (compared strongly) or its Last-Modified date
+    def if_range_matches(self, etag: str, last_modified: str) -> bool:
+        if_range = self.headers.get('If-Range')
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith(('"', 'W/"')):
+            return etag_matches(if_range, etag, weak=False)
+        return if_range == last_modified
+    
+    def copyfile(self, source, outputfile):
+        if isinstance(source, DirectoryListing):
+            source.write_to(outputfile)
+        elif not self.byte_ranges:
+            self.send_file_range(source, outputfile, 0, None)
+        elif len(self.byte_ranges) == 1:
+            self.send_file_range(source, outputfile, *self.byte_ranges[0])
+        else:
+            for part_head, offset, count in self.byte_ranges:
+                outputfile.write(part_head)
+                self.send_file_range(source, outputfile, offset, count)
+            outputfile.write(self.byte_ranges_end)
+    
+    # True argument type for count is int | None (None means to end of file),
+    # but Python 3.9 doesn't support |
+    def send_file_range(self, source, outputfile, offset: int, count: int):
+        if can_sendfile(self, source):
+            sent = self.connection.sendfile(source, offset, count)
+            if isinstance(outputfile, CountingWriter):
+                outputfile.bytes_written += sent
+            return
+        
+        source.seek(offset)
+        if count is None:
+            shutil.copyfileobj(source, outputfile)
+            return
+        while count > 0:
+            data = source.read(min(count, BODY_CHUNK_SIZE))
+            if not data:
+                break
+            outputfile.write(data)
+            count -= len(data)
+
+class SimpleHTTPRequestHandler(PersistentConnections, FileDownloads,
+    ListDirectoryInterception, http.server.SimpleHTTPRequestHandler):
     def do_GET(self):
         if not check_http_authentication(self): return
         
         if self.path == '/upload':
             send_upload_page(self)
+        elif is_metrics_path(self.path):
+            send_metrics(self)
         else:
             super().do_GET()
     
+    def do_HEAD(self):
+        if not check_http_authentication(self): return
+        
+        if is_session_path(self.path):
+            send_result(self, receive_session_head(self))
+        else:
+            # Can't use super() - CGIHTTPRequestHandler reuses this method
+            http.server.SimpleHTTPRequestHandler.do_HEAD(self)
+    
     def do_POST(self):
         if not check_http_authentication(self): return
         
@@ -782,25 +3598,45 @@ class SimpleHTTPRequestHandler(ListDirectoryInterception,
             result = receive_upload(self)
         elif self.path == '/mkdir':
             result = receive_mkdir(self)
+        elif self.path == UPLOAD_SESSIONS_PATH:
+            result = receive_session_create(self)
         else:
             self.send_error(http.HTTPStatus.NOT_FOUND,
                 'Can only POST/PUT to /upload or /mkdir')
             return
 
-        if result[0] < http.HTTPStatus.BAD_REQUEST:
-            self.send_response(result[0], result[1])
-            self.end_headers()
+        send_result(self, result)
+    
+    def do_PATCH(self):
+        if not check_http_authentication(self): return
+        
+        if is_session_path(self.path):
+            send_result(self, receive_session_patch(self))
         else:
-            self.send_error(result[0], result[1])
+            self.send_error(http.HTTPStatus.NOT_FOUND,
+                'Can only PATCH upload sessions')
     
     def do_PUT(self):
-        self.do_POST()
+        if self.path in ('/upload', '/mkdir'):
+            self.do_POST()
+            return
+        
+        if not check_http_authentication(self): return
+        
+        send_result(self, receive_put(self))
 
     def do_DELETE(self):
         if not check_http_authentication(self): return
         
+        if is_session_path(self.path):
+            send_result(self, receive_session_delete(self))
+            return
+        
         # Security: Prevent directory traversal
         target_path = self.translate_path(self.path)
+        if is_upload_spool_path(target_path):
+            self.send_error(http.HTTPStatus.NOT_FOUND, "File not found")
+            return
         
         # Ensure target is within the served directory
         server_root = pathlib.Path(args.directory).resolve()
@@ -815,12 +3651,25 @@ class SimpleHTTPRequestHandler(ListDirectoryInterception,
 
         if os.path.isfile(target_path):
             try:
-                os.remove(target_path)
-                self.send_response(http.HTTPStatus.NO_CONTENT)
-                self.end_headers()
+                # If-Match and friends are checked together with the removal,
+                # so a conditional PUT can't slip in between
+                with commit_lock:
+                    status = evaluate_file_preconditions(self, target_path)
+                    if status is None:
+                        os.remove(target_path)
             except OSError:
                 self.send_error(http.HTTPStatus.INTERNAL_SERVER_ERROR, "Failed to delete file")
+                return
+            if status is not None:
+                self.send_error(status, "Precondition failed")
+                return
+            self.send_response(http.HTTPStatus.NO_CONTENT)
+            self.end_headers()
         elif os.path.isdir(target_path):
+            status = evaluate_file_preconditions(self, target_path)
+            if status is not None:
+                self.send_error(status, "Precondition failed")
+                return
             try:
                 shutil.rmtree(target_path)
                 self.send_response(http.HTTPStatus.NO_CONTENT)
@@ -830,12 +3679,23 @@ class SimpleHTTPRequestHandler(ListDirectoryInterception,
         else:
             self.send_error(http.HTTPStatus.NOT_FOUND, "File not found")
 
-class CGIHTTPRequestHandler(ListDirectoryInterception,
-    http.server.CGIHTTPRequestHandler):
+class CGIHTTPRequestHandler(PersistentConnections, FileDownloads,
+    ListDirectoryInterception, http.server.CGIHTTPRequestHandler):
+    def send_head(self):
+        if self.is_cgi():
+            # Script output has no Content-Length, it ends when the connection
+            # closes
+            self.close_connection = True
+            return self.run_cgi()
+        return FileDownloads.send_head(self)
+    
     def do_GET(self):
         if not check_http_authentication(self): return
         
-        super().do_GET()
+        if is_metrics_path(self.path):
+            send_metrics(self)
+        else:
+            super().do_GET()
     
     def do_POST(self):
         if not check_http_authentication(self): return
@@ -844,22 +3704,29 @@ class CGIHTTPRequestHandler(ListDirectoryInterception,
             result = receive_upload(self)
         elif self.path == '/mkdir':
              result = receive_mkdir(self)
+        elif self.path == UPLOAD_SESSIONS_PATH:
+            result = receive_session_create(self)
         else:
             super().do_POST()
             return
             
-        if result[0] < http.HTTPStatus.BAD_REQUEST:
-            self.send_response(result[0], result[1])
-            self.end_headers()
-        else:
-            self.send_error(result[0], result[1])
+        send_result(self, result)
 
     def do_DELETE(self):
         # reuse the implementation from SimpleHTTPRequestHandler (safe since we check args.directory)
         SimpleHTTPRequestHandler.do_DELETE(self)
     
     def do_PUT(self):
-        self.do_POST()
+        SimpleHTTPRequestHandler.do_PUT(self)
+    
+    def do_HEAD(self):
+        SimpleHTTPRequestHandler.do_HEAD(self)
+    
+    def do_PATCH(self):
+        SimpleHTTPRequestHandler.do_PATCH(self)
+
+class AsyncioHTTPRequestHandler(AsyncioRequests, SimpleHTTPRequestHandler):
+    pass
 
 def intercept_first_print():
     if args.server_certificate:
@@ -871,8 +3738,53 @@ def intercept_first_print():
             builtins.print = old_print
         builtins.print = new_print
 
-def ssl_wrap(socket: socket.socket) -> ssl.SSLSocket:
+TLS_HANDSHAKES = metrics.Counter('updownserver_tls_handshakes_total',
+    'TLS handshakes completed, by whether an earlier session was resumed')
+TLS_HANDSHAKE_FAILURES = metrics.Counter(
+    'updownserver_tls_handshake_failures_total',
+    'TLS handshakes that failed or timed out')
+TLS_HANDSHAKE_FAILURES.inc(0)
+TLS_HANDSHAKE_SECONDS = metrics.Histogram('updownserver_tls_handshake_seconds',
+    'Time from the start of the TLS handshake until it completed')
+
+# Records every handshake done with the context from get_ssl_context(). The
+# threading engine uses SSLSocket, asyncio uses SSLObject, and both call
+# do_handshake() until it stops raising SSLWantReadError or SSLWantWriteError.
+# Handshakes the asyncio engine gives up on at its timeout never fail in
+# do_handshake(), so they aren't counted
+class MeasuredHandshake:
+    handshake_started = None
+    
+    def do_handshake(self, *arguments):
+        if self.handshake_started is None:
+            self.handshake_started = time.perf_counter()
+        try:
+            super().do_handshake(*arguments)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            raise
+        except Exception:
+            TLS_HANDSHAKE_FAILURES.inc()
+            raise
+        
+        TLS_HANDSHAKE_SECONDS.observe(time.perf_counter() -
+            self.handshake_started)
+        TLS_HANDSHAKES.inc(resumed=str(self.session_reused).lower())
+
+class MeasuredSSLSocket(MeasuredHandshake, ssl.SSLSocket):
+    pass
+
+class MeasuredSSLObject(MeasuredHandshake, ssl.SSLObject):
+    pass
+
+def get_ssl_context() -> ssl.SSLContext:
     context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.sslsocket_class = MeasuredSSLSocket
+    context.sslobject_class = MeasuredSSLObject
+    
+    # OpenSSL's defaults already let returning clients resume their session
+    # instead of doing a full handshake, by session ID or by session ticket.
+    # The ticket keys belong to the context, which --workers creates before
+    # forking, so any worker can resume a session another one started
     server_root = pathlib.Path(args.directory).resolve()
     
     # Server certificate handling
@@ -913,11 +3825,85 @@ def ssl_wrap(socket: socket.socket) -> ssl.SSLSocket:
         context.load_verify_locations(cafile=client_certificate)
         context.verify_mode = ssl.CERT_REQUIRED
     
+    return context
+
+# Process IDs of the --workers processes, in the process that forked them
+worker_pids = []
+
+# Fork --workers processes that each run serve() on the listening socket they
+# inherit from this one. Workers killed by a signal are replaced. Returns once
+# all of them have exited
+def run_workers(serve):
+    parent = os.getpid()
+    
+    def fork_worker():
+        pid = os.fork()
+        if pid:
+            worker_pids.append(pid)
+            return
+        
+        signal.signal(signal.SIGTERM, flush_and_terminate)
+        # Don't outlive a parent that was killed without stopping the workers
+        def watch_parent():
+            while os.getppid() == parent:
+                time.sleep(1)
+            os._exit(0)
+        threading.Thread(target=watch_parent, daemon=True).start()
+        
+        code = 1
+        try:
+            serve()
+            code = 0
+        except KeyboardInterrupt:
+            code = 0
+        except SystemExit as e:
+            code = e.code if type(e.code) is int else 1
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            if access_log:
+                access_log.close()
+            remove_spools()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+    
+    # Turn SIGTERM into SystemExit, so the workers are stopped on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
-        return context.wrap_socket(socket, server_side=True)
-    except ssl.SSLError as e:
-        print('SSL error: "{}", exiting'.format(e))
-        sys.exit(5)
+        for _ in range(args.workers):
+            fork_worker()
+        
+        while worker_pids:
+            pid, status = os.wait()
+            worker_pids.remove(pid)
+            if os.WIFSIGNALED(status):
+                print(f'[Workers] Worker {pid} killed by signal '
+                    f'{os.WTERMSIG(status)}, restarting')
+                remove_stale_upload_spools()
+                fork_worker()
+    finally:
+        stop_workers()
+
+def stop_workers():
+    for pid in worker_pids:
+        with contextlib.suppress(ProcessLookupError):
+            os.kill(pid, signal.SIGTERM)
+    for pid in worker_pids:
+        with contextlib.suppress(ChildProcessError):
+            os.waitpid(pid, 0)
+    worker_pids.clear()
+
+# Auto-shutdown. With --workers only the parent process runs the timer, and
+# takes the workers down with it
+def shutdown_now():
+    for pid in worker_pids:
+        with contextlib.suppress(ProcessLookupError):
+            os.kill(pid, signal.SIGTERM)
+    if access_log:
+        access_log.close()
+    remove_spools()
+    os._exit(0)
 
 def serve_forever():
     # Verify arguments in case the method was called directly
@@ -931,8 +3917,34 @@ def serve_forever():
     assert hasattr(args, 'basic_auth')
     assert hasattr(args, 'basic_auth_upload')
     assert hasattr(args, 'directory') and type(args.directory) is str
+    assert hasattr(args, 'spool_dir')
+    assert hasattr(args, 'keep_alive_timeout')
+    assert hasattr(args, 'max_requests') and type(args.max_requests) is int
+    assert hasattr(args, 'engine') and args.engine in ('threading', 'asyncio')
+    assert hasattr(args, 'threads') and type(args.threads) is int
+    assert hasattr(args, 'max_connections') and \
+        type(args.max_connections) is int
+    assert hasattr(args, 'max_uploads') and type(args.max_uploads) is int
+    assert hasattr(args, 'workers') and type(args.workers) is int
+    assert hasattr(args, 'metrics') and type(args.metrics) is bool
+    assert hasattr(args, 'server_timing') and type(args.server_timing) is bool
+    assert hasattr(args, 'profile_every') and type(args.profile_every) is int
+    assert hasattr(args, 'profile_dir')
+    assert hasattr(args, 'access_log')
+    
+    if args.workers > 1 and not hasattr(os, 'fork'):
+        print('--workers needs os.fork(), which this platform lacks, exiting')
+        sys.exit(2)
     
-    if args.cgi:
+    if args.cgi and args.engine == 'asyncio':
+        # CGI scripts are run with the connection as their stdin and stdout
+        print('CGI is not supported by the asyncio engine, exiting')
+        sys.exit(2)
+    
+    if args.engine == 'asyncio':
+        handler_class = functools.partial(AsyncioHTTPRequestHandler,
+            directory=args.directory)
+    elif args.cgi:
         handler_class = CGIHTTPRequestHandler
     else:
         handler_class = functools.partial(SimpleHTTPRequestHandler,
@@ -940,7 +3952,58 @@ def serve_forever():
     
     print('File upload available at /upload')
     
-    class DualStackServer(http.server.ThreadingHTTPServer):
+    for spool_dir in args.spool_dir or []:
+        try:
+            pathlib.Path(spool_dir).mkdir(mode=0o700, parents=True,
+                exist_ok=True)
+            problem = check_spool_dir(pathlib.Path(spool_dir))
+        except OSError as e:
+            problem = f'cannot be created: {e.strerror}'
+        if problem:
+            print(f'Spool directory "{spool_dir}" {problem}, exiting')
+            sys.exit(3)
+    
+    server_root = pathlib.Path(args.directory).resolve()
+    for spool_dir in get_spool_dirs():
+        if server_root == spool_dir or server_root in spool_dir.parents:
+            if args.spool_dir:
+                print(f'Spool directory "{spool_dir}" is inside web server '
+                    f'root "{server_root}", exiting')
+                sys.exit(3)
+            print(f'[Warning] Spool directory "{spool_dir}" is inside web '
+                'server root, unfinished resumable uploads will be visible. '
+                'Use --spool-dir to move it.')
+    
+    removed = clean_spools()
+    if removed:
+        print(f'[Spool] Removed {removed} abandoned upload(s)')
+    
+    if args.access_log:
+        open_access_log()
+        atexit.register(access_log.close)
+    signal.signal(signal.SIGTERM, flush_and_terminate)
+    
+    # Profiles show the server's code paths and the paths of served files
+    profile_dir = get_profile_dir()
+    if args.profile_every and (server_root == profile_dir or
+    server_root in profile_dir.parents):
+        print(f'Profile directory "{profile_dir}" is inside web server root '
+            f'"{server_root}", exiting')
+        sys.exit(3)
+    
+    if args.engine == 'asyncio':
+        base_server_class = aio.AsyncioHTTPServer
+    else:
+        base_server_class = PooledHTTPServer
+    
+    class DualStackServer(base_server_class):
+        request_queue_size = LISTEN_BACKLOG
+        keep_alive_timeout = args.keep_alive_timeout
+        threads = args.threads
+        max_connections = args.max_connections
+        busy_response = BUSY_RESPONSE
+        handshake_timeout = TLS_HANDSHAKE_TIMEOUT
+        
         def server_bind(self):
             # suppress exception when protocol is IPv4
             with contextlib.suppress(Exception):
@@ -948,8 +4011,29 @@ def serve_forever():
                     socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
             bind = super().server_bind()
             if args.server_certificate:
-                self.socket = ssl_wrap(self.socket)
+                # Handshakes are done per connection, by a pool worker or the
+                # event loop, never by the accept loop
+                self.ssl_context = get_ssl_context()
             return bind
+        
+        def serve_forever(self, poll_interval: float = 0.5):
+            # Threads don't survive fork(), so the access log writer and the
+            # spool sweeper are started in each process that serves
+            def serve():
+                if access_log:
+                    access_log.start()
+                threading.Thread(target=run_spool_sweeper, daemon=True,
+                    name='updownserver-spool-sweeper').start()
+                super(DualStackServer, self).serve_forever(poll_interval)
+            
+            if args.workers <= 1:
+                serve()
+                return
+            
+            # All workers wait on the shared socket. The ones that lose the
+            # race for a connection must not block in accept()
+            self.socket.setblocking(False)
+            run_workers(serve)
     server_class = DualStackServer
     
     # Enforce safety: If no authentication is configured, prevent infinite run
@@ -965,12 +4049,15 @@ def serve_forever():
              print(f'[Auto-Shutdown] Pass --timeout 0 to disable this behavior.\n')
         else:
              print(f'[Auto-Shutdown] Authentication required to disable auto-shutdown.\n')
-        shutdown_timer = threading.Timer(args.timeout, lambda: os._exit(0))
+        shutdown_timer = threading.Timer(args.timeout, shutdown_now)
         shutdown_timer.daemon = True
         shutdown_timer.start()
     else:
         print(f'\n[Auto-Shutdown] Disabled. Server will run indefinitely.\n')
 
+    if args.workers > 1:
+        print(f'[Workers] Serving from {args.workers} processes\n')
+    
     if args.qr:
         print_qr_codes()
         
@@ -978,6 +4065,7 @@ def serve_forever():
     http.server.test(
         HandlerClass=handler_class,
         ServerClass=server_class,
+        protocol='HTTP/1.1',
         port=args.port,
         bind=args.bind,
     )
@@ -1100,6 +4188,65 @@ def main():
         'uploads)')
     parser.add_argument('--basic-auth-upload',
         help='Specify user:pass for basic authentication (uploads only)')
+    parser.add_argument('--spool-dir', metavar='DIRECTORY', action='append',
+        help='Specify directory for resumable upload sessions and upload temp '
+        'files. Repeat for more filesystems, uploads are spooled on their '
+        'destination\'s one. Must be mode 0700 and owned by this user '
+        '[default: a new private directory in the system temp directory, '
+        'removed on exit]')
+    parser.add_argument('--keep-alive-timeout', type=float, default=15,
+        metavar='SECONDS',
+        help='Close idle keep-alive connections after N seconds (0 to disable '
+        'keep-alive) [default: 15]')
+    parser.add_argument('--max-requests', type=int, default=100,
+        metavar='N',
+        help='Close keep-alive connections after N requests [default: 100]')
+    parser.add_argument('--threads', type=int, default=64, metavar='N',
+        help='Handle at most N requests at a time [default: 64]')
+    parser.add_argument('--max-connections', type=int, default=1024,
+        metavar='N',
+        help='Answer connections past N open ones, including those waiting '
+        'for a thread, with 503 [default: 1024]')
+    parser.add_argument('--max-uploads', type=int, default=32, metavar='N',
+        help='Answer uploads past N at a time with 503 [default: 32]')
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+        help='Serve from N processes, each with its own threads and limits '
+        '[default: 1]')
+    parser.add_argument('--metrics', action='store_true',
+        help='Serve request, upload and TLS metrics at /metrics, in the '
+        'Prometheus text format')
+    parser.add_argument('--server-timing', action='store_true',
+        help='Report how long each phase of a request took in a '
+        'Server-Timing header and in the log')
+    parser.add_argument('--profile-every', type=int, default=0, metavar='N',
+        help='Profile every Nth request with cProfile (0 to disable) '
+        '[default: 0]')
+    parser.add_argument('--profile-dir', metavar='DIRECTORY',
+        help='Specify directory for --profile-every profiles [default: '
+        'updownserver-profiles in the system temp directory]')
+    parser.add_argument('--access-log', metavar='FILE',
+        help='Write a JSON line per request to FILE (- for stderr) from a '
+        'background thread, instead of the request log on stderr')
+    parser.add_argument('--access-log-buffer', type=int, default=10000,
+        metavar='N',
+        help='Drop access log records past N waiting to be written '
+        '[default: 10000]')
+    parser.add_argument('--access-log-batch', type=int, default=100,
+        metavar='N',
+        help='Write access log records N at a time [default: 100]')
+    parser.add_argument('--access-log-flush', type=float, default=1,
+        metavar='SECONDS',
+        help='Write access log records at most N seconds after they were '
+        'logged [default: 1]')
+    parser.add_argument('--access-log-max-bytes', type=int, default=0,
+        metavar='N',
+        help='Rotate the access log file once it reaches N bytes, keeping 5 '
+        'old files (0 to disable) [default: 0]')
+    parser.add_argument('--engine', default='threading',
+        choices=['threading', 'asyncio'],
+        help='Keep a thread per open connection, or wait for requests on an '
+        'asyncio event loop and only take a thread to handle them [default: '
+        'threading]')
     parser.add_argument('--timeout', type=int, default=300,
         help='Auto-shutdown server after N seconds (0 to disable) [default: 300]')
     parser.add_argument('--qr', action='store_true',
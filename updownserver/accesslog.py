@@ -0,0 +1,174 @@
+# Buffered JSON-lines access log, written by one background thread.
+#
+# Request threads only put a dict on a bounded queue. The writer thread turns
+# records into JSON and writes them in batches, so a slow stderr pipe or disk
+# holds up the writer instead of the requests. When the queue is full, records
+# are dropped and counted rather than waiting for room, and the writer logs how
+# many were lost.
+#
+# Several processes (--workers) can share one file: batches are written with a
+# single write() in append mode, and rotation is done under an flock() on the
+# file being rotated, so only one process rotates it. The others notice the
+# file was renamed and reopen it.
+#
+# Nothing in this module depends on the server's global arguments.
+
+import json, os, queue, sys, threading, time
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+class AccessLog:
+    # path '-' means stderr. Records are written once batch_size of them are
+    # waiting or the oldest has waited flush_interval seconds. With
+    # max_bytes, the file is rotated to path.1, path.2 ... path.<backups>
+    # once it grows past that size
+    def __init__(self, path: str, buffer_size: int = 10000,
+    batch_size: int = 100, flush_interval: float = 1.0, max_bytes: int = 0,
+    backups: int = 5):
+        self.path = path
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._queue = queue.Queue(max(buffer_size, 1))
+        self._fd = None
+        self._thread = None
+        self._closed = False
+        if path != '-':
+            self._open()
+
+    # Called from request threads. Never blocks
+    def log(self, record: dict):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            # Only an estimate under contention, this isn't worth a lock
+            self.dropped += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True,
+            name='updownserver-access-log')
+        self._thread.start()
+
+    # Write out everything queued so far and stop the writer
+    def close(self, timeout: float = 5):
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread and self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+                self._thread.join(timeout)
+            except queue.Full:
+                pass
+        else:
+            self._write(self._take_all())
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _take_all(self) -> list:
+        records = []
+        while True:
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                return records
+            if record is not None:
+                records.append(record)
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while records[-1] is not None and len(records) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    records.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            stop = records[-1] is None
+            if stop:
+                records.pop()
+                records += self._take_all()
+            try:
+                self._write(records)
+            except Exception as e:
+                # Keep serving even if the log can't be written
+                sys.stderr.write(f'Access log write failed: {e}\n')
+            if stop:
+                return
+
+    def _write(self, records: list):
+        lines = [json.dumps(record, ensure_ascii=False, default=str)
+            for record in records]
+        dropped = self.dropped
+        if dropped != self._reported_dropped:
+            lines.append(json.dumps({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'message': f'{dropped - self._reported_dropped} access log '
+                    'records dropped, buffer full',
+            }))
+            self._reported_dropped = dropped
+        if not lines:
+            return
+
+        data = ('\n'.join(lines) + '\n').encode('utf-8', 'replace')
+        if self.path == '-':
+            sys.stderr.buffer.write(data)
+            sys.stderr.flush()
+            return
+
+        self._reopen_if_rotated()
+        os.write(self._fd, data)
+        if self.max_bytes and os.fstat(self._fd).st_size >= self.max_bytes:
+            self._rotate()
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+            0o644)
+
+    # Another process may have rotated the file since it was opened
+    def _reopen_if_rotated(self):
+        try:
+            current = os.stat(self.path)
+        except FileNotFoundError:
+            current = None
+        opened = os.fstat(self._fd)
+        if current is None or (current.st_dev, current.st_ino) != \
+        (opened.st_dev, opened.st_ino):
+            os.close(self._fd)
+            self._open()
+
+    def _rotate(self):
+        if fcntl:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            # Whoever held the lock first may have rotated the file already
+            current = os.stat(self.path)
+            opened = os.fstat(self._fd)
+            if (current.st_dev, current.st_ino) == \
+            (opened.st_dev, opened.st_ino):
+                for i in range(self.backups - 1, 0, -1):
+                    if os.path.exists(f'{self.path}.{i}'):
+                        os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+                if self.backups > 0:
+                    os.replace(self.path, f'{self.path}.1')
+                else:
+                    os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        finally:
+            if fcntl:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._open()
@@ -0,0 +1,237 @@
+# asyncio engine for serving the request handlers in updownserver/__init__.py.
+#
+# With socketserver, a connection holds a thread for as long as it stays open,
+# so each idle keep-alive client or slow mobile connection takes a thread and
+# its stack, or a place in a bounded pool. Here one event loop accepts the
+# connections, does the TLS handshakes, waits out keep-alive idle time and
+# reads each request head. Only then is the request handed to a handler running
+# in a bounded thread pool. The handler reads the body and writes the response
+# through a Channel, which passes the bytes to and from the event loop, so the
+# handlers and all their disk work run unchanged and never on the loop thread.
+#
+# A handler class used here must handle exactly one request per instance,
+# count requests in Channel.requests_handled and leave the outcome in
+# Channel.close_connection. Nothing in this module depends on the server's
+# global arguments.
+
+import asyncio, concurrent.futures, http.server, io, socket
+
+# Size of each read from a connection
+READ_SIZE = 1 << 18
+
+# Request heads longer than this are handed to the handler unfinished. It reads
+# the rest itself and rejects the request if the head is too long
+MAX_HEAD_SIZE = 1 << 16
+
+# Time allowed for the first request on a new connection, and for the rest of
+# a request head once its first bytes have arrived
+HEAD_TIMEOUT = 60
+
+# A handler waiting this long for the client to send or accept data gives up,
+# so a stalled client can't hold a pool thread forever
+IO_TIMEOUT = 300
+
+# Stands in for the socket a handler would get from socketserver. Handler
+# threads call into it; the StreamReader and StreamWriter are only touched on
+# the event loop
+class Channel:
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._loop = loop
+        self._reader = reader
+        self._writer = writer
+        self.is_tls = writer.get_extra_info('ssl_object') is not None
+
+        # Bytes received but not read by a handler yet. Only used by the event
+        # loop between requests and by the handler thread during one
+        self.buffer = bytearray()
+
+        self.requests_handled = 0
+        self.close_connection = True
+
+    # Event loop side
+
+    async def _read(self) -> bool:
+        data = await self._reader.read(READ_SIZE)
+        self.buffer += data
+        return bool(data)
+
+    # Wait up to `timeout` for the next request to start, then up to
+    # HEAD_TIMEOUT for its head. Returns False if the client closed the
+    # connection or stayed idle
+    async def receive_head(self, timeout: float) -> bool:
+        try:
+            if not self.buffer and not await asyncio.wait_for(self._read(),
+            timeout):
+                return False
+
+            deadline = self._loop.time() + HEAD_TIMEOUT
+            while b'\n\r\n' not in self.buffer and \
+            b'\n\n' not in self.buffer and len(self.buffer) < MAX_HEAD_SIZE:
+                if not await asyncio.wait_for(self._read(),
+                deadline - self._loop.time()):
+                    return False
+        except (asyncio.TimeoutError, OSError):
+            return False
+        return True
+
+    async def _write(self, data: bytes):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    # Handler thread side
+
+    def _call(self, coroutine) -> object:
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        try:
+            return future.result(IO_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError('Timed out waiting for the client')
+
+    # Read more into self.buffer. Returns False at end of stream
+    def receive(self) -> bool:
+        return self._call(self._read())
+
+    def makefile(self, mode: str = 'rb', buffering: int = -1) -> io.RawIOBase:
+        return ChannelReader(self)
+
+    def settimeout(self, timeout: float):
+        pass
+
+    def sendall(self, data: bytes):
+        # The transport may hold on to the data after write() returns, and
+        # callers reuse their buffers
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        self._call(self._write(data))
+
+    # Same signature as socket.sendfile(). Zero-copy on plain TCP, don't use it
+    # with TLS: asyncio would read the file on the event loop
+    def sendfile(self, file, offset: int = 0, count: int = None) -> int:
+        return self._call(self._loop.sendfile(self._writer.transport, file,
+            offset, count))
+
+# Request body reader for handlers. Not buffered beyond Channel.buffer, so bytes
+# of a pipelined next request are left there for the event loop
+class ChannelReader(io.RawIOBase):
+    def __init__(self, channel: Channel):
+        self._channel = channel
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        buffer = self._channel.buffer
+        if not buffer and not self._channel.receive():
+            return 0
+        count = min(len(b), len(buffer))
+        b[:count] = buffer[:count]
+        del buffer[:count]
+        return count
+
+    def readline(self, size: int = -1) -> bytes:
+        buffer = self._channel.buffer
+        start = 0
+        while True:
+            end = buffer.find(b'\n', start)
+            if end >= 0:
+                end += 1
+                break
+            if 0 <= size <= len(buffer) or not self._channel.receive():
+                end = len(buffer)
+                break
+            start = len(buffer)
+
+        if 0 <= size < end:
+            end = size
+        line = bytes(buffer[:end])
+        del buffer[:end]
+        return line
+
+# Drop-in replacement for a socketserver-based HTTP server. Binding, listening
+# and the socketserver API stay the same, only serve_forever() differs
+class AsyncioHTTPServer(http.server.HTTPServer):
+    # Set before serve_forever() is called
+    ssl_context = None
+    keep_alive_timeout = 15
+    threads = 64
+    handshake_timeout = HEAD_TIMEOUT
+    # Connections past max_connections get busy_response and are closed
+    # without reading their request
+    max_connections = 1024
+    busy_response = (b'HTTP/1.1 503 Service Unavailable\r\n'
+        b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+
+    connections = 0
+    _loop = None
+    _stop = None
+
+    def serve_forever(self, poll_interval: float = 0.5):
+        asyncio.run(self.serve())
+
+    def shutdown(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        executor = concurrent.futures.ThreadPoolExecutor(self.threads,
+            thread_name_prefix='updownserver')
+
+        server = await asyncio.start_server(
+            lambda reader, writer: self.handle_connection(reader, writer,
+                executor),
+            sock=self.socket, backlog=self.request_queue_size,
+            ssl=self.ssl_context, limit=READ_SIZE,
+            ssl_handshake_timeout=self.handshake_timeout if self.ssl_context
+                else None)
+        try:
+            await self._stop.wait()
+        finally:
+            server.close()
+            # Handlers still running are stopped by their Channel calls
+            # failing once the loop is gone
+            executor.shutdown(wait=False)
+
+    async def handle_connection(self, reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter, executor: concurrent.futures.Executor):
+        if self.connections >= self.max_connections:
+            writer.write(self.busy_response)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+            return
+
+        # Response heads and bodies are separate writes, and with Nagle's
+        # algorithm the body would wait for the client to ACK the head
+        sock = writer.get_extra_info('socket')
+        if sock is not None and sock.family in (socket.AF_INET,
+        socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        channel = Channel(self._loop, reader, writer)
+        client_address = writer.get_extra_info('peername')
+
+        self.connections += 1
+        try:
+            while await channel.receive_head(self.keep_alive_timeout
+            if channel.requests_handled else HEAD_TIMEOUT):
+                channel.close_connection = True
+                try:
+                    await self._loop.run_in_executor(executor,
+                        self.finish_request, channel, client_address)
+                except Exception:
+                    self.handle_error(channel, client_address)
+                if channel.close_connection:
+                    break
+        finally:
+            self.connections -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
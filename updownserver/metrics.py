@@ -0,0 +1,141 @@
+# In-process counters and histograms, rendered in the Prometheus text format.
+#
+# Recording is a dict lookup and an addition under a lock per metric, cheap
+# enough for every request and every TLS handshake. Values are kept per process,
+# so with --workers each process counts only the connections it served.
+#
+# Nothing in this module depends on the server's global arguments.
+
+import bisect, threading
+
+# Every metric created, in order, for render()
+registry = []
+
+# Latency buckets in seconds, from 1 ms to 1 min
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60)
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value)
+        .replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels) + '}'
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        # Label values as a tuple of (name, value) pairs, sorted by name
+        self._values = {}
+        registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    def samples(self) -> list:
+        with self._lock:
+            return [(self.name, key, value)
+                for key, value in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{format_labels(labels)} '
+                f'{format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+# A Counter that can also go down
+class Gauge(Counter):
+    type = 'gauge'
+
+    # With `function`, the value is whatever it returns when rendered, and the
+    # gauge has no labels
+    def __init__(self, name: str, documentation: str, function=None):
+        super().__init__(name, documentation)
+        self._function = function
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def get(self, **labels) -> float:
+        if self._function:
+            return self._function()
+        return super().get(**labels)
+
+    def samples(self) -> list:
+        if self._function:
+            return [(self.name, (), self._function())]
+        return super().samples()
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+    buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    # Values are [count per bucket, +Inf count, sum]. Buckets are counted
+    # individually here and made cumulative when rendered
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + \
+                    [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self) -> list:
+        samples = []
+        with self._lock:
+            values = [(key, list(counts))
+                for key, counts in self._values.items()]
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                samples.append((self.name + '_bucket',
+                    key + (('le', format_value(bound)),), total))
+            samples.append((self.name + '_sum', key, counts[-1]))
+            samples.append((self.name + '_count', key, total))
+        return samples
+
+    # Number of values observed and their sum
+    def get(self, **labels) -> tuple:
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            if counts is None:
+                return 0, 0.0
+            return sum(counts[:-1]), counts[-1]
+
+def render() -> str:
+    return ''.join(metric.render() for metric in registry)
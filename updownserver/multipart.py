@@ -0,0 +1,369 @@
+# Streaming multipart/form-data parser used for uploads.
+#
+# cgi.FieldStorage walks each part with readline(), comparing every line
+# against the boundary, so a binary upload full of b'\n' bytes costs millions
+# of Python-level iterations per GB. This parser instead reads the body in
+# large blocks into a fixed buffer, looks for the boundary with
+# bytearray.find(), and hands part bodies to their sinks as memoryview slices
+# of that buffer. Per-iteration cost is per block, not per line.
+#
+# Nothing in this module depends on the server's global arguments, so it can
+# be driven from a BytesIO in benchmarks.
+
+import io, os
+
+# Size of each read from the request body
+READ_SIZE = 1 << 20
+# Buffered body data is kept in place, and handed on, once less than this much
+# room is left after it
+MIN_READ_SIZE = 1 << 16
+
+# Limits for things that have to be held in memory
+MAX_HEADER_SIZE = 1 << 16
+MAX_FIELD_SIZE = 1 << 20
+# parse_form() keeps file parts up to this size in memory, as long as the form
+# has MAX_MEMORY_FORM_SIZE left. A temp file per part would make forms of many
+# small files slower than cgi.FieldStorage, which keeps parts under 1000 bytes
+# in memory
+MAX_MEMORY_FILE_SIZE = 1 << 13
+MAX_MEMORY_FORM_SIZE = 1 << 23
+
+class MultipartError(ValueError):
+    pass
+
+# Same rules as cgi.parse_header(), which is not imported here because that
+# would rebind updownserver.cgi under Python < 3.13
+def parse_header(line: str) -> tuple[str, dict]:
+    params = []
+    rest = line
+    while True:
+        end = rest.find(';')
+        while end > 0 and (rest.count('"', 0, end) -
+                rest.count('\\"', 0, end)) % 2:
+            end = rest.find(';', end + 1)
+        if end < 0:
+            params.append(rest.strip())
+            break
+        params.append(rest[:end].strip())
+        rest = rest[end + 1:]
+
+    pdict = {}
+    for param in params[1:]:
+        name, sep, value = param.partition('=')
+        if not sep:
+            continue
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] == '"':
+            value = value[1:-1].replace('\\\\', '\\').replace('\\"', '"')
+        pdict[name.strip().lower()] = value
+    return params[0].lower(), pdict
+
+def valid_boundary(boundary: bytes) -> bool:
+    return 0 < len(boundary) <= 200 and all(32 <= c <= 126 for c in boundary) \
+        and boundary[-1] != 32
+
+class Part:
+    def __init__(self, parser: 'MultipartParser', headers: dict):
+        self._parser = parser
+        self.headers = headers
+        disposition, params = parse_header(headers.get('content-disposition',
+            ''))
+        self.disposition = disposition
+        self.name = params.get('name')
+        # None means this part is a plain form field, '' means a file input
+        # that had nothing selected
+        self.filename = params.get('filename')
+        self.content_type = parse_header(headers.get('content-type',
+            'text/plain' if self.filename is None else
+            'application/octet-stream'))[0]
+        self.consumed = False
+
+    # Stream the part body into write(), which receives memoryview slices of
+    # the parser's buffer and must not keep them after returning. Returns the
+    # number of bytes written
+    def write_to(self, write) -> int:
+        if self.consumed:
+            raise MultipartError('Part body already read')
+        self.consumed = True
+        return self._parser._read_body(write)
+
+    def read(self, limit: int = MAX_FIELD_SIZE) -> bytes:
+        buffer = io.BytesIO()
+        def write(data):
+            if buffer.tell() + len(data) > limit:
+                raise MultipartError(f'Form field "{self.name}" too large')
+            buffer.write(data)
+        self.write_to(write)
+        return buffer.getvalue()
+
+class MultipartParser:
+    def __init__(self, fp, boundary: bytes, content_length: int,
+    read_size: int = READ_SIZE):
+        if not valid_boundary(boundary):
+            raise MultipartError(f'Invalid boundary {boundary!r}')
+
+        self._fp = fp
+        # A buffered reader's readinto() waits until the whole buffer is
+        # filled, readinto1() returns whatever one read of the socket gives.
+        # Parts are handed on as soon as they arrive instead of once per
+        # READ_SIZE of the body
+        self._readinto = getattr(fp, 'readinto1', fp.readinto)
+        self._remaining = content_length
+        self._delimiter = b'\r\n--' + boundary
+
+        # Fixed-size buffer, so memoryview slices never need reallocating. The
+        # spare room past read_size holds a partial delimiter or header block
+        # carried over from the previous read
+        self._buffer = bytearray(read_size + MAX_HEADER_SIZE +
+            len(self._delimiter))
+        self._view = memoryview(self._buffer)
+        # Pretend the body starts with a line break, so the first boundary
+        # looks the same as the others
+        self._buffer[:2] = b'\r\n'
+        self._start = 0
+        self._end = 2
+
+        self.bytes_read = 0
+        self._current = None
+        self._finished = False
+
+    # Read more of the body into the buffer. Returns False at end of body
+    def _fill(self) -> bool:
+        if self._remaining <= 0:
+            return False
+
+        if self._start and len(self._buffer) - self._end < MIN_READ_SIZE:
+            pending = self._end - self._start
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start = 0
+            self._end = pending
+
+        size = min(len(self._buffer) - self._end, self._remaining)
+        if size <= 0:
+            raise MultipartError('Part headers too large')
+        count = self._readinto(self._view[self._end:self._end + size])
+        if not count:
+            raise MultipartError('Unexpected end of request body')
+
+        self._end += count
+        self._remaining -= count
+        self.bytes_read += count
+        return True
+
+    # Read until at least `size` bytes are buffered
+    def _require(self, size: int):
+        while self._end - self._start < size:
+            if not self._fill():
+                raise MultipartError('Unexpected end of request body')
+
+    # Stream bytes up to the next delimiter into write(), then consume the
+    # delimiter itself
+    def _read_body(self, write) -> int:
+        delimiter = self._delimiter
+        # Bytes at the end of the buffer that could be the start of a
+        # delimiter split across two reads must be held back
+        keep = len(delimiter) - 1
+        total = 0
+        # Offset from _start of the bytes not searched yet. Held as an offset,
+        # since _fill() may move the buffered bytes
+        searched = 0
+
+        while True:
+            index = self._buffer.find(delimiter, self._start + searched,
+                self._end)
+            if index >= 0:
+                if index > self._start:
+                    write(self._view[self._start:index])
+                    total += index - self._start
+                self._start = index + len(delimiter)
+                return total
+
+            # readinto1() may return a TLS record at a time. Small reads are
+            # searched as they come, so a part ends as soon as its delimiter
+            # arrives, but the data is handed on in blocks of about READ_SIZE
+            safe = self._end - keep
+            if safe > self._start and \
+            len(self._buffer) - self._end < MIN_READ_SIZE:
+                write(self._view[self._start:safe])
+                total += safe - self._start
+                self._start = safe
+            searched = max(safe - self._start, 0)
+
+            if not self._fill():
+                raise MultipartError('Unexpected end of request body')
+
+    # Called right after a delimiter has been consumed. Returns the next part's
+    # headers, or None if that was the closing delimiter
+    def _read_headers(self) -> dict:
+        self._require(2)
+        if self._buffer[self._start:self._start + 2] == b'--':
+            return None
+
+        # Skip transport padding, then the line break ending the delimiter
+        while True:
+            self._require(1)
+            if self._buffer[self._start] not in b' \t':
+                break
+            self._start += 1
+        self._require(2)
+        if self._buffer[self._start:self._start + 2] != b'\r\n':
+            raise MultipartError('Malformed boundary line')
+        self._start += 2
+
+        self._require(2)
+        if self._buffer[self._start:self._start + 2] == b'\r\n':
+            self._start += 2
+            return {}
+
+        while True:
+            index = self._buffer.find(b'\r\n\r\n', self._start, self._end)
+            if index >= 0:
+                break
+            if self._end - self._start > MAX_HEADER_SIZE:
+                raise MultipartError('Part headers too large')
+            if not self._fill():
+                raise MultipartError('Unexpected end of request body')
+
+        block = bytes(self._view[self._start:index]).decode('utf-8', 'replace')
+        self._start = index + 4
+
+        headers = {}
+        for line in block.split('\r\n'):
+            if line[:1] in (' ', '\t') and headers:
+                # Folded continuation of the previous header
+                headers[name] += ' ' + line.strip()
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise MultipartError('Malformed part header')
+            name = name.strip().lower()
+            headers[name] = value.strip()
+        return headers
+
+    # Yield each Part in order. A part's body must be read before the next part
+    # is requested; whatever is left unread is discarded
+    def __iter__(self):
+        if self._finished:
+            return
+
+        # Skip the preamble, up to and including the first delimiter
+        self._read_body(lambda data: None)
+
+        while True:
+            if self._current and not self._current.consumed:
+                self._current.write_to(lambda data: None)
+
+            headers = self._read_headers()
+            if headers is None:
+                break
+
+            self._current = Part(self, headers)
+            yield self._current
+
+        # Discard the epilogue, so a kept-alive connection stays in sync
+        self._start = self._end
+        while self._fill():
+            self._start = self._end
+        self._finished = True
+
+# Stands in for the cgi.FieldStorage objects that receive_mkdir() was written
+# against: fields have .name, .filename, .file and .value
+class FormField:
+    def __init__(self, name: str, filename: str, file: object = None,
+    value: str = None):
+        self.name = name
+        self.filename = filename
+        self.file = file
+        self._value = value
+
+    @property
+    def value(self) -> object:
+        if self._value is None and self.file is not None:
+            self.file.seek(0)
+            return self.file.read()
+        return self._value
+
+    def __repr__(self) -> str:
+        return f'FormField({self.name!r}, {self.filename!r}, {self.value!r})' \
+            if self.file is None else \
+            f'FormField({self.name!r}, {self.filename!r}, {self.file!r})'
+
+class MultipartForm:
+    def __init__(self):
+        self.fields = []
+
+    def __contains__(self, key: str) -> bool:
+        return any(field.name == key for field in self.fields)
+
+    # Same convention as cgi.FieldStorage: a repeated field gives a list
+    def __getitem__(self, key: str) -> object:
+        found = [field for field in self.fields if field.name == key]
+        if not found:
+            raise KeyError(key)
+        return found[0] if len(found) == 1 else found
+
+    def getvalue(self, key: str, default: object = None) -> object:
+        if key not in self:
+            return default
+        value = self[key]
+        if isinstance(value, list):
+            return [field.value for field in value]
+        return value.value
+
+    def keys(self) -> list:
+        return list(dict.fromkeys(field.name for field in self.fields))
+
+    # Remove spooled files that were not moved into place
+    def cleanup(self):
+        for field in self.fields:
+            if field.file is None or not hasattr(field.file, 'name'):
+                continue
+            field.file.close()
+            try:
+                os.remove(field.file.name)
+            except FileNotFoundError:
+                pass
+
+# Read a file part into a BytesIO if it is at most `limit` bytes, otherwise
+# into a file from make_file(part). Returns the file, at its start
+def read_file_part(part: Part, make_file, limit: int) -> object:
+    buffer = io.BytesIO()
+    file = buffer
+    def write(data):
+        nonlocal file
+        if file is buffer and buffer.tell() + len(data) > limit:
+            file = make_file(part)
+            file.write(buffer.getbuffer())
+        file.write(data)
+
+    try:
+        part.write_to(write)
+    except BaseException:
+        if file is not buffer:
+            file.close()
+            os.remove(file.name)
+        raise
+    file.seek(0)
+    return file
+
+# Parse a whole form, keeping small file parts and other fields in memory and
+# spooling larger file parts into files from make_file(part)
+def parse_form(fp, boundary: bytes, content_length: int, make_file,
+encoding: str = 'utf-8', errors: str = 'replace') -> MultipartForm:
+    form = MultipartForm()
+    memory = MAX_MEMORY_FORM_SIZE
+    try:
+        for part in MultipartParser(fp, boundary, content_length):
+            if part.filename is None:
+                form.fields.append(FormField(part.name, None,
+                    value=part.read().decode(encoding, errors)))
+            else:
+                file = read_file_part(part, make_file,
+                    min(MAX_MEMORY_FILE_SIZE, memory))
+                if isinstance(file, io.BytesIO):
+                    memory -= len(file.getbuffer())
+                form.fields.append(FormField(part.name, part.filename, file))
+    except BaseException:
+        form.cleanup()
+        raise
+    return form
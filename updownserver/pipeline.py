@@ -0,0 +1,155 @@
+# Pipelined disk writes for upload bodies.
+#
+# Written inline, an upload alternates between reading the socket and writing
+# the file, so whenever a write stalls on a slow or busy disk nothing drains the
+# socket and the client's TCP window closes. Here the request thread only puts
+# received data into one of a fixed set of reusable buffers and queues it, and
+# a writer thread writes queued buffers to their files and hands them back.
+#
+# Buffer memory stays at buffers * buffer_size per upload. When every buffer is
+# waiting to be written, the request thread waits for one (a disk stall). When
+# none are, the writer waits for the next (a network stall). Both are counted.
+# A body that fits in one buffer is written inline, without starting a thread.
+#
+# Nothing in this module depends on the server's global arguments.
+
+import queue, threading, time
+
+class PipelinedWriter:
+    def __init__(self, buffer_size: int = 1 << 20, buffers: int = 4):
+        self.buffer_size = buffer_size
+        self.buffers = max(buffers, 2)
+
+        # Seconds the request thread waited for a free buffer, and the writer
+        # thread waited for a full one
+        self.disk_stall = 0.0
+        self.network_stall = 0.0
+        # Seconds the writer thread spent in write()
+        self.write_seconds = 0.0
+        # Whether the writer thread was needed
+        self.pipelined = False
+
+        # The buffer being filled, which file it is for, and how much of it is
+        # used
+        self._buffer = None
+        self._view = None
+        self._file = None
+        self._used = 0
+
+        self._free = queue.Queue()
+        # (file, buffer, bytes used) to write, None to stop the writer
+        self._full = queue.Queue()
+        self._allocated = 0
+        self._thread = None
+        self._error = None
+
+    # Copy data, to be written to file. Doesn't keep a reference to data, so
+    # callers can reuse its memory once this returns
+    def write(self, file: object, data: memoryview):
+        data = memoryview(data).cast('B')
+        while data:
+            view = self._take(file)
+            count = min(len(data), len(view))
+            view[:count] = data[:count]
+            self._used += count
+            data = data[count:]
+
+    # Read into the current buffer with readinto() (of at most `size` bytes),
+    # to be written to file. Saves the copy write() makes. Returns what
+    # readinto() returned
+    def readinto(self, file: object, readinto, size: int) -> int:
+        view = self._take(file)
+        count = readinto(view[:size])
+        if count:
+            self._used += count
+        return count
+
+    # Wait until everything given so far has been written. Raises the error
+    # the writer thread ran into, if any, here and on every later call
+    def flush(self):
+        if self._used:
+            if self._thread:
+                self._queue()
+            else:
+                # Never filled a buffer, no need for a thread
+                start = time.perf_counter()
+                try:
+                    self._file.write(self._view[:self._used])
+                finally:
+                    self.write_seconds += time.perf_counter() - start
+                    self._used = 0
+        if self._thread:
+            self._full.join()
+        self._raise()
+
+    # Flush and stop the writer thread
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._thread:
+                self._full.put(None)
+                self._thread.join()
+                self._thread = None
+
+    def _raise(self):
+        if self._error:
+            raise self._error
+
+    # Returns the free part of the current buffer, first queueing it if it is
+    # full or for another file
+    def _take(self, file: object) -> memoryview:
+        if file is not self._file and self._used:
+            self.flush()
+        elif self._view is not None and self._used == len(self._view):
+            if not self._thread:
+                self._start()
+            self._queue()
+        self._raise()
+
+        if self._view is None:
+            if self._allocated < self.buffers:
+                self._allocated += 1
+                self._buffer = bytearray(self.buffer_size)
+                self._view = memoryview(self._buffer)
+            else:
+                start = time.perf_counter()
+                self._buffer = self._free.get()
+                self.disk_stall += time.perf_counter() - start
+                self._view = memoryview(self._buffer)
+        self._file = file
+        return self._view[self._used:]
+
+    def _queue(self):
+        self._full.put((self._file, self._buffer, self._used))
+        self._buffer = None
+        self._view = None
+        self._used = 0
+
+    def _start(self):
+        self.pipelined = True
+        self._thread = threading.Thread(target=self._run, daemon=True,
+            name='updownserver-upload-writer')
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            start = time.perf_counter()
+            item = self._full.get()
+            if item is None:
+                self._full.task_done()
+                return
+            self.network_stall += time.perf_counter() - start
+
+            file, buffer, used = item
+            # After an error, buffers are only handed back, so the request
+            # thread never waits for one that won't come
+            if not self._error:
+                start = time.perf_counter()
+                try:
+                    file.write(memoryview(buffer)[:used])
+                except Exception as e:
+                    self._error = e
+                self.write_seconds += time.perf_counter() - start
+            self._free.put(buffer)
+            self._full.task_done()